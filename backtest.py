@@ -0,0 +1,151 @@
+## Backtest of the energy estimators on recorded traces
+## Every dataset of a DataReader trace file is binned into per-slot energies (through the trace cache of
+## harvester.py) and fed through several estimator configurations at once: one batched estimator per estimator
+## type steps every (configuration, dataset) stream in a single call per slot. Before every slot the estimate
+## is compared with the energy that is then harvested, as in estimator_experiment.py.
+##
+## Example:
+##   python backtest.py ../Energy_Modelling/pwr_cars.h5 --kalman 1e-14 1e-13 --piecewise 0.9:0.5 0.8:0.2
+##
+## The measurement noise of the Kalman estimator is the standard deviation of the last --window samples of a
+## dataset, as in estimator_experiment.py.
+
+import json
+import numpy as np
+
+from estimator import BatchKalmanEstimator, BatchPieceWiseEstimator, RollingVariance
+from harvester import cached_slot_energies, trace_datasets
+
+
+def load_streams(path, datasets=None, Ts=1e-2):
+    """Per-slot energies of datasets of a trace file, as an array of shape (slots, datasets).
+
+    Args:
+        path: hdf5 trace file
+        datasets: dataset names or node numbers, every dataset of the file if None
+        Ts: slot length in seconds the traces are binned to
+
+    Returns:
+        the dataset names and the energies, cut to the length of the shortest dataset
+    """
+    names = trace_datasets(path, "random" if datasets is None else list(datasets))
+    energies = cached_slot_energies(path, names, Ts)
+    slots = min(len(energies[name]) for name in names)
+    return names, np.stack([np.asarray(energies[name][:slots], dtype=np.float64) for name in names], axis=1)
+
+
+class ErrorStats:
+    """Running error statistics of n streams, the error being sample - estimate."""
+
+    def __init__(self, n):
+        self.count = 0
+        self.sum = np.zeros(n)
+        self.sum_abs = np.zeros(n)
+        self.sum_sq = np.zeros(n)
+        self.shortfall = np.zeros(n)
+        self.covered = np.zeros(n, dtype=np.int64)
+
+    def add(self, sample, estimate):
+        error = sample - estimate
+        self.count += 1
+        self.sum += error
+        self.sum_abs += np.abs(error)
+        self.sum_sq += error * error
+        ## Energy that was expected but not harvested, the error estimator_experiment.py plots
+        self.shortfall += np.maximum(error, 0.0)
+        self.covered += estimate >= sample
+
+    def summary(self, i):
+        n = max(self.count, 1)
+        return {'bias': self.sum[i] / n, 'mae': self.sum_abs[i] / n, 'rmse': float(np.sqrt(self.sum_sq[i] / n)),
+                'shortfall': self.shortfall[i] / n, 'coverage': self.covered[i] / n}
+
+
+def backtest(energy, kalman=(), piecewise=(), window=5, warmup=10):
+    """Run every estimator configuration over every stream of energy.
+
+    Args:
+        energy: per-slot energies, shape (slots, datasets)
+        kalman: process_noise of every Kalman configuration
+        piecewise: (decay_rate, threshold) of every PieceWise configuration
+        window: number of samples of the rolling measurement noise
+        warmup: slots the estimators are updated for before they are scored
+
+    Returns:
+        list with the configuration, dataset index and error statistics of every stream
+    """
+    slots, D = energy.shape
+    kalman, piecewise = list(kalman), list(piecewise)
+    ## Stream c * D + d runs configuration c on dataset d
+    filters = []
+    if kalman:
+        filters.append(('kalman', kalman, BatchKalmanEstimator(np.repeat(kalman, D), len(kalman) * D)))
+    if piecewise:
+        decay, threshold = zip(*piecewise)
+        filters.append(('piecewise', piecewise,
+                        BatchPieceWiseEstimator(np.repeat(decay, D), np.repeat(threshold, D), len(piecewise) * D)))
+    stats = [ErrorStats(len(configs) * D) for _, configs, _ in filters]
+    noise = RollingVariance(D, window)
+
+    for t in range(slots):
+        sample = energy[t]
+        noise.update(sample)
+        for (kind, configs, estimator), stat in zip(filters, stats):
+            samples = np.tile(sample, len(configs))
+            if t >= warmup:
+                stat.add(samples, estimator.estimate())
+            if kind == 'kalman':
+                estimator.update(samples, np.tile(noise.std(), len(configs)))
+            else:
+                estimator.update(samples)
+
+    results = []
+    for (kind, configs, _), stat in zip(filters, stats):
+        for c, config in enumerate(configs):
+            params = {'process_noise': config} if kind == 'kalman' else {'decay_rate': config[0], 'threshold': config[1]}
+            for d in range(D):
+                results.append(dict(estimator=kind, dataset=d, **params, **stat.summary(c * D + d)))
+    return results
+
+
+def summarize(results, names):
+    """Error statistics of every configuration, averaged over the datasets, best rmse first."""
+    configs = dict()
+    for result in results:
+        key = tuple((k, v) for k, v in result.items() if k in ('estimator', 'process_noise', 'decay_rate', 'threshold'))
+        configs.setdefault(key, []).append(result)
+    summary = []
+    for key, rows in configs.items():
+        row = dict(key)
+        for stat in ('bias', 'mae', 'rmse', 'shortfall', 'coverage'):
+            row[stat] = float(np.mean([r[stat] for r in rows]))
+        row['datasets'] = [names[r['dataset']] for r in rows]
+        summary.append(row)
+    return sorted(summary, key=lambda row: row['rmse'])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace_file", help="hdf5 trace file in the DataReader format")
+    parser.add_argument("--datasets", nargs="*", default=None, help="Datasets to backtest on, all by default")
+    parser.add_argument("--Ts", type=float, default=1e-2, help="Slot length in seconds the traces are binned to")
+    parser.add_argument("--kalman", type=float, nargs="*", default=[], help="Process noise of every Kalman configuration")
+    parser.add_argument("--piecewise", nargs="*", default=[], help="decay_rate:threshold of every PieceWise configuration")
+    parser.add_argument("--window", type=int, default=5, help="Samples of the rolling measurement noise")
+    parser.add_argument("--warmup", type=int, default=10, help="Slots the estimators run before they are scored")
+    parser.add_argument("--output", default=None, help="Json file the results of every stream are written to")
+    args = parser.parse_args()
+
+    piecewise = [tuple(float(x) for x in p.split(":")) for p in args.piecewise]
+    names, energy = load_streams(args.trace_file, args.datasets, args.Ts)
+    results = backtest(energy, args.kalman, piecewise, args.window, args.warmup)
+    for row in summarize(results, names):
+        params = ", ".join("%s=%g" % (k, row[k]) for k in ('process_noise', 'decay_rate', 'threshold') if k in row)
+        print("%-10s %-32s rmse %.3e  mae %.3e  bias %+.3e  shortfall %.3e  coverage %.3f"
+              % (row['estimator'], params, row['rmse'], row['mae'], row['bias'], row['shortfall'], row['coverage']))
+    if args.output is not None:
+        for result in results:
+            result['dataset'] = names[result['dataset']]
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
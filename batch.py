@@ -0,0 +1,449 @@
+## Vectorized batch Monte Carlo engine
+## Keeps the state of every trial and node in (trials, nodes) arrays and advances all trials one
+## slot at a time with NumPy operations. Each step mirrors, in order, Node.run_one_time_step,
+## Radio.publish, Radio.subscribe and Node.build_channel_map of the slot-stepped engine in
+## simulation.py, so the discovery latencies follow the same distribution.
+
+import logging
+import numpy as np
+import yaml
+
+from harvester import load_energy_indices, trace_datasets, GaussianSource, LogNormalSource, OnOffSource, DiurnalSource
+from node import ACTION, RUN_TYPE, ChannelMap
+from topology import node_config, topology_from_config
+
+## Integer codes for the per-slot action array
+SLEEP = ACTION.SLEEP.value
+ADVERTISE = ACTION.ADVERTISE.value
+SCAN = ACTION.SCAN.value
+
+## Nodes reset once their voltage drops below this level after having run once (Node.compute_energy_level)
+RESET_VOLTAGE = 1.8
+## Sleep drain per slot and scans per period, as hard-coded in Node
+ESLEEP = 10.5e-9
+N_SCANS = 15
+
+
+def channel_maps(period, shape):
+    """An empty sparse ChannelMap of every node, as an object array of the given shape whose last axis are the nodes.
+
+    The maps only hold the slots that have entries, so their size does not grow with the period.
+    """
+    maps = np.empty(shape, dtype=object)
+    for index in np.ndindex(*shape):
+        maps[index] = ChannelMap(int(period[index[-1]]))
+    return maps
+
+
+def node_parameters(config):
+    """Collect the per-node parameters of a simulation config into arrays of shape (nodes,)."""
+    num_nodes = config['num_nodes']
+    nodes_config = [node_config(config, i) for i in range(num_nodes)]
+
+    params = {}
+    for key in ('alpha', 'capacitance', 'von', 'voff', 'eadv', 'escan'):
+        params[key] = np.array([float(c.get(key)) for c in nodes_config])
+    params['period'] = np.array([int(c.get('nominal_runtime')) for c in nodes_config], dtype=np.int64)
+
+    runtypes = []
+    for c in nodes_config:
+        runtype = RUN_TYPE.NORMAL
+        if c.get('runtype') == 'scanning':
+            runtype = RUN_TYPE.SCANNING
+        elif c.get('runtype') == 'advertising':
+            runtype = RUN_TYPE.ADVERTISING
+        runtypes.append(runtype.value)
+    params['runtype'] = np.array(runtypes)
+
+    ## Same harvester set-up as run_simulation
+    modes, power, mean, std, files, datasets = [], [], [], [], [], []
+    stochastic = dict((key, []) for key in ('sigma', 'mean_on', 'mean_off', 'day', 'noise'))
+    for c in nodes_config:
+        harvester = c.get('harvester')
+        mode = harvester.get('harvesting_mode')
+        cycle_energy = 0.5 * c.get('capacitance') * (c.get('von')**2 - c.get('voff')**2) / c.get('nominal_runtime')
+        p, m, s, f, d = 0.0, 0.0, 0.0, None, None
+        extra = dict((key, 0.0) for key in stochastic)
+        if mode == 'constant':
+            p = harvester.get('power')
+            p = cycle_energy if p == "default" else float(p)
+        elif mode == 'gaussian':
+            m = cycle_energy
+            s = float(harvester.get('std')) * m
+        elif mode == 'lognormal':
+            m = cycle_energy
+            extra['sigma'] = float(harvester.get('sigma'))
+        elif mode == 'onoff':
+            ## Harvests `power` while on, so that the mean over the on and off periods is the cycle energy
+            m = cycle_energy
+            extra['mean_on'] = float(harvester.get('mean_on'))
+            extra['mean_off'] = float(harvester.get('mean_off'))
+            p = m * (extra['mean_on'] + extra['mean_off']) / extra['mean_on']
+        elif mode == 'diurnal':
+            m = cycle_energy
+            extra['day'] = float(harvester.get('day'))
+            extra['noise'] = float(harvester.get('noise', 0.0))
+        elif mode == 'file':
+            f = harvester.get('file')
+            d = trace_datasets(f, harvester.get('dataset'))
+        else:
+            raise ValueError("Unknown harvesting mode: " + str(mode))
+        modes.append(mode)
+        power.append(p)
+        mean.append(m)
+        std.append(s)
+        files.append(f)
+        datasets.append(d)
+        for key in stochastic:
+            stochastic[key].append(extra[key])
+    params['harvesting_mode'] = modes
+    params['power'] = np.array(power)
+    params['mean'] = np.array(mean)
+    params['std'] = np.array(std)
+    params['file'] = files
+    ## Candidate datasets of every file harvester, one of which is drawn per trial
+    params['dataset'] = datasets
+    for key, values in stochastic.items():
+        params[key] = np.array(values)
+
+    return params
+
+
+## Harvesting modes generated by a BlockSource
+STOCHASTIC_MODES = ('gaussian', 'lognormal', 'onoff', 'diurnal')
+
+
+def harvest_source(params, mode, nodes, generator, trials=None, block_size=1024):
+    """BlockSource of the given nodes of a stochastic harvesting mode, one slot of shape (nodes,) or
+    (trials, nodes). A single node id gives a source of shape () for that node alone."""
+    shape = np.shape(nodes) if trials is None else (trials,) + np.shape(nodes)
+    mean = params['mean'][nodes]
+    if mode == 'gaussian':
+        ## Harvester.get_energy draws from normal(mean, mean*std)
+        return GaussianSource(generator, mean, mean * params['std'][nodes], shape, block_size)
+    elif mode == 'lognormal':
+        return LogNormalSource(generator, mean, params['sigma'][nodes], shape, block_size)
+    elif mode == 'onoff':
+        return OnOffSource(generator, params['power'][nodes], params['mean_on'][nodes], params['mean_off'][nodes],
+                           shape, block_size)
+    elif mode == 'diurnal':
+        return DiurnalSource(generator, mean, params['day'][nodes], params['noise'][nodes], shape, block_size)
+    raise ValueError("Not a stochastic harvesting mode: " + str(mode))
+
+
+class BatchSimulation:
+    """Runs many independent trials of the discovery simulation in lock-step.
+
+    Args:
+        config: simulation config as loaded from the yaml file
+        n_trials: number of independent trials
+        seed: seed of the random generator shared by all trials
+        Ts: slot length in seconds, used to bin file traces
+        topology: network topology, read from the config if not given
+        compact_fraction: retired trials are dropped from the state arrays once they make up this
+            fraction of the rows still being stepped
+    """
+
+    def __init__(self, config, n_trials, seed=None, Ts=1e-2, topology=None, compact_fraction=0.25, log_level=logging.INFO):
+        self.config = config
+        self.num_nodes = config['num_nodes']
+        self.num_cycles = config['num_cycles']
+        self.n_trials = n_trials
+        self.Ts = Ts
+        self.compact_fraction = compact_fraction
+        self.rng = np.random.default_rng(seed)
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(log_level)
+
+        self.params = node_parameters(config)
+        self.max_slots = self.num_cycles * int(self.params['period'][0])
+        self.topology = topology if topology is not None else topology_from_config(config, self.rng)
+        ## Node 0 has discovered the network once it counted every node it hears
+        self.targets, self.single = self.topology.discovery_targets(0)
+        self.target = len(self.targets)
+
+        p = self.params
+        self.alpha = p['alpha']
+        self.capacitance = p['capacitance']
+        self.von = p['von']
+        self.voff = p['voff']
+        self.eadv = p['eadv']
+        self.escan = p['escan']
+        self.period = p['period']
+        self.scan_probability = N_SCANS / self.period
+        self.is_normal = p['runtype'] == RUN_TYPE.NORMAL.value
+        self.is_advertising = p['runtype'] == RUN_TYPE.ADVERTISING.value
+        self.is_scanning = p['runtype'] == RUN_TYPE.SCANNING.value
+        self.is_constant = np.array([m == 'constant' for m in p['harvesting_mode']])
+        self.is_file = np.array([m == 'file' for m in p['harvesting_mode']])
+        self._load_traces()
+
+        self.reset_state()
+
+    def _load_traces(self):
+        ## Every file harvester replays one of its candidate datasets, drawn per trial, through the shared energy
+        ## indices
+        self.trace_of_node = [None] * self.num_nodes
+        self.trace_length = [None] * self.num_nodes
+        self.samples_per_slot = [0] * self.num_nodes
+        for i, f in enumerate(self.params['file']):
+            if f is not None:
+                self.trace_of_node[i] = load_energy_indices(f, self.params['dataset'][i], self.Ts)
+                self.trace_length[i] = np.array([len(index) for index in self.trace_of_node[i]])
+                self.samples_per_slot[i] = self.trace_of_node[i][0].samples_per_slot(self.Ts)
+
+    def reset_state(self):
+        """Allocate the (trials, nodes) state arrays for a fresh set of trials."""
+        T, N = self.n_trials, self.num_nodes
+        self.slot = 0
+        self.trial_id = np.arange(T)
+        self.results = [None] * T
+        self.retired = np.zeros(T, dtype=bool)
+
+        self.energy = np.zeros((T, N))
+        self.on = np.zeros((T, N), dtype=bool)
+        self.ran_once = np.zeros((T, N), dtype=bool)
+        self.done = np.zeros((T, N), dtype=bool)
+        self.offset = self.rng.integers(0, self.period, size=(T, N))
+        self.action_decided = np.zeros((T, N), dtype=bool)
+        self.nScan = np.zeros((T, N), dtype=np.int64)
+        self.next_wakeup = np.zeros((T, N), dtype=np.int64)
+        self.action = np.zeros((T, N), dtype=np.int8)
+
+        ## Sparse channel map of every node plus arrays of its running maximum and first argmax, so "any entry"
+        ## and "best slot" are vector operations
+        self.channel_map = channel_maps(self.period, (T, N))
+        self.map_max = np.zeros((T, N), dtype=np.int32)
+        self.map_best = np.zeros((T, N), dtype=np.int64)
+
+        ## Dataset and position of each file harvester in its trace
+        self.trace_choice = np.zeros((T, N), dtype=np.int64)
+        self.trace_offset = np.zeros((T, N), dtype=np.int64)
+        for i, indices in enumerate(self.trace_of_node):
+            if indices is None:
+                continue
+            if len(indices) == 1:
+                self.trace_offset[:, i] = self.rng.integers(0, len(indices[0]), size=T)
+            else:
+                self.trace_choice[:, i] = self.rng.integers(0, len(indices), size=T)
+                self.trace_offset[:, i] = self.rng.integers(0, self.trace_length[i][self.trace_choice[:, i]])
+
+        ## One block generator per stochastic harvesting mode, over its nodes in every trial
+        modes = np.array(self.params['harvesting_mode'])
+        self.sources = []
+        for mode in STOCHASTIC_MODES:
+            nodes = np.flatnonzero(modes == mode)
+            if len(nodes) > 0:
+                self.sources.append((nodes, harvest_source(self.params, mode, nodes, self.rng, trials=T)))
+
+        self.metrics = {}
+        for key in ("adv_sent", "scan_sent", "adv_success", "scan_success"):
+            self.metrics[key] = np.zeros((T, N), dtype=np.int64)
+
+    def _harvest(self, mask):
+        T, N = mask.shape
+        energy_in = np.zeros((T, N))
+        if self.is_constant.any():
+            energy_in += np.where(self.is_constant, self.params['power'], 0.0)
+        ## The stochastic sources advance every slot, also for nodes that do not harvest in it
+        for nodes, source in self.sources:
+            energy_in[:, nodes] = source.take(1)[0]
+        for i, indices in enumerate(self.trace_of_node):
+            if indices is None:
+                continue
+            start = self.trace_offset[:, i]
+            if len(indices) == 1:
+                energy_in[:, i] = indices[0].window(start, self.samples_per_slot[i])
+            else:
+                for k, index in enumerate(indices):
+                    rows = self.trace_choice[:, i] == k
+                    energy_in[rows, i] = index.window(start[rows], self.samples_per_slot[i])
+            length = self.trace_length[i][self.trace_choice[:, i]]
+            ## The harvester only advances through its trace when it is read
+            self.trace_offset[:, i] = np.where(mask[:, i], (start + self.samples_per_slot[i]) % length, start)
+        return np.where(mask, energy_in, 0.0)
+
+    def _compute_energy_level(self, mask, energy_in):
+        self.energy += np.where(mask, energy_in, 0.0)
+        voltage = np.sqrt(2 * np.maximum(self.energy, 0.0) / self.capacitance)
+        reset = mask & (voltage < RESET_VOLTAGE) & self.ran_once
+        if reset.any():
+            self._reset(reset)
+        self.on = np.where(mask & (voltage > self.von), True, self.on)
+        self.on = np.where(mask & (voltage < self.voff), False, self.on)
+
+    def _reset(self, mask):
+        for channel_map in self.channel_map[mask]:
+            channel_map.reset()
+        self.map_max[mask] = 0
+        self.map_best[mask] = 0
+        self.next_wakeup[mask] = 0
+        self.on[mask] = False
+        self.offset[mask] = self.rng.integers(0, np.broadcast_to(self.period, mask.shape)[mask])
+        self.ran_once[mask] = False
+        self.action_decided[mask] = False
+
+    def _decide(self, asn):
+        ## Node.run_one_time_step for every node of every trial
+        T, N = self.on.shape
+        period = self.period
+        position = asn % period
+        action = np.full((T, N), SLEEP, dtype=np.int8)
+
+        active = self.on & ~self.done
+        normal = active & self.is_normal
+        self.ran_once |= active
+
+        undecided = normal & ~self.action_decided
+        choose_advertise = undecided & (self.rng.random((T, N)) < self.alpha)
+        choose_scan = undecided & ~choose_advertise
+        self.nScan[choose_advertise] = 0
+        self.nScan[choose_scan] = N_SCANS
+        self.action_decided |= undecided
+
+        ## Plan the advertisement: follow the channel map if it has an entry, else the node's own offset
+        has_map = self.map_max > 0
+        best = self.map_best
+        to_best = np.where(position > best, period - position + best, best - position)
+        planned = choose_advertise & has_map
+        self.next_wakeup = np.where(planned, asn + to_best, self.next_wakeup)
+
+        own = choose_advertise & ~has_map
+        late = own & (position > self.offset)
+        now = own & (position == self.offset)
+        early = own & (position < self.offset)
+        self.next_wakeup = np.where(late, asn + period - position + self.offset, self.next_wakeup)
+        self.next_wakeup = np.where(now, asn + period, self.next_wakeup)
+        self.next_wakeup = np.where(early, asn + self.offset - position, self.next_wakeup)
+        action[now] = ADVERTISE
+        self.action_decided &= ~now
+        self.metrics["adv_sent"] += now
+
+        wake = normal & (self.next_wakeup == asn)
+        action[wake] = ADVERTISE
+        self.action_decided &= ~wake
+        self.metrics["adv_sent"] += wake
+
+        scanning = normal & (self.nScan > 0)
+        scan = scanning & (self.rng.random((T, N)) < self.scan_probability)
+        action[scanning] = SLEEP
+        action[scan] = SCAN
+        self.nScan -= scan
+        self.action_decided &= ~(scan & (self.nScan == 0))
+        self.metrics["scan_sent"] += scan
+
+        advertising = active & self.is_advertising
+        action[advertising] = ADVERTISE
+        self.metrics["adv_sent"] += advertising
+        ## Scanning nodes spend the scan energy but never switch their radio on
+        action[active & self.is_scanning] = SCAN
+
+        self.action = action
+        radio_advertise = (action == ADVERTISE) & (self.is_normal | self.is_advertising)
+        radio_scan = (action == SCAN) & self.is_normal
+        return position, radio_advertise, radio_scan
+
+    def _resolve(self, radio_advertise, radio_scan):
+        ## Radio.publish/subscribe: an advertiser succeeds if exactly one neighbour advertised,
+        ## a scanner succeeds if at least one neighbour advertised
+        T, N = radio_advertise.shape
+        rows, transmitters = np.nonzero(radio_advertise)
+        listeners, owner = self.topology.expand(transmitters)
+        heard = np.bincount(rows[owner] * N + listeners, minlength=T * N).reshape(T, N)
+        return (radio_advertise & (heard == 1)) | (radio_scan & (heard >= 1))
+
+    def _build_channel_map(self, position, radio_advertise, radio_scan, success):
+        advertise_success = success & radio_advertise
+        scan_success = success & radio_scan
+        self.metrics["adv_success"] += advertise_success
+        self.metrics["scan_success"] += scan_success
+
+        ## The hub clears the slot it just advertised in and draws a new offset, the others are done
+        hub = np.nonzero(advertise_success[:, 0])[0]
+        if len(hub) > 0:
+            p = int(position[0])
+            self.offset[hub, 0] = self.rng.integers(0, self.period[0], size=len(hub))
+            for t in hub:
+                channel_map = self.channel_map[t, 0]
+                channel_map.clear(p)
+                self.map_best[t, 0], self.map_max[t, 0] = channel_map.best, channel_map.best_count
+        self.done[:, 1:] |= advertise_success[:, 1:]
+
+        rows, cols = np.nonzero(scan_success)
+        if len(rows) > 0:
+            maps = self.channel_map[rows, cols]
+            for channel_map, p in zip(maps, position[cols].tolist()):
+                channel_map.add(p)
+            self.map_max[rows, cols] = [channel_map.best_count for channel_map in maps]
+            self.map_best[rows, cols] = [channel_map.best for channel_map in maps]
+
+        ## Debit the energy spent in this slot
+        debit = np.where(self.action == ADVERTISE, -self.eadv,
+                         np.where(self.action == SCAN, -self.escan, -ESLEEP))
+        spent = (self.action != SLEEP) | self.ran_once
+        self._compute_energy_level(spent, debit)
+
+    def step(self):
+        """Advance every trial still being stepped by one slot."""
+        self.slot += 1
+        asn = self.slot
+
+        harvesting = asn > self.offset
+        self._compute_energy_level(harvesting, self._harvest(harvesting))
+        position, radio_advertise, radio_scan = self._decide(asn)
+        success = self._resolve(radio_advertise, radio_scan)
+        self._build_channel_map(position, radio_advertise, radio_scan, success)
+
+        discovered = self.metrics["adv_success"][:, 0]
+        finished = (discovered == self.target) & ~self.retired
+        for trial in self.trial_id[finished]:
+            self.results[trial] = asn
+        ## Node 0 only counts nodes that are not done yet, and a node hearing nothing but node 0 is done once
+        ## counted. Once too few of them are left and no other node can be counted again, the trial can never
+        ## finish and is retired with the None result the slot-stepped engine returns after running out of slots.
+        undone = ~self.done[:, self.targets]
+        stuck = ((undone & ~self.single).sum(axis=1) == 0) & (discovered + (undone & self.single).sum(axis=1) < self.target)
+        self.retired |= finished | stuck
+        if self.retired.sum() >= max(1, self.compact_fraction * len(self.retired)):
+            self._compact()
+
+    def _compact(self):
+        keep = ~self.retired
+        for name in ("trial_id", "retired", "energy", "on", "ran_once", "done", "offset", "action_decided",
+                     "nScan", "next_wakeup", "action", "channel_map", "map_max", "map_best", "trace_choice", "trace_offset"):
+            setattr(self, name, getattr(self, name)[keep])
+        for _, source in self.sources:
+            source.keep(keep)
+        for key in self.metrics:
+            self.metrics[key] = self.metrics[key][keep]
+
+    def run(self):
+        """Step until every trial discovered all nodes or the slot budget is used up.
+
+        Returns:
+            list with the discovery slot of every trial, None for trials that did not finish
+        """
+        while self.slot < self.max_slots and len(self.trial_id) > 0:
+            self.step()
+            if self.retired.all():
+                break
+        self.logger.info("Batch of %s trials finished at slot %s", self.n_trials, self.slot)
+        return self.results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file", help="The name of the config file")
+    parser.add_argument("output_file", help="The file the discovery slot of every trial is written to")
+    parser.add_argument("--trials", type=int, default=1000, help="Number of trials")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the random generator")
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as stream:
+        config = yaml.load(stream, Loader=yaml.Loader)
+
+    results = BatchSimulation(config, args.trials, seed=args.seed).run()
+    with open(args.output_file, "w") as f:
+        for item in results:
+            f.write("%s\n" % item)
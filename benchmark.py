@@ -0,0 +1,302 @@
+## Benchmarks of the simulation hot paths
+## Times fixed, seeded scenarios end to end and the single calls the slot loop is made of, and writes the
+## results to a json file. Comparing the file of one commit with that of another shows regressions:
+##   python benchmark.py results_new.json --compare results_old.json
+##
+## End to end: run_simulation for 5, 50 and 500 nodes, CONSTANT, GAUSSIAN and FILE harvesting and a short and
+## a long nominal_runtime. Every scenario runs for at most --budget node-slots per trial, so large networks
+## simulate fewer slots and all scenarios take about the same time.
+## Micro: Harvester.get_energy per mode, CachedDataset.get_cached sequential and strided, Radio.subscribe for
+## every network size and Node.run_one_time_step.
+## Start-up: a fresh interpreter importing simulation, and the first task of a spawned pool worker.
+## The FILE scenarios use a synthetic hdf5 trace generated in a temporary directory.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+
+import harvester
+from clock import Clock
+from harvester import Harvester, harvestingmode, DataReader, load_energy_index
+from interface import Publisher
+from node import Node
+from radio import Radio, Medium
+from rng import RandomStream, trial_seed
+from simulation import run_simulation
+from topology import star
+
+NODES = (5, 50, 500)
+MODES = ('constant', 'gaussian', 'file')
+RUNTIMES = {'short': 100, 'long': 1000}
+TS = 1e-2
+SAMPLE_PERIOD = 1e-5
+
+## Node settings of config.yaml
+NODE = dict(alpha=0.7, capacitance=47.0e-6, von=3.0, voff=2.4, eadv=48.05e-6, escan=3.0e-6, runttype='normal')
+
+
+def slot_energy(nominal_runtime):
+    ## Energy per slot of the `default` constant power: one charge from voff to von per nominal_runtime
+    return 0.5 * NODE['capacitance'] * (NODE['von']**2 - NODE['voff']**2) / nominal_runtime
+
+
+def synthetic_trace(path, nominal_runtime, samples=300_000, seed=0):
+    """Write a power trace in the DataReader format, with the mean energy per slot of the constant scenarios."""
+    rng = np.random.default_rng(seed)
+    mean = slot_energy(nominal_runtime) / TS
+    t = np.arange(samples) * SAMPLE_PERIOD
+    power = mean * (1 + 0.5 * np.sin(2 * np.pi * t / 0.7)) * rng.lognormal(-0.125, 0.5, samples)
+    with h5py.File(path, "w") as f:
+        f.create_dataset("time", data=t)
+        f.create_dataset("data/node0", data=np.maximum(power, 0.0))
+    return path
+
+
+def scenario_config(num_nodes, mode, nominal_runtime, budget, trace=None):
+    harvester = {'harvesting_mode': mode}
+    if mode == 'constant':
+        harvester['power'] = 'default'
+    elif mode == 'gaussian':
+        harvester['std'] = 0.5
+    else:
+        harvester['file'] = trace
+    node = dict(NODE, nominal_runtime=nominal_runtime, harvester=harvester)
+    ## The slot loop stops at num_cycles * nominal_runtime, a fraction of a cycle caps it below one cycle
+    return {'num_nodes': num_nodes, 'num_cycles': budget / (num_nodes * nominal_runtime),
+            'node1': node, 'default_node': node}
+
+
+def bench_run_simulation(traces, num_nodes, mode, label, trials, budget):
+    nominal_runtime = RUNTIMES[label]
+    config = scenario_config(num_nodes, mode, nominal_runtime, budget, traces[nominal_runtime])
+    cap = int(np.ceil(config['num_cycles'] * nominal_runtime))
+
+    slots = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for trial in range(trials):
+            slot = run_simulation(config, trial_seed(0, trial))
+            slots += slot if slot is not None else cap
+    seconds = time.perf_counter() - start
+    return {'name': "run_simulation/%s/n%d/%s" % (mode, num_nodes, label), 'seconds': seconds, 'trials': trials,
+            'slots': slots, 'slots_per_s': slots / seconds, 'node_slots_per_s': slots * num_nodes / seconds}
+
+
+def _best(repeat, function):
+    ## Best of `repeat` runs of function(), which returns (seconds, calls)
+    seconds, calls = min(function() for _ in range(repeat))
+    return {'seconds': seconds, 'calls': calls, 'ns_per_call': 1e9 * seconds / calls}
+
+
+def bench_get_energy(mode, trace, calls, repeat):
+    def run():
+        clock_publisher = Publisher("clock")
+        clock = Clock(1000000, clock_publisher)
+        harvester = Harvester(getattr(harvestingmode, mode.upper()), "none", clock_publisher, rng=RandomStream(0))
+        if mode == 'constant':
+            harvester.set_constant(slot_energy(100))
+        elif mode == 'gaussian':
+            harvester.set_gaussian(slot_energy(100), 0.5 * slot_energy(100))
+        else:
+            harvester.set_file(trace, TS)
+        seconds = 0.0
+        for _ in range(calls):
+            clock.tick()
+            start = time.perf_counter()
+            harvester.get_energy()
+            seconds += time.perf_counter() - start
+        return seconds, calls
+    return dict(_best(repeat, run), name="Harvester.get_energy/%s" % mode)
+
+
+def bench_get_cached(trace, calls, repeat, stride, cache_size):
+    def run():
+        with DataReader(trace, cache_size) as reader:
+            dataset = reader[0]
+            n = len(dataset)
+            start = time.perf_counter()
+            for i in range(calls):
+                dataset.get_cached((i * stride) % n)
+            return time.perf_counter() - start, calls
+    access = "sequential" if stride == 1 else "stride%d" % stride
+    return dict(_best(repeat, run), name="CachedDataset.get_cached/%s" % access)
+
+
+def bench_subscribe(num_nodes, slots, repeat):
+    """Publish and subscribe of a star network in which every node advertises, scans or sleeps at random."""
+    actions = np.random.default_rng(0).integers(0, 3, size=(slots, num_nodes))
+
+    def run():
+        medium = Medium()
+        radios = [Radio(medium=medium) for _ in range(num_nodes)]
+        medium.use_topology(star(num_nodes))
+        seconds = 0.0
+        for asn in range(slots):
+            for i, radio in enumerate(radios):
+                if actions[asn, i] == 1:
+                    radio.advertise(asn, i)
+                elif actions[asn, i] == 2:
+                    radio.scan(asn, i)
+            for radio in radios:
+                radio.publish()
+            start = time.perf_counter()
+            radios[0].subscribe()
+            seconds += time.perf_counter() - start
+            for radio in radios:
+                radio.get_message()
+        return seconds, slots
+    return dict(_best(repeat, run), name="Radio.subscribe/n%d" % num_nodes)
+
+
+def bench_run_one_time_step(calls, repeat, period=100):
+    """One node on its own medium, with constant harvesting of the short nominal_runtime and a period of `period`
+    slots, which sets the size of its channel map."""
+    def run():
+        clock_publisher = Publisher("clock")
+        clock = Clock(1000000, clock_publisher)
+        medium = Medium()
+        radio = Radio(medium=medium)
+        rng = RandomStream(0)
+        harvester = Harvester(harvestingmode.CONSTANT, "none", clock_publisher, rng=rng)
+        harvester.set_constant(slot_energy(100))
+        node = Node(0, harvester, clock_publisher, radio, 0, NODE['alpha'], NODE['capacitance'], NODE['von'],
+                    NODE['voff'], NODE['eadv'], NODE['escan'], period, rng=rng)
+        seconds = 0.0
+        for _ in range(calls):
+            clock.tick()
+            start = time.perf_counter()
+            node.run_one_time_step()
+            seconds += time.perf_counter() - start
+            radio.publish()
+            medium.resolve()
+            node.build_channel_map()
+        return seconds, calls
+    return dict(_best(repeat, run), name="Node.run_one_time_step/period%d" % period)
+
+
+## Run by a fresh interpreter: time until a spawned pool worker has imported simulation and answered
+SPAWN_PROBE = """
+import multiprocessing, time
+if __name__ == '__main__':
+    start = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        pool.apply(exec, ('import simulation',))
+    print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(repeat):
+    """Start-up cost of a worker: a fresh interpreter importing simulation, and a spawned pool worker that
+    imports it and runs its first task."""
+    root = os.path.dirname(os.path.abspath(__file__))
+
+    def interpreter():
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import simulation"], cwd=root, check=True)
+        return time.perf_counter() - start, 1
+
+    def pool():
+        output = subprocess.run([sys.executable, "-c", SPAWN_PROBE], cwd=root, check=True, capture_output=True, text=True)
+        return float(output.stdout), 1
+    return [dict(_best(repeat, interpreter), name="startup/import simulation"),
+            dict(_best(repeat, pool), name="startup/spawn pool worker")]
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'processor': platform.processor()}
+
+
+def run_benchmarks(trials=1, budget=100_000, calls=20_000, repeat=3, match=None):
+    """Run all benchmarks whose name contains `match` and return the list of results."""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as directory:
+        traces = dict((p, synthetic_trace(os.path.join(directory, "trace%d.h5" % p), p)) for p in RUNTIMES.values())
+        ## Bin the traces into a cache of their own before timing anything
+        harvester.TRACE_CACHE = os.path.join(directory, "cache")
+        for trace in traces.values():
+            load_energy_index(trace, Ts=TS)
+
+        benchmarks = []
+        for num_nodes in NODES:
+            for mode in MODES:
+                for label in RUNTIMES:
+                    benchmarks.append(("run_simulation/%s/n%d/%s" % (mode, num_nodes, label), bench_run_simulation,
+                                       (traces, num_nodes, mode, label, trials, budget)))
+        for mode in MODES:
+            benchmarks.append(("Harvester.get_energy/%s" % mode, bench_get_energy, (mode, traces[100], calls, repeat)))
+        benchmarks.append(("CachedDataset.get_cached/sequential", bench_get_cached, (traces[100], calls, repeat, 1, 10_000)))
+        benchmarks.append(("CachedDataset.get_cached/stride997", bench_get_cached, (traces[100], calls, repeat, 997, 10_000)))
+        for num_nodes in NODES:
+            benchmarks.append(("Radio.subscribe/n%d" % num_nodes, bench_subscribe, (num_nodes, max(1, calls // num_nodes), repeat)))
+        for period in (100, 100_000):
+            benchmarks.append(("Node.run_one_time_step/period%d" % period, bench_run_one_time_step,
+                               (calls, repeat, period)))
+
+        benchmarks.append(("startup", bench_startup, (repeat,)))
+
+        for name, function, arguments in benchmarks:
+            if match is not None and match not in name:
+                continue
+            result = function(*arguments)
+            for result in (result if isinstance(result, list) else [result]):
+                print(format_result(result), flush=True)
+                results.append(result)
+    return results
+
+
+def format_result(result):
+    if 'slots_per_s' in result:
+        return "%-45s %10.0f slots/s %12.0f node-slots/s" % (result['name'], result['slots_per_s'], result['node_slots_per_s'])
+    if result['name'].startswith("startup"):
+        return "%-45s %10.1f ms" % (result['name'], 1e3 * result['seconds'])
+    return "%-45s %10.0f ns/call" % (result['name'], result['ns_per_call'])
+
+
+def compare(results, baseline):
+    """Print the speedup of every benchmark over the same benchmark in the baseline results."""
+    previous = dict((r['name'], r) for r in baseline)
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        if 'slots_per_s' in result:
+            speedup = result['slots_per_s'] / old['slots_per_s']
+        else:
+            speedup = old['ns_per_call'] / result['ns_per_call']
+        print("%-45s %6.2fx%s" % (result['name'], speedup, "  REGRESSION" if speedup < 0.9 else ""))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_file", help="The json file the results are written to")
+    parser.add_argument("--trials", type=int, default=1, help="Seeded trials per end-to-end scenario")
+    parser.add_argument("--budget", type=int, default=100_000, help="Node-slots per end-to-end trial at most")
+    parser.add_argument("--calls", type=int, default=20_000, help="Calls per micro-benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of every micro-benchmark, the best is kept")
+    parser.add_argument("--match", default=None, help="Only run the benchmarks whose name contains this string")
+    parser.add_argument("--compare", default=None, help="Results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.trials, args.budget, args.calls, args.repeat, args.match)
+    report = dict(environment(), settings=dict(trials=args.trials, budget=args.budget, calls=args.calls,
+                                                 repeat=args.repeat), results=results)
+    with open(args.output_file, "w") as f:
+        json.dump(report, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
@@ -5,7 +5,7 @@ class Estimator:
     def __init__(self) -> None:
         pass
 
-    def estimate(self, sample) -> np.int:
+    def estimate(self, sample) -> int:
         raise NotImplementedError
 
 
@@ -37,7 +37,6 @@ class Kalman_Estimator:
             self.variance = (1-self.K_n)*self.variance + self.process_noise
             self.prediction = self.prediction + self.K_n * error
 
-            print("K_n: ", self.K_n, "measurement: ", measurement, "prediction: ", self.prediction, "variance: ", self.variance, "process_noise: ", self.process_noise)
     def estimate(self):
         return self.prediction + self.variance
     
@@ -65,3 +64,95 @@ class PieceWiseEstimator:
         return self.internal_state
     
 ## Class Bonito Estimator
+
+
+## Batched estimators
+## The classes below update an array of independent streams per call, e.g. every trace dataset times every
+## estimator configuration of a backtest. Parameters are scalars or arrays with one value per stream.
+
+class RollingVariance:
+    """Variance of the last `window` samples of every stream, updated in O(1) per sample.
+
+    Matches np.std/np.var (ddof=0) over a deque(maxlen=window) of the samples.
+    """
+
+    def __init__(self, n, window=5):
+        self.window = window
+        self.buffer = np.zeros((window, n))
+        self.count = 0
+        self.sum = np.zeros(n)
+        self.sum_sq = np.zeros(n)
+
+    def update(self, samples):
+        slot = self.count % self.window
+        if self.count >= self.window:
+            old = self.buffer[slot]
+            self.sum -= old
+            self.sum_sq -= old * old
+        self.buffer[slot] = samples
+        self.sum += samples
+        self.sum_sq += samples * samples
+        self.count += 1
+        ## Recomputed from the buffer now and then, so rounding errors of the running sums do not build up
+        if self.count % (256 * self.window) == 0:
+            self.sum = self.buffer.sum(axis=0)
+            self.sum_sq = (self.buffer * self.buffer).sum(axis=0)
+
+    def var(self):
+        n = min(self.count, self.window)
+        mean = self.sum / n
+        ## Running sums can leave a tiny negative rest where the samples are all equal
+        return np.maximum(self.sum_sq / n - mean * mean, 0.0)
+
+    def std(self):
+        return np.sqrt(self.var())
+
+
+class BatchKalmanEstimator:
+    """Kalman_Estimator over n streams at once."""
+
+    def __init__(self, process_noise, n):
+        self.initialized = np.zeros(n, dtype=bool)
+        self.prediction = np.zeros(n)
+        self.variance = np.zeros(n)
+        self.K_n = np.ones(n)
+        self.process_noise = np.broadcast_to(np.asarray(process_noise, dtype=float), (n,))
+
+    def update(self, measurement, measurement_noise):
+        first = ~self.initialized
+        self.prediction = np.where(first, measurement, self.prediction)
+        self.variance = np.where(first, measurement_noise, self.variance)
+        self.initialized[:] = True
+
+        error = measurement - self.prediction
+        total = self.variance + measurement_noise
+        ## A stream without any variance yet takes the measurement
+        K_n = np.divide(self.variance, total, out=np.ones_like(total), where=total > 0)
+        self.K_n = np.where(first, self.K_n, K_n)
+        self.variance = np.where(first, self.variance, (1 - K_n) * self.variance + self.process_noise)
+        self.prediction = np.where(first, self.prediction, self.prediction + K_n * error)
+
+    def estimate(self):
+        return self.prediction + self.variance
+
+
+class BatchPieceWiseEstimator:
+    """PieceWiseEstimator over n streams at once."""
+
+    def __init__(self, decay_rate, threshold, n):
+        self.decay_rate = np.broadcast_to(np.asarray(decay_rate, dtype=float), (n,)).copy()
+        self.threshold = np.broadcast_to(np.asarray(threshold, dtype=float), (n,))
+        self.internal_state = np.zeros(n)
+
+    def update(self, sample):
+        above = sample > self.internal_state
+        ## Decay rate depends on the error relative to the state, a zero state has no error
+        error = self.internal_state - sample
+        ratio = np.divide(error, self.internal_state, out=np.zeros_like(error), where=self.internal_state != 0)
+        self.decay_rate = np.where(above, self.decay_rate, (1 - ratio) * self.decay_rate)
+        decayed = np.where(self.internal_state > (1 + self.threshold) * sample,
+                           self.decay_rate * self.internal_state, sample)
+        self.internal_state = np.where(above, sample, decayed)
+
+    def estimate(self):
+        return self.internal_state
@@ -0,0 +1,442 @@
+## Event-driven discovery simulator
+## Instead of ticking every ASN, every node schedules the next slot in which it does something that
+## matters: a decision, an advertisement, a scan, or a voltage threshold crossing (turning on, turning
+## off or resetting). A heap of these per-node events lets the simulation jump straight to the next
+## slot in which any radio is active. Harvested and sleep energy of the skipped slots is applied in bulk.
+## Within an event slot, the node runs exactly the logic of Node.run_one_time_step, Radio.publish,
+## Radio.subscribe and Node.build_channel_map, so results match the slot-stepped engine statistically.
+
+import heapq
+import logging
+import math
+import numpy as np
+import yaml
+
+from batch import node_parameters, harvest_source, RESET_VOLTAGE, ESLEEP, N_SCANS, SLEEP, ADVERTISE, SCAN
+from harvester import load_energy_index, load_traces
+from node import ChannelMap, RUN_TYPE
+from topology import topology_from_config
+
+NEVER = math.inf
+
+
+class HarvestStream:
+    """Per-slot harvested energy of one node, generated ahead in blocks.
+
+    Values that were looked at with peek() are kept until they are consumed with take(), so a quiet
+    interval can first be searched for threshold crossings and later be applied in bulk.
+
+    Args:
+        mode: 'constant', 'file' or one of the stochastic modes of batch.STOCHASTIC_MODES
+        power: energy per slot in constant mode
+        source: BlockSource of one node that generates the stochastic modes
+        index: energy index of the trace in file mode
+        position: start position in the trace in file mode
+        samples_per_slot: number of trace samples per slot in file mode
+        block_size: number of slots searched for threshold crossings at once
+    """
+
+    def __init__(self, mode, power=0.0, source=None, index=None, position=0, samples_per_slot=0, block_size=4096):
+        self.mode = mode
+        self.power = power
+        self.source = source
+        self.index = index
+        self.position = position
+        self.samples_per_slot = samples_per_slot
+        self.block_size = block_size
+
+    def peek(self, k):
+        """The next k per-slot energies, without consuming them."""
+        if self.mode == 'constant':
+            return np.full(k, self.power)
+        elif self.mode == 'file':
+            return self.index.window(self.position + self.samples_per_slot * np.arange(k), self.samples_per_slot)
+        else:
+            return self.source.peek(k)
+
+    def take(self, k):
+        """Consume the next k slots and return their total energy."""
+        if k <= 0:
+            return 0.0
+        if self.mode == 'constant':
+            return k * self.power
+        elif self.mode == 'file':
+            energy = self.index.window(self.position, k * self.samples_per_slot)
+            self.position = (self.position + k * self.samples_per_slot) % len(self.index)
+            return energy
+        else:
+            return float(np.sum(self.source.take(k)))
+
+
+class EventNode:
+    """State of one node in the event-driven simulation, with the same fields as Node."""
+
+    def __init__(self, id, params, offset, stream):
+        self.id = id
+        self.alpha = params['alpha'][id]
+        self.capacitance = params['capacitance'][id]
+        self.eadv = params['eadv'][id]
+        self.escan = params['escan'][id]
+        self.nominal_time_period = int(params['period'][id])
+        self.runtype = params['runtype'][id]
+        self.energy_on = 0.5 * self.capacitance * params['von'][id]**2
+        self.energy_off = 0.5 * self.capacitance * params['voff'][id]**2
+        self.energy_reset = 0.5 * self.capacitance * RESET_VOLTAGE**2
+        self.stream = stream
+
+        self.offset = offset
+        self.energy_level = 0.0
+        self.on = False
+        self.ran_once = False
+        self.done = False
+        self.action_decided = False
+        self.nScan = 0
+        self.next_wakeup = 0
+        self.scan_slot = None
+        self.action = SLEEP
+        self.channel_map = ChannelMap(self.nominal_time_period)
+
+        ## Energy is valid up to the end of this slot
+        self.last_slot = 0
+        self.next_event = NEVER
+        self.version = 0
+
+        self.metrics = {"adv_sent": 0, "scan_sent": 0, "adv_success": 0, "scan_success": 0, "resets": 0,
+                        "harvested": 0.0, "spent": 0.0}
+
+
+class EventSimulation:
+    """One trial of the discovery simulation, advanced from event to event.
+
+    Args:
+        config: simulation config as loaded from the yaml file
+        seed: seed of the random generator of the trial
+        Ts: slot length in seconds, used to bin file traces
+        topology: network topology, read from the config if not given
+    """
+
+    def __init__(self, config, seed=None, Ts=1e-2, topology=None, log_level=logging.INFO):
+        self.config = config
+        self.num_nodes = config['num_nodes']
+        self.params = node_parameters(config)
+        self.max_slots = config['num_cycles'] * int(self.params['period'][0])
+        self.rng = np.random.default_rng(seed)
+        self.Ts = Ts
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(log_level)
+
+        self.topology = topology if topology is not None else topology_from_config(config, self.rng)
+        ## Node 0 has discovered the network once it counted every node it hears. Nodes that hear nothing but
+        ## node 0 are counted at most once, see Topology.discovery_targets
+        targets, single = self.topology.discovery_targets(0)
+        self.target = len(targets)
+        self.undone_single = set(int(j) for j in targets[single])
+        self.undone_multiple = set(int(j) for j in targets[~single])
+
+        ## Every dataset the file harvesters may replay, read in one pass per trace file
+        load_traces([(f, d) for f, ds in zip(self.params['file'], self.params['dataset']) if f is not None for d in ds],
+                    Ts)
+        self.nodes = []
+        for i in range(self.num_nodes):
+            offset = int(self.rng.integers(0, self.params['period'][i]))
+            self.nodes.append(EventNode(i, self.params, offset, self._stream(i)))
+        self.events = []
+        self.slot = 0
+
+    def _stream(self, i):
+        p = self.params
+        mode = p['harvesting_mode'][i]
+        if mode == 'file':
+            candidates = p['dataset'][i]
+            dataset = candidates[int(self.rng.integers(0, len(candidates)))] if len(candidates) > 1 else candidates[0]
+            index = load_energy_index(p['file'][i], dataset, self.Ts)
+            position = int(self.rng.integers(0, len(index)))
+            return HarvestStream(mode, index=index, position=position, samples_per_slot=index.samples_per_slot(self.Ts))
+        if mode == 'constant':
+            return HarvestStream(mode, power=p['power'][i])
+        return HarvestStream(mode, source=harvest_source(p, mode, i, self.rng, block_size=4096))
+
+    ## Energy bookkeeping
+
+    def _gated(self, node, first, last):
+        ## Number of slots in [first, last] in which the node harvests (Node only harvests once ASN > offset)
+        return max(0, last - max(first, node.offset + 1) + 1)
+
+    def _drain(self, node):
+        return ESLEEP if node.ran_once else 0.0
+
+    def _advance(self, node, slot):
+        ## Apply harvest and sleep drain of the quiet slots between the last update and `slot` (exclusive)
+        quiet = slot - 1 - node.last_slot
+        if quiet > 0:
+            harvested = node.stream.take(self._gated(node, node.last_slot + 1, slot - 1))
+            node.metrics["harvested"] += harvested
+            node.metrics["spent"] += quiet * self._drain(node)
+            node.energy_level += harvested - quiet * self._drain(node)
+            node.last_slot = slot - 1
+
+    def _compute_energy_level(self, node, energy_in):
+        node.energy_level += energy_in
+        if node.energy_level < node.energy_reset and node.ran_once:
+            self._reset(node)
+        if node.energy_level > node.energy_on:
+            node.on = True
+        elif node.energy_level < node.energy_off:
+            node.on = False
+
+    def _reset(self, node):
+        node.metrics["resets"] += 1
+        node.channel_map.reset()
+        node.next_wakeup = 0
+        node.action = SLEEP
+        node.on = False
+        node.offset = int(self.rng.integers(0, node.nominal_time_period))
+        node.ran_once = False
+        node.action_decided = False
+
+    def _crossing(self, node, slot, horizon):
+        """First slot in (slot, horizon) in which a quiet node turns on, turns off or resets, else horizon."""
+        drain = self._drain(node)
+        if node.on:
+            down, up = node.energy_off, None
+        else:
+            down = node.energy_reset if node.ran_once else None
+            up = node.energy_on
+        if node.stream.mode == 'constant' and slot >= node.offset:
+            return self._constant_crossing(node, slot, horizon, drain, down, up)
+
+        energy = node.energy_level
+        first = slot + 1
+        used = 0
+        while first < horizon:
+            last = int(min(horizon - 1, first + node.stream.block_size - 1))
+            slots = np.arange(first, last + 1)
+            harvest = np.zeros(len(slots))
+            gate = slots > node.offset
+            n = int(gate.sum())
+            harvest[gate] = node.stream.peek(used + n)[used:]
+            used += n
+            after_drain = energy + np.cumsum(harvest - drain)
+            after_harvest = after_drain + drain
+            hit = np.zeros(len(slots), dtype=bool)
+            if down is not None:
+                hit |= after_drain < down
+            if up is not None:
+                hit |= after_harvest > up
+            if hit.any():
+                return first + int(np.argmax(hit))
+            energy = after_drain[-1]
+            first = last + 1
+        return horizon
+
+    def _constant_crossing(self, node, slot, horizon, drain, down, up):
+        energy = node.energy_level
+        power = node.stream.power
+        net = power - drain
+        k = NEVER
+        if down is not None and net < 0:
+            k = min(k, math.floor((energy - down) / -net) + 1)
+        if up is not None:
+            if energy + power > up:
+                k = 1
+            elif net > 0:
+                k = min(k, math.floor((up - energy - power) / net) + 2)
+        return min(horizon, slot + k)
+
+    ## Slot logic for nodes with an event
+
+    def _harvest_slot(self, node, slot):
+        self._advance(node, slot)
+        if slot > node.offset:
+            energy = node.stream.take(1)
+            node.metrics["harvested"] += energy
+            self._compute_energy_level(node, energy)
+
+    def _decide(self, node, slot):
+        ## Node.run_one_time_step, returns the action of the radio
+        node.action = SLEEP
+        if node.done or not node.on:
+            return SLEEP
+        node.ran_once = True
+        if node.runtype == RUN_TYPE.ADVERTISING.value:
+            node.action = ADVERTISE
+            node.metrics["adv_sent"] += 1
+            return ADVERTISE
+        if node.runtype == RUN_TYPE.SCANNING.value:
+            node.action = SCAN
+            return SLEEP
+
+        period = node.nominal_time_period
+        position = slot % period
+        if not node.action_decided:
+            if self.rng.random() < node.alpha:
+                node.action = ADVERTISE
+                node.nScan = 0
+            else:
+                node.nScan = N_SCANS
+            node.action_decided = True
+
+        if node.action == ADVERTISE:
+            node.action = SLEEP
+            if node.channel_map.any():
+                best = node.channel_map.best
+                if position > best:
+                    node.next_wakeup = slot + period - position + best
+                else:
+                    node.next_wakeup = slot + best - position
+            elif position > node.offset:
+                node.next_wakeup = slot + period - position + node.offset
+            elif position == node.offset:
+                node.action = ADVERTISE
+                node.metrics["adv_sent"] += 1
+                node.action_decided = False
+                node.next_wakeup = slot + period
+            else:
+                node.next_wakeup = slot + node.offset - position
+
+        if slot == node.next_wakeup:
+            node.action = ADVERTISE
+            node.metrics["adv_sent"] += 1
+            node.action_decided = False
+
+        if node.nScan > 0:
+            ## A scheduled scan slot already decided the per-slot draws up to it, all earlier ones failed
+            if node.scan_slot is None:
+                scan = self.rng.random() < N_SCANS / period
+            else:
+                scan = slot == node.scan_slot
+            if scan:
+                node.action = SCAN
+                node.nScan -= 1
+                if node.nScan == 0:
+                    node.action_decided = False
+                node.metrics["scan_sent"] += 1
+            else:
+                node.action = SLEEP
+        return node.action
+
+    def _build_channel_map(self, node, slot, radio, success):
+        if success and node.on:
+            position = slot % node.nominal_time_period
+            if radio == ADVERTISE:
+                if node.id == 0:
+                    node.channel_map.clear(position)
+                    node.offset = int(self.rng.integers(0, node.nominal_time_period))
+                else:
+                    node.done = True
+                    self.undone_single.discard(node.id)
+                    self.undone_multiple.discard(node.id)
+                node.metrics["adv_success"] += 1
+            elif radio == SCAN:
+                node.metrics["scan_success"] += 1
+                node.channel_map.add(position)
+
+        if node.action == ADVERTISE:
+            node.metrics["spent"] += node.eadv
+            self._compute_energy_level(node, -node.eadv)
+        elif node.action == SCAN:
+            node.metrics["spent"] += node.escan
+            self._compute_energy_level(node, -node.escan)
+        elif node.ran_once:
+            node.metrics["spent"] += ESLEEP
+            self._compute_energy_level(node, -ESLEEP)
+        node.last_slot = slot
+
+    ## Scheduling
+
+    def _next_event(self, node, slot):
+        """Slot of the next event of a node whose state is valid at the end of `slot`."""
+        node.scan_slot = None
+        if node.done:
+            return NEVER
+        horizon = self.max_slots + 1
+        if node.on:
+            if node.runtype != RUN_TYPE.NORMAL.value or not node.action_decided:
+                return slot + 1
+            if node.next_wakeup > slot:
+                horizon = node.next_wakeup
+            if node.nScan > 0:
+                node.scan_slot = slot + int(self.rng.geometric(N_SCANS / node.nominal_time_period))
+                horizon = min(horizon, node.scan_slot)
+        event = self._crossing(node, slot, horizon)
+        return NEVER if event > self.max_slots else event
+
+    def _schedule(self, node, slot):
+        node.version += 1
+        node.next_event = self._next_event(node, slot)
+        if node.next_event != NEVER:
+            heapq.heappush(self.events, (node.next_event, node.id, node.version))
+
+    def run(self):
+        """Run the trial until node 0 discovered all other nodes.
+
+        Returns:
+            the discovery slot, or None if the slot budget ran out first
+        """
+        for node in self.nodes:
+            self._schedule(node, 0)
+
+        while self.events:
+            slot = self.events[0][0]
+            if slot > self.max_slots:
+                break
+            active = []
+            while self.events and self.events[0][0] == slot:
+                _, i, version = heapq.heappop(self.events)
+                if version == self.nodes[i].version:
+                    active.append(self.nodes[i])
+            if not active:
+                continue
+            self.slot = slot
+
+            radios = {}
+            for node in active:
+                self._harvest_slot(node, slot)
+                radios[node.id] = self._decide(node, slot)
+
+            ## Radio.publish/subscribe: an advertiser succeeds if exactly one neighbour advertised,
+            ## a scanner succeeds if at least one neighbour advertised
+            heard = dict.fromkeys(radios, 0)
+            for i, radio in radios.items():
+                if radio == ADVERTISE:
+                    for j in self.topology.listeners(i).tolist():
+                        if j in heard:
+                            heard[j] += 1
+
+            for node in active:
+                radio = radios[node.id]
+                success = (radio == ADVERTISE and heard[node.id] == 1) or (radio == SCAN and heard[node.id] >= 1)
+                self._build_channel_map(node, slot, radio, success)
+                self._schedule(node, slot)
+
+            discovered = self.nodes[0].metrics['adv_success']
+            if discovered == self.target:
+                self.logger.info("Node discovered all other nodes at ASN: %s", slot)
+                return slot
+            ## Nodes that were done without being counted by node 0 can never be discovered
+            if not self.undone_multiple and discovered + len(self.undone_single) < self.target:
+                return None
+        return None
+
+    def node_metrics(self):
+        """Metrics and energy level of every node, one dict per node as collected by run_simulation. The energy
+        of a node is accounted up to its last event."""
+        return [dict(node.metrics, energy=node.energy_level) for node in self.nodes]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file", help="The name of the config file")
+    parser.add_argument("output_file", help="The file the discovery slot of every trial is written to")
+    parser.add_argument("--trials", type=int, default=1000, help="Number of trials")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the first trial")
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as stream:
+        config = yaml.load(stream, Loader=yaml.Loader)
+
+    seeds = np.random.SeedSequence(args.seed).spawn(args.trials)
+    with open(args.output_file, "w") as f:
+        for seed in seeds:
+            f.write("%s\n" % EventSimulation(config, seed=seed).run())
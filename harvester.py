@@ -2,23 +2,69 @@
 ## It can also do that with a input file for the energy harvested per clock tick.
 
 import numpy as np
-import random
 from enum import Enum
-import math
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from interface import Subscriber
+from rng import RandomStream
 
-from platform import node
-import pandas as pd
-import numpy as np
-import h5py
+import bisect
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+
+## h5py is only imported once a trace file is opened, so runs without file harvesting and pool workers that
+## memory-map shared traces do not load it
+
+class BlockCache(object):
+    """Least recently used blocks of the CachedDatasets of one DataReader, up to memory_budget bytes in total.
+
+    Blocks being read ahead count against the budget as well. The most recently used block is never evicted, so
+    at least one block is held whatever the budget.
+
+    Args:
+        memory_budget: bytes of blocks held in memory
+    """
+
+    def __init__(self, memory_budget=64_000_000):
+        self.memory_budget = memory_budget
+        self.nbytes = 0
+        ## Bytes of the blocks being read ahead
+        self.reserved = 0
+        self._blocks = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._blocks
 
-from multiprocessing import Pool
-from multiprocessing import cpu_count
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key):
+        self._blocks.move_to_end(key)
+        return self._blocks[key]
+
+    def put(self, key, block):
+        self._blocks[key] = block
+        self.nbytes += block.nbytes
+        self.evict()
+
+    def evict(self, nbytes=0):
+        """Drop the least recently used blocks until nbytes more fit in the budget."""
+        while len(self._blocks) > 1 and self.nbytes + self.reserved + nbytes > self.memory_budget:
+            (owner, block), data = self._blocks.popitem(last=False)
+            self.nbytes -= data.nbytes
+            owner._evicted(block)
+
+    def discard(self, owner):
+        """Drop the blocks of one dataset."""
+        for key in [key for key in self._blocks if key[0] is owner]:
+            self.nbytes -= self._blocks.pop(key).nbytes
 
-import sys
-import warnings
 
 # Taken from Bonito
 class CachedDataset(object):
@@ -27,32 +73,95 @@ class CachedDataset(object):
     hdf5 loads data 'lazily', i.e. only loads data into memory that is explicitly indexed. This incurs high
     delays when accessing single values successively. Chunk caching should improve this, but we couldn't observe
     a gain. Instead, this class implements a simple cached dataset, where data is read into memory in blocks
-    and single index access reads from that cache.
+    and single index access reads from that cache. Contiguous slices are assembled from the same blocks.
+
+    The blocks are held in a BlockCache, which the datasets of a DataReader share so that the budget covers
+    all of them. When the blocks are consumed in order and the budget holds at least two blocks, a background
+    thread reads the next block while the current one is in use. The block being read counts against the
+    budget, and is dropped when the access moves elsewhere.
 
     Args:
         dataset: underlying hdf5 dataset
-        cache_size: number of values to be held in memory
+        cache_size: number of values per block, rounded up to whole hdf5 chunks
+        memory_budget: bytes of blocks held in memory, if no cache is given
+        read_ahead: read the next block in the background during sequential access
+        cache: BlockCache shared with other datasets
     """
 
-    def __init__(self, dataset: h5py.Dataset, cache_size: int = 10_000_000):
+    def __init__(self, dataset: "h5py.Dataset", cache_size: int = 1_000_000, memory_budget: int = 64_000_000,
+                 read_ahead: bool = True, cache: BlockCache = None):
         self._ds = dataset
         self._istart = 0
         self._iend = -1
-        self._cache_size = cache_size
+        self._block = None
+        self._buf = None
+        ## Whole chunks per block, so no chunk is read twice
+        chunks = dataset.chunks
+        self._cache_size = -(-cache_size // chunks[0]) * chunks[0] if chunks else cache_size
+        self._block_bytes = self._cache_size * dataset.dtype.itemsize
+        self._cache = cache if cache is not None else BlockCache(memory_budget)
+        self._read_ahead = read_ahead
+        self._executor = None
+        self._pending = dict()
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            return self._ds[key]
+            return self.get_slice(key)
         elif isinstance(key, int):
             return self.get_cached(key)
 
     def __len__(self):
         return len(self._ds)
 
+    @property
+    def chunks(self):
+        ## The blocks are whole chunks and the current one stays cached, so reads need no alignment to read every
+        ## chunk once
+        return None
+
+    def _read(self, block):
+        start = block * self._cache_size
+        return self._ds[start : min(len(self._ds), start + self._cache_size)]
+
+    def _evicted(self, block):
+        ## Called by the cache, the current buffer must not outlive its block
+        if block == self._block:
+            self._buf = None
+            self._istart, self._iend = 0, -1
+
+    def _prefetch(self, block):
+        if block * self._cache_size >= len(self._ds) or (self, block) in self._cache or block in self._pending:
+            return
+        ## Room for the block being read, the current block is the most recently used one and stays
+        self._cache.evict(self._block_bytes)
+        self._cache.reserved += self._block_bytes
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="read_ahead")
+        self._pending[block] = self._executor.submit(self._read, block)
+
+    def _take_pending(self, block):
+        pending = self._pending.pop(block, None)
+        if pending is not None:
+            self._cache.reserved -= self._block_bytes
+        return pending
+
     def update_cache(self, idx):
-        self._istart = (idx // self._cache_size) * self._cache_size
-        self._iend = min(len(self._ds), self._istart + self._cache_size)
-        self._buf = self._ds[self._istart : self._iend]
+        block = idx // self._cache_size
+        previous, self._block = self._block, block
+        ## Blocks read ahead for another position are not going to be used
+        for stale in [b for b in self._pending if b != block]:
+            self._take_pending(stale).cancel()
+        if (self, block) in self._cache:
+            self._buf = self._cache.get((self, block))
+        else:
+            pending = self._take_pending(block)
+            self._buf = pending.result() if pending is not None else self._read(block)
+            self._cache.put((self, block), self._buf)
+        if (self._read_ahead and self._cache.memory_budget >= 2 * self._block_bytes and previous is not None
+                and block == previous + 1):
+            self._prefetch(block + 1)
+        self._istart = block * self._cache_size
+        self._iend = self._istart + len(self._buf)
 
     def get_cached(self, idx):
         if idx >= self._istart and idx < self._iend:
@@ -61,39 +170,71 @@ class CachedDataset(object):
             self.update_cache(idx)
             return self.get_cached(idx)
 
+    def get_slice(self, key):
+        start, stop, step = key.indices(len(self))
+        if step != 1 or start >= stop:
+            return self._ds[key]
+        parts = []
+        while start < stop:
+            if not self._istart <= start < self._iend:
+                self.update_cache(start)
+            end = min(stop, self._iend)
+            parts.append(self._buf[start - self._istart:end - self._istart])
+            start = end
+        return np.concatenate(parts) if len(parts) > 1 else parts[0].copy()
+
+    def close(self):
+        """Wait for a running read-ahead and drop the cached blocks."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for block in list(self._pending):
+            self._take_pending(block)
+        self._cache.discard(self)
+        self._buf = None
+        self._istart, self._iend = 0, -1
+
 
 class DataReader(object):
-    """Convenient and cached access to an hdf5 database with power traces from multiple nodes."""
+    """Convenient and cached access to an hdf5 database with power traces from multiple nodes.
 
-    def __init__(self, path, cache_size=10_000_000):
+    Args:
+        path: hdf5 trace file
+        cache_size: number of values per cached block of every dataset
+        memory_budget: bytes of cached blocks held in total, shared by all datasets of the file
+        read_ahead: read the next block of a dataset in the background during sequential access
+    """
+
+    def __init__(self, path, cache_size=1_000_000, memory_budget=64_000_000, read_ahead=True):
         self.path = path
         self.cache_size = cache_size
+        self.memory_budget = memory_budget
+        self.read_ahead = read_ahead
+        self.cache = BlockCache(memory_budget)
         self._datasets = dict()
 
     def __enter__(self):
-        self._hf = h5py.File(self.path, "r")
-        self.nodes = list(self._hf["data"].keys())
-
-        self.time = self._hf["time"]
-        for node in self._hf["data"].keys():
-            self._datasets[node] = CachedDataset(self._hf["data"][node], self.cache_size)
-
-        return self
+        return self.open()
 
     def open(self):
+        import h5py
         self._hf = h5py.File(self.path, "r")
         self.nodes = list(self._hf["data"].keys())
 
         self.time = self._hf["time"]
         for node in self._hf["data"].keys():
-            self._datasets[node] = CachedDataset(self._hf["data"][node], self.cache_size)
+            self._datasets[node] = CachedDataset(self._hf["data"][node], self.cache_size, self.memory_budget,
+                                                 self.read_ahead, self.cache)
 
         return self
     
     def __exit__(self, *exc):
-        self._hf.close()
+        self.close()
 
     def close(self):
+        ## Background reads have to finish before the file is closed
+        for dataset in self._datasets.values():
+            dataset.close()
         self._hf.close()
     
     def __getitem__(self, key):
@@ -107,14 +248,472 @@ class DataReader(object):
         return len(self.time)      
 
 
+class EnergyIndex(object):
+    """Cumulative energy of a power trace, for O(1) access to the energy of any window.
+
+    The index is built once per trace. The energy harvested over any window, including windows that wrap
+    around the end of the trace, is then two lookups and a subtraction, for any slot length.
+
+    Args:
+        data: power samples of the trace
+        sample_period: time between two samples in seconds
+    """
+
+    def __init__(self, data, sample_period: float = 1e-5):
+        self.sample_period = sample_period
+        self.cumulative = np.zeros(len(data) + 1)
+        np.cumsum(np.asarray(data, dtype=np.float64) * sample_period, out=self.cumulative[1:])
+        self.total = self.cumulative[-1]
+
+    @classmethod
+    def from_cumulative(cls, cumulative, sample_period: float = 1e-5):
+        """Wrap an existing cumulative energy array, e.g. a read-only memory map, without copying it."""
+        index = cls.__new__(cls)
+        index.sample_period = sample_period
+        index.cumulative = cumulative
+        index.total = cumulative[-1]
+        return index
+
+    @classmethod
+    def from_slot_energy(cls, energy, Ts):
+        """Index of a trace binned into slots: every sample is the energy of one slot of length Ts."""
+        cumulative = np.zeros(len(energy) + 1)
+        np.cumsum(energy, dtype=np.float64, out=cumulative[1:])
+        return cls.from_cumulative(cumulative, Ts)
+
+    def __len__(self):
+        return len(self.cumulative) - 1
+
+    def samples_per_slot(self, Ts):
+        return int(round(Ts / self.sample_period))
+
+    def window(self, offset, length):
+        """Energy of `length` samples starting at `offset`. Works on scalars and arrays of offsets."""
+        n = len(self)
+        full, rest = np.divmod(length, n)
+        start = np.mod(offset, n)
+        end = start + rest
+        if np.ndim(end) == 0:
+            energy = full * self.total + self.cumulative[min(end, n)] - self.cumulative[start]
+            if end > n:
+                energy += self.cumulative[end - n]
+            return float(energy)
+        wrapped = end > n
+        energy = full * self.total + self.cumulative[np.minimum(end, n)] - self.cumulative[start]
+        return energy + np.where(wrapped, self.cumulative[np.where(wrapped, end - n, 0)], 0.0)
+
+    def slot_energy(self, offset, Ts):
+        return self.window(offset, self.samples_per_slot(Ts))
+
+
+## Pre-binned slot energies of trace datasets, reused by every later run. Override with BFND_TRACE_CACHE.
+TRACE_CACHE = os.environ.get("BFND_TRACE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "bfnd", "traces"))
+
+
+def _file_digest(path, cache_dir):
+    ## sha256 of the trace file, remembered by path, size and mtime so unchanged files are hashed only once
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    digests_file = os.path.join(cache_dir, "digests.json")
+    try:
+        with open(digests_file) as f:
+            digests = json.load(f)
+    except (OSError, ValueError):
+        digests = dict()
+    entry = digests.get(key)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    digests[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha.hexdigest()}
+    tmp = digests_file + ".%d.tmp" % os.getpid()
+    with open(tmp, "w") as f:
+        json.dump(digests, f, indent=1)
+    os.replace(tmp, digests_file)
+    return sha.hexdigest()
+
+
+def bin_trace(dataset, Ts, sample_period: float = 1e-5, block_slots: int = 10_000):
+    """Energy harvested in every full slot of length Ts of a power trace, as float32.
+
+    The trace is read in blocks of about block_slots slots, rounded to whole hdf5 chunks when the dataset is
+    chunked, so it is never held in memory as a whole and no chunk is read twice. A CachedDataset reads whole
+    chunks itself, and reads ahead in the background while a block is binned. Samples past the last full slot
+    are dropped.
+
+    Args:
+        dataset: power samples of the trace, e.g. a CachedDataset of a DataReader
+        Ts: slot length in seconds
+        sample_period: time between two samples in seconds
+        block_slots: number of slots read at once
+    """
+    samples = int(round(Ts / sample_period))
+    slots = len(dataset) // samples
+    chunks = getattr(dataset, "chunks", None)
+    step = math.lcm(samples, chunks[0]) if chunks else samples
+    block = max(1, block_slots * samples // step) * step // samples
+    energy = np.empty(slots, dtype=np.float32)
+    for start in range(0, slots, block):
+        stop = min(slots, start + block)
+        data = np.asarray(dataset[start * samples:stop * samples], dtype=np.float64)
+        energy[start:stop] = data.reshape(stop - start, samples).sum(axis=1) * sample_period
+    return energy
+
+
+def dataset_name(node):
+    ## Datasets of a trace file are named node<i>, a number i selects node<i>
+    return node if isinstance(node, str) else f"node{node}"
+
+
+## Datasets of the trace files opened in this process
+_file_datasets = dict()
+
+
+def trace_datasets(path, dataset=None):
+    """Candidate datasets of a file harvester, one of which is drawn for every trial.
+
+    Args:
+        path: hdf5 trace file
+        dataset: `dataset` entry of the harvester config: a dataset name or node number, a list of them, or
+            "random" for every dataset of the file. Defaults to node0.
+    """
+    if dataset is None:
+        return ["node0"]
+    if dataset == "random":
+        if path not in _file_datasets:
+            with DataReader(path) as reader:
+                _file_datasets[path] = list(reader.nodes)
+        return list(_file_datasets[path])
+    if isinstance(dataset, (list, tuple)):
+        return [dataset_name(d) for d in dataset]
+    return [dataset_name(dataset)]
+
+
+def cached_slot_energies(path, datasets, Ts=1e-2, cache_dir=None):
+    """Per-slot energy of datasets of an hdf5 trace file, memory-mapped from the trace cache.
+
+    Datasets requested for the first time are binned with bin_trace, all in one pass over one open file, and
+    stored as .npy files named after the sha256 of the trace file, the dataset and Ts. Later requests, also from
+    other runs, only map those files.
+
+    Returns:
+        dict from dataset name to its slot energies
+    """
+    cache_dir = cache_dir if cache_dir is not None else TRACE_CACHE
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = _file_digest(path, cache_dir)[:16]
+    files = dict((d, os.path.join(cache_dir, "%s_%s_%r.npy" % (digest, d, Ts))) for d in map(dataset_name, datasets))
+    missing = [d for d, npy in files.items() if not os.path.exists(npy)]
+    if missing:
+        with DataReader(path) as reader:
+            for d in missing:
+                energy = bin_trace(reader[d], Ts)
+                ## Written under a temporary name first, so concurrent runs never map a partial file
+                tmp = files[d][:-len(".npy")] + ".%d.tmp.npy" % os.getpid()
+                np.save(tmp, energy)
+                os.replace(tmp, files[d])
+    return dict((d, np.load(npy, mmap_mode="r")) for d, npy in files.items())
+
+
+def cached_slot_energy(path, node=0, Ts=1e-2, cache_dir=None):
+    """Per-slot energy of one node of an hdf5 trace file, see cached_slot_energies."""
+    return cached_slot_energies(path, [node], Ts, cache_dir)[dataset_name(node)]
+
+
+## Energy indices built in this process, keyed by trace file, dataset and slot length
+_energy_indices = dict()
+
+
+def load_energy_indices(path, datasets, Ts):
+    """Slot energy indices of datasets of an hdf5 trace file, binning the ones not cached yet in one pass."""
+    datasets = [dataset_name(d) for d in datasets]
+    missing = [d for d in datasets if (path, d, Ts) not in _energy_indices]
+    if missing:
+        for d, energy in cached_slot_energies(path, missing, Ts).items():
+            _energy_indices[(path, d, Ts)] = EnergyIndex.from_slot_energy(energy, Ts)
+    return [_energy_indices[(path, d, Ts)] for d in datasets]
+
+
+def load_traces(traces, Ts):
+    """Slot energy indices of (trace file, dataset) pairs, read in one pass per trace file."""
+    by_file = dict()
+    for path, dataset in traces:
+        by_file.setdefault(path, set()).add(dataset_name(dataset))
+    for path, datasets in sorted(by_file.items()):
+        load_energy_indices(path, sorted(datasets), Ts)
+    return [load_energy_index(path, dataset, Ts) for path, dataset in traces]
+
+
+def load_energy_index(path, node=0, Ts=None):
+    """Energy index of one node of an hdf5 trace file, read only the first time it is requested.
+
+    With a slot length Ts the index is built from the pre-binned slot energies of the trace cache, so every index
+    sample is one slot (samples_per_slot(Ts) == 1). Without Ts it holds every raw sample of the trace.
+    """
+    if Ts is not None:
+        return load_energy_indices(path, [node], Ts)[0]
+    key = (path, dataset_name(node), Ts)
+    if key not in _energy_indices:
+        with DataReader(path) as reader:
+            _energy_indices[key] = EnergyIndex(reader[dataset_name(node)][:])
+    return _energy_indices[key]
+
+
+class SharedTraces(object):
+    """Slot energy indices of trace files, built once by the parent process and shared read-only with pool workers.
+
+    Each index is written to a .npy file in a temporary directory, which the parent and the workers memory-map
+    instead of opening the hdf5 file and holding a private copy of the trace. The directory is removed on exit.
+    The dataset lists of the files that the parent looked up for "random" harvesters are handed to the workers
+    as well, so trace_datasets does not open the file in every worker.
+
+    Usage:
+        with SharedTraces(traces) as shared:
+            pool = Pool(initializer=attach_shared_traces, initargs=(shared.handles, shared.datasets))
+
+    Args:
+        traces: (hdf5 trace file, dataset) pairs used by the simulation, a plain path stands for its node0
+        directory: where the temporary directory is created, defaults to the system temp directory
+        Ts: slot length in seconds the traces are binned to
+    """
+
+    def __init__(self, traces, directory=None, Ts=1e-2):
+        self.traces = sorted(set((t, "node0") if isinstance(t, str) else (t[0], dataset_name(t[1])) for t in traces))
+        self.directory = directory
+        self.Ts = Ts
+        self.handles = dict()
+        self.datasets = dict()
+
+    def __enter__(self):
+        self._dir = tempfile.mkdtemp(prefix="traces_", dir=self.directory)
+        for i, ((path, dataset), index) in enumerate(zip(self.traces, load_traces(self.traces, self.Ts))):
+            npy = os.path.join(self._dir, "trace%d.npy" % i)
+            np.save(npy, index.cumulative)
+            self.handles[(path, dataset, self.Ts)] = (npy, index.sample_period)
+        for path in set(path for path, _ in self.traces):
+            if path in _file_datasets:
+                self.datasets[path] = list(_file_datasets[path])
+        attach_shared_traces(self.handles)
+        return self
+
+    def __exit__(self, *exc):
+        for key in self.handles:
+            _energy_indices.pop(key, None)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def attach_shared_traces(handles, datasets=None):
+    """Pool initializer: memory-map the energy indices shared by the parent, so set_file never reads the trace.
+
+    Args:
+        handles: SharedTraces.handles
+        datasets: SharedTraces.datasets, the datasets of every trace file as listed by the parent
+    """
+    if datasets is not None:
+        _file_datasets.update(datasets)
+    for key, (npy, sample_period) in handles.items():
+        _energy_indices[key] = EnergyIndex.from_cumulative(np.load(npy, mmap_mode="r"), sample_period)
+
+
+## Stochastic harvesting modes
+## Every mode generates its per-slot energies in vectorized blocks of shape (slots,) + shape, for one node
+## (shape ()) or a batch of nodes and trials, e.g. (trials, nodes). Parameters broadcast against shape.
+
+class BlockSource(object):
+    """Per-slot energy of a stochastic harvesting mode, generated ahead in blocks.
+
+    peek(k) looks at the next k slots without consuming them, take(k) consumes them, next() hands out single
+    slots of a source of one node.
+
+    Args:
+        generator: numpy random Generator
+        shape: shape of one slot of energies
+        block_size: number of slots generated at once
+    """
+
+    def __init__(self, generator, shape=(), block_size=1024):
+        self.generator = generator
+        self.shape = tuple(shape)
+        self.block_size = block_size
+        self._buf = np.zeros((0,) + self.shape)
+        self._head = 0
+        self._list = []
+
+    def _generate(self, k):
+        ## Energies of the next k slots, shape (k,) + shape
+        raise NotImplementedError
+
+    def peek(self, k):
+        if self._list:
+            ## Values not handed out by next() yet go back in front of the block, in order
+            pending = np.array(self._list[::-1]).reshape((-1,) + self.shape)
+            self._buf = np.concatenate((pending, self._buf[self._head:]))
+            self._head = 0
+            self._list = []
+        available = len(self._buf) - self._head
+        if available < k:
+            block = self._generate(max(self.block_size, k - available))
+            self._buf = np.concatenate((self._buf[self._head:], block))
+            self._head = 0
+        return self._buf[self._head:self._head + k]
+
+    def take(self, k):
+        energy = self.peek(k)
+        self._head += k
+        return energy
+
+    def next(self):
+        if not self._list:
+            ## Values that were peeked at come first. Reversed so that pop() hands them out in order
+            block = self._buf[self._head:] if self._head < len(self._buf) else self._generate(self.block_size)
+            self._buf = self._buf[:0]
+            self._head = 0
+            self._list = block[::-1].tolist()
+        return self._list.pop()
+
+    def reseed(self, generator):
+        """Draw from another generator from now on, e.g. in a fork of a simulation. Slots generated already are
+        kept, so the harvest stays continuous for up to one block."""
+        self.generator = generator
+
+    def restart(self, generator):
+        """A source with the same parameters that starts afresh from generator, e.g. in a fork of a simulation
+        for a node that has not harvested yet."""
+        return type(self)(generator, *(getattr(self, name) for name in self._params), self.shape, self.block_size)
+
+    def keep(self, rows):
+        """Keep the rows of the first axis of shape, e.g. the trials still running of a batch."""
+        self._buf = self._buf[self._head:, rows]
+        self._head = 0
+        self.shape = self._buf.shape[1:]
+        for name in self._state:
+            setattr(self, name, getattr(self, name)[rows])
+
+    ## Per-row arrays of the source, cut down by keep()
+    _state = ()
+    ## Arguments of the constructor after the generator, see restart()
+    _params = ()
+
+
+class GaussianSource(BlockSource):
+    """normal(mean, std) clipped at zero."""
+
+    _state = ('mean', 'std')
+    _params = ('mean', 'std')
+
+    def __init__(self, generator, mean, std, shape=(), block_size=1024):
+        super().__init__(generator, shape, block_size)
+        self.mean = np.broadcast_to(mean, self.shape).copy()
+        self.std = np.broadcast_to(std, self.shape).copy()
+
+    def _generate(self, k):
+        return np.maximum(self.generator.normal(self.mean, self.std, size=(k,) + self.shape), 0.0)
+
+
+class LogNormalSource(GaussianSource):
+    """Log-normal energy with the given mean, sigma is the standard deviation of its logarithm."""
+
+    def _generate(self, k):
+        with np.errstate(divide='ignore'):
+            mu = np.log(self.mean) - self.std**2 / 2
+        return np.exp(mu + self.std * self.generator.standard_normal(size=(k,) + self.shape))
+
+
+class OnOffSource(BlockSource):
+    """Markov-modulated on/off harvesting: power while on, nothing while off.
+
+    The on and off periods are geometric with the given mean lengths in slots, and the source starts in the
+    stationary state. Periods are drawn a fixed number at a time and queued, so a source of one node generates
+    the same slots for any sequence of block sizes.
+    """
+
+    _state = ('power', 'mean_on', 'mean_off', 'on', 'left', 'queue')
+    _params = ('power', 'mean_on', 'mean_off')
+
+    ## Periods drawn at a time
+    RUNS = 32
+
+    def __init__(self, generator, power, mean_on, mean_off, shape=(), block_size=1024):
+        super().__init__(generator, shape, block_size)
+        self.power = np.broadcast_to(power, self.shape).astype(float)
+        self.mean_on = np.broadcast_to(mean_on, self.shape).astype(float)
+        self.mean_off = np.broadcast_to(mean_off, self.shape).astype(float)
+        self.on = np.asarray(generator.random(self.shape) < self.mean_on / (self.mean_on + self.mean_off))
+        ## Slots left in the current period, and the lengths of the periods drawn after it
+        self.left = np.asarray(generator.geometric(1 / np.where(self.on, self.mean_on, self.mean_off)))
+        self.queue = np.empty(self.shape, dtype=object)
+        for i in np.ndindex(self.shape):
+            self.queue[i] = np.zeros(0, dtype=np.int64)
+
+    def _generate(self, k):
+        on, left = self.on.reshape(-1).copy(), self.left.reshape(-1).copy()
+        queue = self.queue.reshape(-1).copy()
+        mean_on, mean_off = self.mean_on.reshape(-1), self.mean_off.reshape(-1)
+        out = np.empty((len(on), k), dtype=bool)
+        for i in range(len(on)):
+            ## Periods alternate between on and off, starting with the current one, until they run past the block
+            lengths, total = [np.array([left[i]])], int(left[i])
+            count = 1
+            while total <= k:
+                if len(queue[i]) == 0:
+                    state = (np.arange(self.RUNS) % 2 == 1) != (on[i] ^ (count % 2 == 1))
+                    queue[i] = self.generator.geometric(1 / np.where(state, mean_on[i], mean_off[i]))
+                used = min(len(queue[i]), int(np.searchsorted(np.cumsum(queue[i]), k - total, side='right')) + 1)
+                lengths.append(queue[i][:used])
+                total += int(queue[i][:used].sum())
+                queue[i] = queue[i][used:]
+                count += used
+            lengths = np.concatenate(lengths)
+            states = (np.arange(count) % 2 == 1) != on[i]
+            out[i] = np.repeat(states, lengths)[:k]
+            ## The last period runs past slot k and carries over to the next block
+            on[i], left[i] = states[-1], total - k
+        self.on, self.left, self.queue = on.reshape(self.shape), left.reshape(self.shape), queue.reshape(self.shape)
+        return np.where(out.T.reshape((k,) + self.shape), self.power, 0.0)
+
+
+class DiurnalSource(BlockSource):
+    """Half-wave rectified sine with a period of `day` slots, times log-normal noise of mean one.
+
+    The peak is pi times the mean, so a whole day harvests mean energy per slot on average. Every row starts at
+    a random time of the day.
+    """
+
+    _state = ('mean', 'day', 'noise', 'time')
+    _params = ('mean', 'day', 'noise')
+
+    def __init__(self, generator, mean, day, noise=0.0, shape=(), block_size=1024):
+        super().__init__(generator, shape, block_size)
+        self.mean = np.broadcast_to(mean, self.shape).astype(float)
+        self.day = np.broadcast_to(day, self.shape).astype(float)
+        self.noise = np.broadcast_to(noise, self.shape).astype(float)
+        self.time = np.asarray(generator.random(self.shape) * self.day)
+
+    def _generate(self, k):
+        t = self.time + np.arange(k).reshape((k,) + (1,) * len(self.shape))
+        self.time = (self.time + k) % self.day
+        sun = np.pi * self.mean * np.maximum(np.sin(2 * np.pi * t / self.day), 0.0)
+        if not self.noise.any():
+            return sun
+        z = self.generator.standard_normal(size=(k,) + self.shape)
+        return sun * np.exp(self.noise * z - self.noise**2 / 2)
+
+
 class harvestingmode(Enum):
     CONSTANT = 0
     GAUSSIAN =1
     FILE = 2
+    ONOFF = 3
+    LOGNORMAL = 4
+    DIURNAL = 5
 
 class Harvester:
-    def __init__(self, mode, file, clock, log_level=logging.INFO):
+    def __init__(self, mode, file, clock, log_level=logging.INFO, rng=None):
         self.mode = mode
+        self.rng = rng if rng is not None else RandomStream()
         self.file = file
         self.offset = 0
         self.Ts = 0
@@ -130,6 +729,12 @@ class Harvester:
         self.logger.setLevel(log_level)
         self.logger.disabled = True
         self.len = 0
+        self.index = None
+        self.dataset = None
+        self.datasets = None
+        self.samples_per_slot = 0
+        ## Block generator of the stochastic modes
+        self.source = None
     
     def set_constant(self, energy_per_clock_tick):
         self.energy_per_clock_tick = energy_per_clock_tick
@@ -137,15 +742,136 @@ class Harvester:
     def set_gaussian(self, mean, std):
         self.mean = mean
         self.std = std
+        self.source = GaussianSource(self.rng.generator, mean, mean*std)
+
+    def set_lognormal(self, mean, sigma):
+        self.mean = mean
+        self.source = LogNormalSource(self.rng.generator, mean, sigma)
+
+    def set_onoff(self, power, mean_on, mean_off):
+        self.source = OnOffSource(self.rng.generator, power, mean_on, mean_off)
+
+    def set_diurnal(self, mean, day, noise=0.0):
+        self.mean = mean
+        self.source = DiurnalSource(self.rng.generator, mean, day, noise)
     
-    def set_file(self, file, Ts):
-        self.file = DataReader(file).open()
-        self.offset = np.random.randint(0, len(self.file))
-        self.data = self.file[0]
+    def set_file(self, file, Ts, dataset=None):
+        ## dataset as in the harvester config, see trace_datasets
+        self.file = file
+        self.datasets = dataset
+        candidates = trace_datasets(file, dataset)
+        self.dataset = candidates[self.rng.randint(0, len(candidates))] if len(candidates) > 1 else candidates[0]
+        self.index = load_energy_index(file, self.dataset, Ts)
+        self.offset = self.rng.randint(0, len(self.index))
         self.Ts = Ts
-        self.len = len(self.data)
-        
-        
+        self.samples_per_slot = self.index.samples_per_slot(Ts)
+        self.len = len(self.index)
+
+    def slots_until(self, energy, target, drain=0.0, horizon=math.inf):
+        """Number of upcoming slots until the stored energy exceeds target, without consuming them.
+
+        With `energy` stored now and `drain` spent after every slot, the result is the smallest k for which
+        energy + (harvest of the next k slots) - (k - 1) * drain > target, i.e. the k-th get_energy call
+        from now is the one that pushes the node over target. CONSTANT mode is closed form, FILE mode a binary
+        search of the cumulative energy of the trace if there is no drain, the other modes scan blocks of their
+        pre-generated slots.
+
+        Returns:
+            k, or None if the target is not reached within horizon slots
+        """
+        if self.mode == harvestingmode.CONSTANT:
+            power = self.energy_per_clock_tick
+            if energy + power > target:
+                k = 1
+            elif power > drain:
+                k = math.floor((target - energy - power) / (power - drain)) + 2
+            else:
+                return None
+        elif self.mode == harvestingmode.FILE and drain == 0:
+            need = target - energy
+            if need < 0:
+                return 1
+            if self.index.total <= 0:
+                return None
+            ## Enough slots to go around the trace more often than the missing energy needs
+            loops = need / self.index.total + 1
+            high = int(min(horizon, math.ceil(loops * self.len / self.samples_per_slot) + 1))
+            energy_of = lambda k: self.index.window(self.offset, k * self.samples_per_slot)
+            if energy_of(high) <= need:
+                return None
+            k = bisect.bisect_right(range(1, high + 1), need, key=energy_of) + 1
+        else:
+            k = self._scan_until(energy, target, drain, horizon)
+        return k if k is not None and k <= horizon else None
+
+    def _scan_until(self, energy, target, drain, horizon, block=4096):
+        used = 0
+        while used < horizon:
+            n = int(min(block, horizon - used))
+            if self.mode == harvestingmode.FILE:
+                starts = self.offset + (used + np.arange(n)) * self.samples_per_slot
+                harvest = self.index.window(starts, self.samples_per_slot)
+            else:
+                harvest = self.source.peek(used + n)[used:]
+            ## Energy after the harvest of every slot, with the drain of the slots before it
+            after = energy + np.cumsum(harvest) - drain * np.arange(n)
+            hit = np.flatnonzero(after > target)
+            if len(hit) > 0:
+                return used + int(hit[0]) + 1
+            energy = after[-1] - drain
+            used += n
+        return None
+
+    def pause(self):
+        """Keep only the latest clock tick instead of queueing every tick, while a node fast-forwards and does
+        not call get_energy. The next skip takes the ticks."""
+        self.subscriber.pause()
+
+    def skip(self, k):
+        """Consume k slots at once, the last of them the current clock tick, as k calls of get_energy, and return
+        the energy harvested in them. Every clock tick received so far is taken, get_energy continues with the
+        next one."""
+        if k <= 0:
+            return 0.0
+        self.previous_tick = self.subscriber.drain()
+        return self.take(k)
+
+    def take(self, k):
+        """Consume the next k slots without reading the clock and return the energy harvested in them."""
+        if k <= 0:
+            return 0.0
+        if self.mode == harvestingmode.CONSTANT:
+            return k * self.energy_per_clock_tick
+        elif self.mode == harvestingmode.FILE:
+            energy_in = self.index.window(self.offset, k * self.samples_per_slot)
+            self.offset = (self.offset + k * self.samples_per_slot) % self.len
+            return energy_in
+        return float(np.sum(self.source.take(k)))
+
+    def reseed(self, rng):
+        """Continue with the RandomStream rng, for a fork of a simulation."""
+        self.rng = rng
+        if self.source is not None:
+            self.source.reseed(rng.generator)
+
+    def restart(self):
+        """Draw the random start of the harvest again from rng, i.e. the dataset and trace position in FILE mode
+        and the initial state of a stochastic source. Only for a harvester that has not harvested yet."""
+        if self.mode == harvestingmode.FILE and self.dataset is not None:
+            self.set_file(self.file, self.Ts, self.datasets)
+        elif self.source is not None:
+            self.source = self.source.restart(self.rng.generator)
+
+    ## The energy index of a trace is not part of the pickled state, it is looked up again on unpickling
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['index'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.mode == harvestingmode.FILE and self.dataset is not None:
+            self.index = load_energy_index(self.file, self.dataset, self.Ts)
 
     def get_energy(self):
         new_tick = self.subscriber.get_message()
@@ -153,25 +879,15 @@ class Harvester:
             self.previous_tick = new_tick
             if self.mode == harvestingmode.CONSTANT:
                 return self.energy_per_clock_tick
-            elif self.mode == harvestingmode.GAUSSIAN:
-                ein = np.random.normal(self.mean, self.mean*self.std)
-                if ein < 0:
-                    ein = 0
-                return ein
             elif self.mode == harvestingmode.FILE:
-                energy_in = 0
-                
-                ## Read a slice of the data
-                ## The slice is the size of the time slot
-                
-                energy_data = self.data[self.offset:(self.offset + int(self.Ts/1e-5))%self.len]
-                energy_data = energy_data * 1e-5
-                energy_in = np.sum(energy_data)
-                # print("Energy in: ", energy_in)
-                self.offset += int(self.Ts/1e-5)
-                self.offset = self.offset % self.len
-                  
+                ## Energy of the samples in one time slot, wrapping around the end of the trace
+                energy_in = self.index.window(self.offset, self.samples_per_slot)
+                self.offset = (self.offset + self.samples_per_slot) % self.len
+
                 return energy_in
+            elif self.source is not None:
+                ## GAUSSIAN and the other stochastic modes hand out slots of their pre-generated blocks
+                return self.source.next()
             else:
                 self.logger.error("No harvesting mode set")
                 return 0
@@ -179,4 +895,18 @@ class Harvester:
             
         else:
             self.logger.error("Clock ticks are not in order: " + str(new_tick) + " " + str(self.previous_tick))
-            return 0
\ No newline at end of file
+            return 0
+
+
+if __name__ == '__main__':
+    ## Fill the trace cache ahead of a study: bin every dataset of the given trace files
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="hdf5 trace files")
+    parser.add_argument("--Ts", type=float, default=1e-2, help="Slot length in seconds")
+    parser.add_argument("--cache", default=None, help="Cache directory, by default " + TRACE_CACHE)
+    args = parser.parse_args()
+
+    for path in args.files:
+        for dataset, energy in cached_slot_energies(path, trace_datasets(path, "random"), args.Ts, args.cache).items():
+            print("%s/%s: %d slots" % (path, dataset, len(energy)))
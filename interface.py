@@ -18,6 +18,9 @@ class Subscriber:
     def __init__(self, topic, publisher):
         self.topic = topic
         self.message_queue = queue.Queue()
+        ## While paused only the latest message is kept, see pause
+        self.paused = False
+        self.latest = None
         self.subscribe(publisher)
     
     def subscribe(self, publisher):
@@ -25,7 +28,10 @@ class Subscriber:
     
     def notify(self, message):
         if message is not None:
-            self.message_queue.put(message)
+            if self.paused:
+                self.latest = message
+            else:
+                self.message_queue.put(message)
 
     def get_message(self):
         message = None
@@ -36,4 +42,36 @@ class Subscriber:
     
     def get_number_of_messages(self):
         n = self.message_queue.qsize()
-        return n
\ No newline at end of file
+        return n
+
+    def pause(self):
+        """Stop queueing messages and only keep the latest one, until the next drain."""
+        self.paused = True
+
+    def drain(self):
+        """Take every message received so far and resume queueing.
+
+        Returns:
+            the latest message, None if there was none
+        """
+        message = self.latest
+        with self.message_queue.mutex:
+            if self.message_queue.queue and message is None:
+                message = self.message_queue.queue[-1]
+            self.message_queue.queue.clear()
+        self.paused = False
+        self.latest = None
+        return message
+
+    ## Pickled with the messages still queued, the queue itself holds locks
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['message_queue'] = list(self.message_queue.queue)
+        return state
+
+    def __setstate__(self, state):
+        messages = state.pop('message_queue')
+        self.__dict__.update(state)
+        self.message_queue = queue.Queue()
+        for message in messages:
+            self.message_queue.put(message)
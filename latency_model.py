@@ -0,0 +1,212 @@
+## Markov-chain model of the discovery latency of the star network
+## A mean-field model of Node.run_one_time_step, fast enough to screen large parameter spaces before running
+## Monte Carlo trials. Time advances in periods of nominal_runtime slots, in which every node that is on either
+## advertises once (probability alpha) or spends a scan phase of N_SCANS scans (probability 1 - alpha).
+##
+## The hub and the leaves meet in a rendezvous slot: the hub advertises there, and a leaf that heard the hub while
+## scanning (an informed leaf) advertises there too. A leaf that did not hear the hub yet advertises at its own
+## offset, which is the rendezvous slot with probability 1/period. In a period in which the hub advertises and
+##   - exactly one leaf advertises with it, the hub counts that leaf and the leaf is done,
+##   - two or more leaves advertise with it, each of them hears only the hub and is done without being counted,
+##     so the trial can no longer finish (the None result of the simulation).
+## The chain state is (discovered leaves, informed leaves), with absorbing success and failure states.
+##
+## A node that harvests less per period than it spends is only on for that fraction of the periods. The time to
+## charge up to von and the random offset of the hub give the slot at which the chain starts.
+
+import math
+import numpy as np
+
+from batch import node_parameters, ESLEEP, N_SCANS
+from harvester import load_energy_indices
+
+
+def _binomial(n, p):
+    ## Probabilities of 0..n successes out of n trials
+    k = np.arange(n + 1)
+    log_choose = np.array([math.lgamma(n + 1) - math.lgamma(j + 1) - math.lgamma(n - j + 1) for j in k])
+    with np.errstate(divide='ignore'):
+        logs = log_choose + k * np.log(p) + (n - k) * np.log1p(-p) if 0 < p < 1 else None
+    if logs is None:
+        pmf = np.zeros(n + 1)
+        pmf[0 if p <= 0 else n] = 1.0
+        return pmf
+    return np.exp(logs)
+
+
+def slot_energy(params, i, Ts=1e-2):
+    """Mean energy harvested by node i in one slot."""
+    mode = params['harvesting_mode'][i]
+    if mode == 'constant':
+        return params['power'][i]
+    elif mode == 'gaussian':
+        ## Harvester.get_energy clips normal(mean, mean*std) at zero
+        mu, sigma = params['mean'][i], params['mean'][i] * params['std'][i]
+        if sigma <= 0:
+            return max(mu, 0.0)
+        z = mu / sigma
+        return mu * 0.5 * (1 + math.erf(z / math.sqrt(2))) + sigma * math.exp(-z * z / 2) / math.sqrt(2 * math.pi)
+    elif mode in ('lognormal', 'onoff', 'diurnal'):
+        ## Generated with the cycle energy of node_parameters as their mean
+        return params['mean'][i]
+    else:
+        ## Averaged over the datasets the harvester draws from
+        indices = load_energy_indices(params['file'][i], params['dataset'][i], Ts)
+        return float(np.mean([index.total / len(index) * index.samples_per_slot(Ts) for index in indices]))
+
+
+class DiscoveryModel:
+    """Markov chain of the number of leaves the hub of a star network discovered.
+
+    Args:
+        config: simulation config as loaded from the yaml file, the topology must be a star around node 0
+        Ts: slot length in seconds, used for file traces
+    """
+
+    def __init__(self, config, Ts=1e-2):
+        topology = config.get('topology') or {}
+        if topology.get('type', 'star') != 'star':
+            raise ValueError("The discovery model only covers the star network")
+        params = node_parameters(config)
+        self.num_nodes = config['num_nodes']
+        self.leaves = self.num_nodes - 1
+        self.period = int(params['period'][0])
+        self.max_slots = config['num_cycles'] * self.period
+
+        harvest = np.array([slot_energy(params, i, Ts) for i in range(self.num_nodes)])
+        ## Energy spent per period by a node that is on, against the energy it harvests in that period
+        spend = (params['alpha'] * params['eadv'] + (1 - params['alpha']) * N_SCANS * params['escan']
+                 + ESLEEP * params['period'])
+        self.activity = np.minimum(1.0, harvest * params['period'] / spend)
+        ## Leaves are taken as exchangeable, with the mean parameters of nodes 1..n-1
+        self.hub_advertise = self.activity[0] * params['alpha'][0]
+        self.leaf_advertise = float(np.mean(self.activity[1:] * params['alpha'][1:]))
+        leaf_scan = float(np.mean(self.activity[1:] * (1 - params['alpha'][1:])))
+        self.hub_scan = self.activity[0] * (1 - params['alpha'][0])
+        ## Probability that a scan phase covers a given slot
+        self.coverage = min(1.0, N_SCANS / self.period)
+        ## An uninformed leaf learns the rendezvous slot when one of its scans falls on the hub's advertisement
+        self.learn = leaf_scan * self.coverage
+
+        ## The hub starts once it charged from empty to von, after its offset of on average half a period
+        on_energy = 0.5 * params['capacitance'][0] * params['von'][0]**2
+        self.charge_slots = math.ceil(on_energy / harvest[0]) if harvest[0] > 0 else math.inf
+        self.start_slot = self.charge_slots + (self.period - 1) / 2
+
+        self._build()
+
+    def _state(self, k, m):
+        return self._index[k, m]
+
+    def _build(self):
+        ## Transient states (k, m) with k + m <= leaves, then the absorbing success and failure states
+        L = self.leaves
+        self._index = -np.ones((L + 1, L + 1), dtype=np.int64)
+        states = [(k, m) for k in range(L) for m in range(L - k + 1)]
+        for s, (k, m) in enumerate(states):
+            self._index[k, m] = s
+        self.states = states
+        self.success = len(states)
+        self.failure = len(states) + 1
+
+        a0, a, b = self.hub_advertise, self.leaf_advertise, self.leaf_advertise / self.period
+        learn = [_binomial(u, self.learn) for u in range(L + 1)]
+        src, dst, prob = [], [], []
+
+        def add(s, k, m, p, hub_advertised):
+            ## After the hub advertised, uninformed leaves may have heard it
+            if p <= 0:
+                return
+            if k == L:
+                src.append(s), dst.append(self.success), prob.append(p)
+                return
+            u = L - k - m
+            pmf = learn[u] if hub_advertised else np.eye(u + 1)[0]
+            for j in np.nonzero(pmf)[0]:
+                src.append(s), dst.append(self._state(k, m + j)), prob.append(p * pmf[j])
+
+        for s, (k, m) in enumerate(states):
+            u = L - k - m
+            none = (1 - a)**m * (1 - b)**u
+            informed = m * a * (1 - a)**(m - 1) * (1 - b)**u if m > 0 else 0.0
+            uninformed = u * b * (1 - b)**(u - 1) * (1 - a)**m if u > 0 else 0.0
+            ## A scanning hub without a rendezvous slot moves to the offset of a leaf it heard advertising,
+            ## which makes that leaf informed
+            found = 1 - (1 - self.coverage * a)**u if m == 0 else 0.0
+            add(s, k, m, (1 - a0) - self.hub_scan * found, False)
+            add(s, k, m + 1, self.hub_scan * found, False)
+            add(s, k, m, a0 * none, True)
+            add(s, k + 1, m - 1, a0 * informed, True)
+            add(s, k + 1, m, a0 * uninformed, True)
+            fail = a0 * (1 - none - informed - uninformed)
+            if fail > 0:
+                src.append(s), dst.append(self.failure), prob.append(fail)
+
+        self._src = np.array(src, dtype=np.int64)
+        self._dst = np.array(dst, dtype=np.int64)
+        self._prob = np.array(prob)
+
+    def step(self, p):
+        """Probabilities of the states one period after the distribution p."""
+        return np.bincount(self._dst, weights=p[self._src] * self._prob, minlength=len(p))
+
+    def distribution(self, max_periods=None, tolerance=1e-9):
+        """Probability that the hub discovers the last leaf in each period.
+
+        Args:
+            max_periods: periods to follow the chain for, by default the slot budget of the config
+            tolerance: stop early once less than this probability is left in transient states
+
+        Returns:
+            array with the probability of discovery in period 1, 2, ..., and the probability of failure
+        """
+        if max_periods is None:
+            max_periods = max(1, int((self.max_slots - self.start_slot) / self.period))
+        p = np.zeros(len(self.states) + 2)
+        p[self._state(0, 0)] = 1.0
+        pmf = []
+        for _ in range(max_periods):
+            p = self.step(p)
+            pmf.append(p[self.success])
+            p[self.success] = 0.0
+            if p[:self.success].sum() < tolerance:
+                break
+        return np.array(pmf), p[self.failure]
+
+    def slots(self, periods):
+        """Slot of a discovery in the given period, taken in the middle of the period."""
+        return self.start_slot + (np.asarray(periods) - 0.5) * self.period
+
+    def predict(self, quantiles=(0.1, 0.5, 0.9)):
+        """Summary of the predicted discovery latency within the slot budget of the config.
+
+        Returns:
+            dict with the probability of finishing, and the mean and quantiles of the slots of finished trials
+        """
+        pmf, _ = self.distribution()
+        finished = pmf.sum()
+        result = {'finished': float(finished), 'mean': None, 'quantiles': {}}
+        if finished > 0:
+            slots = self.slots(np.arange(1, len(pmf) + 1))
+            cdf = np.cumsum(pmf) / finished
+            result['mean'] = float(np.dot(pmf, slots) / finished)
+            for q in quantiles:
+                result['quantiles'][q] = float(slots[min(np.searchsorted(cdf, q), len(slots) - 1)])
+        return result
+
+
+if __name__ == '__main__':
+    import argparse
+    import yaml
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file", help="The name of the config file")
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as stream:
+        config = yaml.load(stream, Loader=yaml.Loader)
+    prediction = DiscoveryModel(config).predict()
+    print("Finished: %.3f" % prediction['finished'])
+    if prediction['mean'] is not None:
+        print("Mean slots: %.0f" % prediction['mean'])
+        for q, slot in prediction['quantiles'].items():
+            print("Quantile %.2f: %.0f slots" % (q, slot))
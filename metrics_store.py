@@ -0,0 +1,151 @@
+## Columnar per-trial metrics
+## Besides the discovery slot, every trial can return the counters of all its nodes as a small structured array,
+## one fixed-width record per node, tagged with the config hash, the seed and the trial number. The workers send
+## these records back with their results and the parent appends them in bulk to a .npy or an hdf5 file
+## (.h5/.hdf5), so metrics that were not looked at when the trials ran do not need a rerun.
+##
+## A .npy metrics file is read back without copying it into memory:
+##   metrics = read_metrics("metrics.npy")
+##   hub = metrics[(metrics["config"] == digest.encode()) & (metrics["node"] == 0)]
+##   hub["scan_success"].mean(), (metrics["slot"] < 0).mean()
+
+import os
+import time
+import numpy as np
+
+from recorder import _npy_header
+from results_store import seed_key
+
+METRICS_RECORD = np.dtype([("config", "S16"), ("seed", "S64"), ("trial", np.int64), ("node", np.int32),
+                           ("slot", np.int64), ("adv_sent", np.int64), ("scan_sent", np.int64),
+                           ("adv_success", np.int64), ("scan_success", np.int64), ("resets", np.int64),
+                           ("harvested", np.float64), ("spent", np.float64), ("energy", np.float64)])
+COUNTERS = ("adv_sent", "scan_sent", "adv_success", "scan_success", "resets", "harvested", "spent", "energy")
+
+## Fixed size of the .npy header of a metrics file, the dtype description does not fit in that of an event trace
+METRICS_HEADER = 512
+
+
+def trial_metrics(counters, slot, digest, seed, trial):
+    """Records of one trial.
+
+    Args:
+        counters: dict per node with the metrics of the node and its final energy level (energy)
+        slot: discovery slot of the trial, None if it did not finish (stored as -1)
+        digest: config hash of the trial
+        seed: seed of the trial
+        trial: trial number
+
+    Returns:
+        structured array of METRICS_RECORD with one record per node
+    """
+    records = np.zeros(len(counters), dtype=METRICS_RECORD)
+    records["config"] = digest
+    records["seed"] = seed_key(seed)
+    records["trial"] = trial
+    records["node"] = np.arange(len(counters))
+    records["slot"] = -1 if slot is None else slot
+    for key in COUNTERS:
+        records[key] = [c[key] for c in counters]
+    return records
+
+
+class MetricsWriter(object):
+    """Buffer of metric records, appended in chunks to a .npy or an hdf5 file (.h5/.hdf5).
+
+    Records already in the file are kept, so reruns and sweeps can share one metrics file. The buffer is written
+    out once it is full or flush_interval seconds after the last write, and by close().
+
+    Args:
+        path: output file, the format follows from its extension
+        capacity: number of records held in memory before they are written out
+        dataset: name of the dataset in an hdf5 file
+        flush_interval: seconds records are held at most before they are written out, so a run that is killed
+            loses at most that much
+        chunk_size: number of records per chunk of the hdf5 dataset
+    """
+
+    def __init__(self, path, capacity=65536, dataset="metrics", flush_interval=10.0, chunk_size=4096):
+        self.path = path
+        self.buffer = np.zeros(capacity, dtype=METRICS_RECORD)
+        self.capacity = capacity
+        self.count = 0
+        self.flush_interval = flush_interval
+        self._flushed = time.monotonic()
+        self.hdf5 = path.endswith((".h5", ".hdf5"))
+        if self.hdf5:
+            import h5py
+            self._file = h5py.File(path, "a")
+            if dataset not in self._file:
+                self._file.create_dataset(dataset, shape=(0,), maxshape=(None,), dtype=METRICS_RECORD,
+                                          chunks=(chunk_size,))
+            self._dataset = self._file[dataset]
+            self.written = len(self._dataset)
+        elif os.path.exists(path):
+            self._file = open(path, "r+b")
+            version = np.lib.format.read_magic(self._file)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(self._file)
+            if version != (1, 0) or self._file.tell() != METRICS_HEADER or dtype != METRICS_RECORD:
+                self._file.close()
+                raise ValueError("Not a metrics file: " + path)
+            self.written = shape[0]
+            self._file.seek(METRICS_HEADER + self.written * METRICS_RECORD.itemsize)
+            ## Drop the partial record of an interrupted write
+            self._file.truncate()
+        else:
+            self._file = open(path, "wb")
+            self._file.write(_npy_header(0, METRICS_RECORD, METRICS_HEADER))
+            self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, records):
+        """Append the records of one or more trials."""
+        while len(records):
+            n = min(len(records), self.capacity - self.count)
+            self.buffer[self.count:self.count + n] = records[:n]
+            self.count += n
+            records = records[n:]
+            if self.count == self.capacity:
+                self.flush()
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._flushed = time.monotonic()
+        if self.count == 0:
+            return
+        chunk = self.buffer[:self.count]
+        if self.hdf5:
+            self._dataset.resize((self.written + self.count,))
+            self._dataset[self.written:] = chunk
+            self.written += self.count
+        else:
+            self._file.write(chunk.tobytes())
+            self.written += self.count
+            ## The header always counts whole records only, so the file stays readable if the run is interrupted
+            self._file.seek(0)
+            self._file.write(_npy_header(self.written, METRICS_RECORD, METRICS_HEADER))
+            self._file.seek(0, os.SEEK_END)
+        self._file.flush()
+        self.count = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+
+
+def read_metrics(path, dataset="metrics", mmap=True):
+    """Records of a metrics file written by MetricsWriter, memory-mapped for a .npy file unless mmap is False."""
+    if path.endswith((".h5", ".hdf5")):
+        import h5py
+        with h5py.File(path, "r") as f:
+            return f[dataset][:]
+    return np.load(path, mmap_mode="r" if mmap else None)
@@ -4,13 +4,13 @@
 ## Depending on the energy level, it will decide whether to advertise or scan or sleep
 ## Takes in offset and saves it as internal state
 
-import random
 import math
 from enum import Enum
 import numpy as np
 from interface import Subscriber
+from rng import RandomStream
+from recorder import EVENT
 import logging
-from matplotlib import pyplot as plt
 
 class ACTION(Enum):
     SLEEP = 0
@@ -30,12 +30,68 @@ class RUN_TYPE(Enum):
     ADVERTISING = 1
     NORMAL = 2
 
+class ChannelMap(object):
+    """Successful scans per slot of the period, stored only for the slots that have any.
+
+    The slot with the most successful scans (the first one on a tie, as np.argmax of the dense map) is kept up to
+    date as scans are added, so checking for an entry and finding the best slot do not depend on the period.
+
+    Args:
+        period: number of slots of the period the map covers
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.counts = dict()
+        self.best = 0
+        self.best_count = 0
+
+    def any(self):
+        return self.best_count > 0
+
+    def __getitem__(self, slot):
+        return self.counts.get(slot, 0)
+
+    def add(self, slot):
+        """Count one more successful scan in the slot."""
+        count = self.counts.get(slot, 0) + 1
+        self.counts[slot] = count
+        if count > self.best_count or (count == self.best_count and slot < self.best):
+            self.best = slot
+            self.best_count = count
+
+    def clear(self, slot):
+        """Forget the scans of the slot."""
+        if self.counts.pop(slot, 0) and slot == self.best:
+            ## Only the slots with entries are searched for the next best one
+            self.best, self.best_count = 0, 0
+            for s, count in self.counts.items():
+                if count > self.best_count or (count == self.best_count and s < self.best):
+                    self.best, self.best_count = s, count
+
+    def reset(self):
+        self.counts.clear()
+        self.best = 0
+        self.best_count = 0
+
+    def dense(self):
+        """The map as an array of the period."""
+        dense = np.zeros(self.period)
+        for slot, count in self.counts.items():
+            dense[slot] = count
+        return dense
+
+
 class Node():
-    def __init__ (self, id, energy_harvester, clock, radio, offset, alpha, capacitance, von, voff, eadv, escan, nominal_time_period, run_time = 100, runtype= RUN_TYPE.NORMAL, log_level=logging.INFO):
+    def __init__ (self, id, energy_harvester, clock, radio, offset, alpha, capacitance, von, voff, eadv, escan, nominal_time_period, run_time = 100, runtype= RUN_TYPE.NORMAL, log_level=logging.INFO, rng=None, recorder=None):
         self.energy_harvester = energy_harvester
         self.clock = Subscriber("clock", clock)
         self.radio = radio
         self.id = id        
+        ## Random stream of this node, a fresh unseeded one if none is given
+        self.rng = rng if rng is not None else RandomStream()
+        ## Optional EventRecorder, the slot loop does not log
+        self.recorder = recorder
 
         ## Take in all the parameters
         self.capacitance = capacitance
@@ -48,7 +104,7 @@ class Node():
         self.esleep = 10.5e-9
         self.nominal_time_period = nominal_time_period
         self.run_time = run_time
-        self.channel_map = np.zeros(nominal_time_period)
+        self.channel_map = ChannelMap(nominal_time_period)
         self.runtype = runtype
         # print( self.id, self.runtype)
         
@@ -74,12 +130,22 @@ class Node():
         self.metrics["scan_sent"] = 0
         self.metrics["adv_success"] = 0
         self.metrics["scan_success"] = 0
+        self.metrics["resets"] = 0
+        ## Energy taken from the harvester and spent on the radio and sleeping
+        self.metrics["harvested"] = 0.0
+        self.metrics["spent"] = 0.0
         
         ## Parameters for the node
         self.done = False
         self.action_decided = False
         self.ran_once = False
 
+        ## Charging phases are fast-forwarded: energy at which the node turns on, and the first and the last
+        ## slot of the current charging phase
+        self.energy_on = 0.5 * self.capacitance * self.von**2
+        self.charge_start = 0
+        self.wake_asn = None
+
     def compute_energy_level(self, energy_in):
         self.energy_level = self.energy_level + energy_in
 
@@ -89,6 +155,8 @@ class Node():
             self.reset()
         
         if voltage > self.von:
+            if self.recorder is not None and self.state == STATE.OFF:
+                self.recorder.record(self.ASN, self.id, EVENT.ON, self.energy_level)
             self.state = STATE.ON
         elif voltage < self.voff:
             self.state = STATE.OFF
@@ -98,46 +166,55 @@ class Node():
             if action == ACTION.ADVERTISE:
                 self.radio.advertise(self.ASN, self.id)
                 self.metrics["adv_sent"] += 1
+                if self.recorder is not None:
+                    self.recorder.record(self.ASN, self.id, EVENT.ADVERTISE, self.energy_level)
             elif action == ACTION.SCAN:
                 self.radio.scan(self.ASN, self.id)
                 self.metrics["scan_sent"] += 1
+                if self.recorder is not None:
+                    self.recorder.record(self.ASN, self.id, EVENT.SCAN, self.energy_level)
             elif action == ACTION.SLEEP:
                 self.radio.sleep()
     
     def build_channel_map(self):
         if self.radio.get_message() == RADIO_STATE.SUCCESS and self.state == STATE.ON:
             if self.action == ACTION.ADVERTISE:
-                self.logger.info("Node: %s, ASN: %s, Advertise Success", self.id, self.ASN)
+                if self.recorder is not None:
+                    self.recorder.record(self.ASN, self.id, EVENT.ADVERTISE_SUCCESS, self.energy_level)
                 
                 ## Updates as the nodes are successful in advertising, hence it will be moving to communication state
                 if (self.id  == 0):
-                    self.channel_map[self.ASN % self.nominal_time_period] = 0
-                    self.offset = np.random.randint(0, self.nominal_time_period)
+                    self.channel_map.clear(self.ASN % self.nominal_time_period)
+                    self.offset = self.rng.randint(0, self.nominal_time_period)
                 else:
                     self.done = True
                 
                 self.metrics["adv_success"] += 1
             elif self.action == ACTION.SCAN:
-                self.logger.info("Node: %s, ASN: %s, Scan Success", self.id, self.ASN)
+                if self.recorder is not None:
+                    self.recorder.record(self.ASN, self.id, EVENT.SCAN_SUCCESS, self.energy_level)
                 self.metrics["scan_success"] += 1
-                self.channel_map[self.ASN % self.nominal_time_period] += 1
-        
-        self.logger.debug("Node: %s, ASN: %s, self.radio message: %s, self.state= %s", self.id, self.ASN, self.radio.get_message(), self.state)
+                self.channel_map.add(self.ASN % self.nominal_time_period)
+
         
         ## Update the energy level now
         if self.action == ACTION.ADVERTISE:
+            self.metrics["spent"] += self.eadv
             self.compute_energy_level(-self.eadv)
         elif self.action == ACTION.SCAN:
+            self.metrics["spent"] += self.escan
             self.compute_energy_level(-self.escan)
         elif self.action == ACTION.SLEEP:
             if self.ran_once:
+                self.metrics["spent"] += self.esleep
                 self.compute_energy_level(-self.esleep)
             
             
         
         
     def show_channel_map(self):
-        plt.plot(self.channel_map)
+        from matplotlib import pyplot as plt
+        plt.plot(self.channel_map.dense())
         plt.savefig("channel_map.png")
 
     def print_stats(self):
@@ -151,7 +228,27 @@ class Node():
                 self.ASN += 1
             
             if self.ASN > self.offset:
-                self.compute_energy_level(self.energy_harvester.get_energy())
+                if self.state == STATE.OFF and not self.ran_once:
+                    ## A charging node does nothing but harvest until it turns on, so its harvester is asked once
+                    ## for the slot in which that happens, and the slots up to it are read in one go. The harvester
+                    ## stops queueing clock ticks until then
+                    if self.wake_asn is None:
+                        horizon = self.run_time * self.nominal_time_period - self.ASN + 1
+                        k = self.energy_harvester.slots_until(self.energy_level, self.energy_on, horizon=horizon)
+                        self.charge_start = self.ASN
+                        self.wake_asn = self.ASN + k - 1 if k is not None else math.inf
+                        self.energy_harvester.pause()
+                    if self.ASN < self.wake_asn:
+                        self.action = ACTION.SLEEP
+                        return
+                    self.wake_asn = None
+                    energy = self.energy_harvester.skip(self.ASN - self.charge_start + 1)
+                    self.metrics["harvested"] += energy
+                    self.compute_energy_level(energy)
+                else:
+                    energy = self.energy_harvester.get_energy()
+                    self.metrics["harvested"] += energy
+                    self.compute_energy_level(energy)
             
             if self.done:
                 self.action = ACTION.SLEEP
@@ -161,7 +258,6 @@ class Node():
             if self.state == STATE.ON:
                 self.ran_once = True
                 if self.runtype == RUN_TYPE.NORMAL:                        
-                    self.logger.debug("Node" + str(self.id) +" is on at ASN: " + str(self.ASN))
 
                     self.action = ACTION.SLEEP
                     ## Node wakes up and checks what should be the right slot for it
@@ -172,7 +268,7 @@ class Node():
                         # self.prev_run_time = int(self.ASN/self.nominal_time_period)
                         # self.build_channel_map()
                     if self.action_decided == False:
-                        if random.random() < self.alpha:
+                        if self.rng.random() < self.alpha:
                             self.action = ACTION.ADVERTISE
                             # self.scan_slots = []
                             self.nScan = 0
@@ -183,12 +279,12 @@ class Node():
                     
                         
                     if  self.action == ACTION.ADVERTISE:
-                        if any(self.channel_map > 0):
-                            ## Check if the current ASN is beyond the argmax of the channel map
-                            if self.ASN % self.nominal_time_period > np.argmax(self.channel_map):
-                                self.next_wakeup_offset = self.nominal_time_period - self.ASN % self.nominal_time_period + np.argmax(self.channel_map)
+                        if self.channel_map.any():
+                            ## Check if the current ASN is beyond the best slot of the channel map
+                            if self.ASN % self.nominal_time_period > self.channel_map.best:
+                                self.next_wakeup_offset = self.nominal_time_period - self.ASN % self.nominal_time_period + self.channel_map.best
                             else:
-                                self.next_wakeup_offset = np.argmax(self.channel_map) - self.ASN % self.nominal_time_period
+                                self.next_wakeup_offset = self.channel_map.best - self.ASN % self.nominal_time_period
                             self.next_wakeup = self.ASN + self.next_wakeup_offset
                             self.action = ACTION.SLEEP
                             self.do_action(ACTION.SLEEP)
@@ -216,7 +312,7 @@ class Node():
                         self.action_decided = False
                     
                     if self.nScan > 0:
-                        if random.random() < self.n/self.nominal_time_period:
+                        if self.rng.random() < self.n/self.nominal_time_period:
                             self.action = ACTION.SCAN
                             self.nScan -= 1
                             if self.nScan == 0:
@@ -247,13 +343,11 @@ class Node():
                             
 
                 elif self.runtype == RUN_TYPE.ADVERTISING:
-                    self.logger.debug("Node" + str(self.id) +" is on at ASN: " + str(self.ASN))
                     self.current_run_time += 1
                     self.action = ACTION.ADVERTISE
                     self.do_action(ACTION.ADVERTISE)
                 
                 elif self.runtype == RUN_TYPE.SCANNING:
-                    self.logger.debug("Node" + str(self.id) +" is on at ASN: " + str(self.ASN))
                     self.current_run_time += 1
                     self.action = ACTION.SCAN
             
@@ -261,13 +355,25 @@ class Node():
                 self.action = ACTION.SLEEP
                 self.do_action(ACTION.SLEEP)
     
+    def settle(self):
+        """Harvest the slots of a fast-forwarded charging phase that have passed, and drop the slot it was
+        expected to end in, e.g. before the harvester of a forked simulation draws from a new stream."""
+        if self.wake_asn is None:
+            return
+        energy = self.energy_harvester.skip(self.ASN - self.charge_start + 1)
+        self.metrics["harvested"] += energy
+        self.compute_energy_level(energy)
+        self.wake_asn = None
+
     def reset(self):
-        self.logger.info("Node: %s, Resetting", self.id)
-        self.channel_map = np.zeros(self.nominal_time_period)
+        if self.recorder is not None:
+            self.recorder.record(self.ASN, self.id, EVENT.RESET, self.energy_level)
+        self.metrics["resets"] += 1
+        self.channel_map.reset()
         self.next_wakeup = 0
         self.action = ACTION.SLEEP
         self.state = STATE.OFF
-        self.offset = np.random.randint(0, self.nominal_time_period)
+        self.offset = self.rng.randint(0, self.nominal_time_period)
         self.ran_once = False
         self.action_decided = False
         
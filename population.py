@@ -0,0 +1,285 @@
+## Struct-of-arrays node population for single large-network trials
+## NodePopulation keeps every per-node field of Node as a NumPy column and runs the charging, wake-up,
+## advertise/scan decision and energy debit of Node.run_one_time_step and Node.build_channel_map as array
+## operations over all nodes of one trial. Unlike BatchSimulation, which steps many trials of a small network
+## in lock-step, the decision and channel map updates only touch the nodes that are on, so the per-slot cost of a
+## trial with thousands of mostly charging nodes stays a handful of vector operations.
+
+import logging
+import numpy as np
+import yaml
+
+from batch import channel_maps, node_parameters, harvest_source, STOCHASTIC_MODES, SLEEP, ADVERTISE, SCAN, RESET_VOLTAGE, ESLEEP, N_SCANS
+from harvester import load_energy_index, load_traces
+from node import RUN_TYPE
+from topology import topology_from_config
+
+
+class NodePopulation:
+    """Per-node state of the nodes of one trial, one array of shape (nodes,) per Node attribute.
+
+    Args:
+        params: per-node parameters as returned by batch.node_parameters
+        rng: numpy random Generator of the trial
+        Ts: slot length in seconds, used to bin file traces
+    """
+
+    def __init__(self, params, rng, Ts=1e-2):
+        self.rng = rng
+        self.alpha = params['alpha']
+        self.capacitance = params['capacitance']
+        self.von = params['von']
+        self.voff = params['voff']
+        self.eadv = params['eadv']
+        self.escan = params['escan']
+        self.period = params['period']
+        self.num_nodes = N = len(self.period)
+        self.scan_probability = N_SCANS / self.period
+        self.is_normal = params['runtype'] == RUN_TYPE.NORMAL.value
+        self.is_advertising = params['runtype'] == RUN_TYPE.ADVERTISING.value
+        self.is_scanning = params['runtype'] == RUN_TYPE.SCANNING.value
+
+        ## Harvesters grouped by mode, file harvesters by the dataset drawn for them so every trace is read once per
+        ## slot
+        modes = np.array(params['harvesting_mode'])
+        self.constant = np.flatnonzero(modes == 'constant')
+        self.power = params['power'][self.constant]
+        self.sources = []
+        for mode in STOCHASTIC_MODES:
+            nodes = np.flatnonzero(modes == mode)
+            if len(nodes) > 0:
+                self.sources.append((nodes, harvest_source(params, mode, nodes, rng)))
+        self.traces = []
+        self.trace_offset = np.zeros(N, dtype=np.int64)
+        dataset = [None] * N
+        for i, candidates in enumerate(params['dataset']):
+            if candidates is not None:
+                dataset[i] = candidates[rng.integers(0, len(candidates))] if len(candidates) > 1 else candidates[0]
+        traces = sorted(set((f, d) for f, d in zip(params['file'], dataset) if f is not None))
+        load_traces(traces, Ts)
+        for f, d in traces:
+            nodes = np.array([i for i in range(N) if (params['file'][i], dataset[i]) == (f, d)], dtype=np.int64)
+            index = load_energy_index(f, d, Ts)
+            self.traces.append((index, nodes, index.samples_per_slot(Ts)))
+            self.trace_offset[nodes] = rng.integers(0, len(index), size=len(nodes))
+
+        self.energy = np.zeros(N)
+        self.on = np.zeros(N, dtype=bool)
+        self.ran_once = np.zeros(N, dtype=bool)
+        self.done = np.zeros(N, dtype=bool)
+        self.offset = rng.integers(0, self.period)
+        self.action_decided = np.zeros(N, dtype=bool)
+        self.nScan = np.zeros(N, dtype=np.int64)
+        self.next_wakeup = np.zeros(N, dtype=np.int64)
+        self.action = np.zeros(N, dtype=np.int8)
+
+        ## Sparse channel map of every node plus arrays of its running maximum and first argmax, so "any entry"
+        ## and "best slot" are vector operations
+        self.channel_map = channel_maps(self.period, (N,))
+        self.map_max = np.zeros(N, dtype=np.int32)
+        self.map_best = np.zeros(N, dtype=np.int64)
+
+        self.metrics = {}
+        for key in ("adv_sent", "scan_sent", "adv_success", "scan_success"):
+            self.metrics[key] = np.zeros(N, dtype=np.int64)
+
+    def __len__(self):
+        return self.num_nodes
+
+    def harvest(self, asn):
+        """Harvester.get_energy and Node.compute_energy_level of every node past its offset."""
+        harvesting = asn > self.offset
+        energy_in = np.zeros(self.num_nodes)
+        energy_in[self.constant] = self.power
+        ## The stochastic sources advance every slot, also for nodes that do not harvest in it
+        for nodes, source in self.sources:
+            energy_in[nodes] = source.take(1)[0]
+        for index, nodes, length in self.traces:
+            start = self.trace_offset[nodes]
+            energy_in[nodes] = index.window(start, length)
+            ## The harvester only advances through its trace when it is read
+            self.trace_offset[nodes] = np.where(harvesting[nodes], (start + length) % len(index), start)
+        self.compute_energy_level(harvesting, energy_in)
+
+    def compute_energy_level(self, mask, energy_in):
+        self.energy += np.where(mask, energy_in, 0.0)
+        voltage = np.sqrt(2 * np.maximum(self.energy, 0.0) / self.capacitance)
+        reset = np.flatnonzero(mask & (voltage < RESET_VOLTAGE) & self.ran_once)
+        if len(reset) > 0:
+            self.reset(reset)
+        self.on[mask & (voltage > self.von)] = True
+        self.on[mask & (voltage < self.voff)] = False
+
+    def reset(self, nodes):
+        for channel_map in self.channel_map[nodes]:
+            channel_map.reset()
+        self.map_max[nodes] = 0
+        self.map_best[nodes] = 0
+        self.next_wakeup[nodes] = 0
+        self.on[nodes] = False
+        self.offset[nodes] = self.rng.integers(0, self.period[nodes])
+        self.ran_once[nodes] = False
+        self.action_decided[nodes] = False
+
+    def run_one_time_step(self, asn):
+        """Node.run_one_time_step of every node that is on, after harvesting.
+
+        Returns:
+            ids of the nodes that advertise and of the nodes that scan on the radio in this slot
+        """
+        self.action[:] = SLEEP
+        active = np.flatnonzero(self.on & ~self.done)
+        self.ran_once[active] = True
+        normal = active[self.is_normal[active]]
+
+        undecided = normal[~self.action_decided[normal]]
+        advertise = self.rng.random(len(undecided)) < self.alpha[undecided]
+        choose_advertise = undecided[advertise]
+        self.nScan[choose_advertise] = 0
+        self.nScan[undecided[~advertise]] = N_SCANS
+        self.action_decided[undecided] = True
+
+        ## Plan the advertisement: follow the channel map if it has an entry, else the node's own offset
+        period = self.period[choose_advertise]
+        position = asn % period
+        best = self.map_best[choose_advertise]
+        offset = self.offset[choose_advertise]
+        has_map = self.map_max[choose_advertise] > 0
+        to_best = np.where(position > best, period - position + best, best - position)
+        to_offset = np.where(position > offset, period - position + offset,
+                             np.where(position == offset, period, offset - position))
+        self.next_wakeup[choose_advertise] = asn + np.where(has_map, to_best, to_offset)
+        now = choose_advertise[~has_map & (position == offset)]
+        self.action[now] = ADVERTISE
+        self.action_decided[now] = False
+        self.metrics["adv_sent"][now] += 1
+
+        wake = normal[self.next_wakeup[normal] == asn]
+        self.action[wake] = ADVERTISE
+        self.action_decided[wake] = False
+        self.metrics["adv_sent"][wake] += 1
+
+        scanning = normal[self.nScan[normal] > 0]
+        scan = scanning[self.rng.random(len(scanning)) < self.scan_probability[scanning]]
+        self.action[scanning] = SLEEP
+        self.action[scan] = SCAN
+        self.nScan[scan] -= 1
+        self.action_decided[scan[self.nScan[scan] == 0]] = False
+        self.metrics["scan_sent"][scan] += 1
+
+        advertising = active[self.is_advertising[active]]
+        self.action[advertising] = ADVERTISE
+        self.metrics["adv_sent"][advertising] += 1
+        ## Scanning nodes spend the scan energy but never switch their radio on
+        self.action[active[self.is_scanning[active]]] = SCAN
+
+        transmitters = np.flatnonzero(self.action == ADVERTISE)
+        scanners = scan
+        return transmitters, scanners
+
+    def build_channel_map(self, asn, advertise_success, scan_success):
+        """Node.build_channel_map of every node, given the ids of the nodes whose advertisement or scan succeeded."""
+        self.metrics["adv_success"][advertise_success] += 1
+        self.metrics["scan_success"][scan_success] += 1
+
+        ## The hub clears the slot it just advertised in and draws a new offset, the others are done
+        if len(advertise_success) > 0 and advertise_success[0] == 0:
+            hub = self.channel_map[0]
+            hub.clear(int(asn % self.period[0]))
+            self.offset[0] = self.rng.integers(0, self.period[0])
+            self.map_best[0], self.map_max[0] = hub.best, hub.best_count
+            advertise_success = advertise_success[1:]
+        self.done[advertise_success] = True
+
+        if len(scan_success) > 0:
+            maps = self.channel_map[scan_success]
+            for channel_map, p in zip(maps, (asn % self.period[scan_success]).tolist()):
+                channel_map.add(p)
+            self.map_max[scan_success] = [channel_map.best_count for channel_map in maps]
+            self.map_best[scan_success] = [channel_map.best for channel_map in maps]
+
+        ## Debit the energy spent in this slot
+        debit = np.where(self.action == ADVERTISE, -self.eadv,
+                         np.where(self.action == SCAN, -self.escan, -ESLEEP))
+        self.compute_energy_level((self.action != SLEEP) | self.ran_once, debit)
+
+
+class PopulationSimulation:
+    """One trial of the discovery simulation over a NodePopulation, for networks of thousands of nodes.
+
+    Args:
+        config: simulation config as loaded from the yaml file
+        seed: seed of the random generator of the trial
+        Ts: slot length in seconds, used to bin file traces
+        topology: network topology, read from the config if not given
+    """
+
+    def __init__(self, config, seed=None, Ts=1e-2, topology=None, log_level=logging.INFO):
+        self.config = config
+        self.rng = np.random.default_rng(seed)
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(log_level)
+
+        params = node_parameters(config)
+        self.max_slots = config['num_cycles'] * int(params['period'][0])
+        self.topology = topology if topology is not None else topology_from_config(config, self.rng)
+        ## Node 0 has discovered the network once it counted every node it hears
+        self.targets, self.single = self.topology.discovery_targets(0)
+        self.target = len(self.targets)
+        self.nodes = NodePopulation(params, self.rng, Ts)
+        self.slot = 0
+
+    def step(self):
+        """Advance the trial by one slot and return the slot number."""
+        self.slot += 1
+        asn = self.slot
+        nodes = self.nodes
+        nodes.harvest(asn)
+        transmitters, scanners = nodes.run_one_time_step(asn)
+
+        ## Radio.publish/subscribe: an advertiser succeeds if exactly one neighbour advertised,
+        ## a scanner succeeds if at least one neighbour advertised
+        listeners, _ = self.topology.expand(transmitters)
+        heard = np.bincount(listeners, minlength=len(nodes))
+        nodes.build_channel_map(asn, transmitters[heard[transmitters] == 1], scanners[heard[scanners] >= 1])
+        return asn
+
+    def stuck(self):
+        ## As in BatchSimulation: no node left that node 0 can still count often enough to finish
+        undone = ~self.nodes.done[self.targets]
+        discovered = self.nodes.metrics["adv_success"][0]
+        return not (undone & ~self.single).any() and discovered + (undone & self.single).sum() < self.target
+
+    def run(self):
+        """Step until node 0 discovered every node it hears or the slot budget is used up.
+
+        Returns:
+            the discovery slot, None if the trial did not finish
+        """
+        while self.slot < self.max_slots:
+            asn = self.step()
+            if self.nodes.metrics["adv_success"][0] == self.target:
+                self.logger.info("Node discovered all other nodes at ASN: %s", asn)
+                return asn
+            if self.stuck():
+                break
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+    from rng import trial_seed
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file", help="The name of the config file")
+    parser.add_argument("output_file", help="The file the discovery slot of every trial is written to")
+    parser.add_argument("--trials", type=int, default=1, help="Number of trials, run one after the other")
+    parser.add_argument("--seed", type=int, default=0, help="Root seed, every trial is seeded from (seed, trial number)")
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as stream:
+        config = yaml.load(stream, Loader=yaml.Loader)
+
+    with open(args.output_file, "w") as f:
+        for trial in range(args.trials):
+            f.write("%s\n" % PopulationSimulation(config, seed=trial_seed(args.seed, trial)).run())
+            f.flush()
@@ -0,0 +1,68 @@
+## Low overhead per-phase wall-clock counters for the slot loop
+## The simulation reads the clock once per phase per slot, so the counters can stay on for whole runs. The
+## totals of several trials or workers are merged and reported as slots/s, trials/s and the share of each phase.
+
+import time
+
+
+class PhaseTimer(object):
+    """Accumulated wall-clock time per phase, plus the number of slots and trials it covers.
+
+    Args:
+        phases: names of the phases, in the order they are reported
+    """
+
+    def __init__(self, phases=()):
+        self.totals = dict((name, 0.0) for name in phases)
+        self.slots = 0
+        self.trials = 0
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+    def lap(self, phase, start):
+        """Add the time since `start` to the phase and return the current time, the start of the next phase."""
+        end = time.perf_counter()
+        self.totals[phase] = self.totals.get(phase, 0.0) + end - start
+        return end
+
+    def wrap(self, phase, function, parent=None):
+        """Time every call of `function` as its own phase. The time is taken off `parent`, the phase the calls
+        are made from, so the phases do not overlap."""
+        totals = self.totals
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                totals[phase] = totals.get(phase, 0.0) + elapsed
+                if parent is not None:
+                    totals[parent] = totals.get(parent, 0.0) - elapsed
+        return timed
+
+    def state(self):
+        """Picklable counters, to be sent back from a worker."""
+        return dict(totals=dict(self.totals), slots=self.slots, trials=self.trials)
+
+    def merge(self, state):
+        for phase, seconds in state['totals'].items():
+            self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+        self.slots += state['slots']
+        self.trials += state['trials']
+
+    def report(self, wall_time=None):
+        """Summary of the counters. With the wall time of the whole run, the throughput over all workers is given
+        as well, otherwise the throughput of the summed phase time."""
+        busy = sum(self.totals.values())
+        lines = ["Trials: %d, slots: %d" % (self.trials, self.slots)]
+        if busy > 0:
+            lines.append("Per worker: %.0f slots/s, %.3f trials/s" % (self.slots / busy, self.trials / busy))
+        if wall_time:
+            lines.append("Overall: %.0f slots/s, %.3f trials/s in %.2f s" % (self.slots / wall_time, self.trials / wall_time, wall_time))
+        for phase, seconds in self.totals.items():
+            share = 100.0 * seconds / busy if busy > 0 else 0.0
+            lines.append("  %-20s %10.3f s %6.1f %%" % (phase, seconds, share))
+        return "\n".join(lines)
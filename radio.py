@@ -1,8 +1,8 @@
 ## This is a software which takes in messages from the nodes and publishes them to the other radios
 ## Have to expose the radio publsihing interface to the nodes
 ## Have to expose the radio subscribing interface to the radios
-from interface import Publisher, Subscriber
 from node import RADIO_STATE
+from recorder import EVENT
 from enum import Enum
 import threading
 import time
@@ -15,12 +15,12 @@ class RadioEvent(Enum):
     SCAN = 2
 
 class radioMessage:
-    def __init__(self, ASN, radioEvent, nodeID, loglevel = logging.INFO):
+    __slots__ = ("ASN", "radioEvent", "nodeID")
+
+    def __init__(self, ASN, radioEvent, nodeID):
         self.ASN  = ASN
         self.radioEvent = radioEvent
         self.nodeID = nodeID
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(loglevel)
 
     def check_message(self, message):
         if message is None:
@@ -28,20 +28,89 @@ class radioMessage:
         if(self.ASN == message.ASN):
             if(self.radioEvent == RadioEvent.ADVERTISE):
                 if(message.radioEvent == RadioEvent.ADVERTISE):
-                    self.logger.debug("Message : self node id: %s, received node id: %s ASN: %s radioEvent: %s", str(self.nodeID), str(message.nodeID), str(message.ASN), " " + str(message.radioEvent))
                     return RADIO_STATE.SUCCESS
                 else:
                     return RADIO_STATE.FAILURE
             elif(self.radioEvent == RadioEvent.SCAN):
                 if(message.radioEvent == RadioEvent.ADVERTISE):
-                    self.logger.debug("Message : self node id: %s,received node id: %s ASN: %s radioEvent: %s", str(self.nodeID), str(message.nodeID), str(message.ASN), " " + str(message.radioEvent))
                     return RADIO_STATE.SUCCESS
                 else:
                     return RADIO_STATE.FAILURE
                 
+class Medium:
+    """Slot-synchronous broadcast medium shared by the radios of one simulation.
+
+    Radios register what they do in the current ASN when they publish: advertisers with their message,
+    scanners as listeners. One resolution pass then computes the outcome of every active radio with the
+    interference rules of radioMessage.check_message: an advertiser succeeds if it heard exactly one
+    advertisement, a scanner if it heard at least one, and nothing heard is a failure.
+
+    Args:
+        recorder: optional EventRecorder, advertisements lost to interference are recorded to it
+    """
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder
+        self.radios = []
+        ## listeners[i] are the ids of the radios that hear radio i
+        self.listeners = []
+        self.heard = []
+        self.last_message = []
+        self.transmissions = []
+        self.active = []
+
+    def register(self, radio):
+        self.radios.append(radio)
+        self.listeners.append([])
+        self.heard.append(0)
+        self.last_message.append(None)
+        return len(self.radios) - 1
+
+    def connect(self, transmitter, listener):
+        self.listeners[transmitter].append(listener)
+
+    def use_topology(self, topology):
+        ## Listeners come straight from the CSR adjacency instead of one link per pair of radios
+        for transmitter in range(len(self.radios)):
+            self.listeners[transmitter] = topology.listeners(transmitter)
+
+    def transmit(self, radio_id, message):
+        self.transmissions.append((radio_id, message))
+        self.active.append(radio_id)
+
+    def listen(self, radio_id):
+        self.active.append(radio_id)
+
+    def resolve(self):
+        touched = []
+        for radio_id, message in self.transmissions:
+            for listener in self.listeners[radio_id]:
+                self.heard[listener] += 1
+                self.last_message[listener] = message
+                touched.append(listener)
+
+        for radio_id in self.active:
+            radio = self.radios[radio_id]
+            n = self.heard[radio_id]
+            if n > 1 and radio.transmitted_message.radioEvent == RadioEvent.ADVERTISE:
+                if self.recorder is not None:
+                    self.recorder.record(radio.transmitted_message.ASN, radio.transmitted_message.nodeID, EVENT.INTERFERENCE)
+                radio.receive_message = RADIO_STATE.FAILURE
+            elif n > 0:
+                radio.receive_message = radio.transmitted_message.check_message(self.last_message[radio_id])
+            radio.subscribe_done = True
+
+        for radio_id in touched:
+            self.heard[radio_id] = 0
+            self.last_message[radio_id] = None
+        self.transmissions = []
+        self.active = []
+
+
 class Radio:
-    def __init__(self, loglevel = logging.INFO):
-        self.publisher = Publisher("radio")
+    def __init__(self, loglevel = logging.INFO, medium = None):
+        self.medium = medium if medium is not None else Medium()
+        self.id = self.medium.register(self)
         self.transmit_message = None
         self.transmitted_message = None
         # self.lock = threading.Lock()
@@ -50,18 +119,15 @@ class Radio:
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(loglevel)
         self.logger.disabled = True
-        self.subscriber = None
     
     # Functions used by the node
     def connectto(self, other_radio):
-        if self.subscriber == None:
-            self.subscriber = Subscriber("radio", getattr(other_radio, "publisher"))
-        else:
-            self.subscriber.subscribe(getattr(other_radio, "publisher"))
+        if other_radio.medium is not self.medium:
+            raise ValueError("Radios can only be connected on the same medium")
+        self.medium.connect(other_radio.id, self.id)
    
     def advertise(self, asn, nodeID):
-        self.logger.debug("node: %s, ASN: %s, Advertising" , str(nodeID), str(asn))
-        message = radioMessage(asn, RadioEvent.ADVERTISE, nodeID, loglevel=self.logger.getEffectiveLevel())
+        message = radioMessage(asn, RadioEvent.ADVERTISE, nodeID)
         self.transmit_message = message
         self.receive_message = False
         # self.lock.acquire()
@@ -69,8 +135,7 @@ class Radio:
         # self.lock.release()
 
     def scan(self, asn, nodeID):
-        self.logger.debug("node: %s, ASN: %s, Scanning" , str(nodeID), str(asn))
-        message = radioMessage(asn, RadioEvent.SCAN, nodeID, loglevel= self.logger.getEffectiveLevel())
+        message = radioMessage(asn, RadioEvent.SCAN, nodeID)
         self.transmitted_message = message
         self.transmit_message = None
         self.receive_message = False
@@ -92,43 +157,15 @@ class Radio:
     # Functions used by the simulation
     def publish(self):
         if self.transmit_message is not None:
-            self.logger.debug("Publishing : node id: %s ASN: %s radioEvent: %s", str(self.transmit_message.nodeID), str(self.transmit_message.ASN), " " + str(self.transmit_message.radioEvent))
-            self.publisher.publish(self.transmit_message)
+            self.medium.transmit(self.id, self.transmit_message)
             self.transmitted_message = self.transmit_message
             self.transmit_message = None
+        elif self.transmitted_message is not None:
+            self.medium.listen(self.id)
     
     def subscribe(self):
-        n = self.subscriber.get_number_of_messages()
-        
-        if self.transmitted_message is not None:
-            # self.logger.debug("Node id: %s, Number of messages in the queue: %s", self.transmitted_message.nodeID, str(n))
-            if n>1 and (self.transmitted_message.radioEvent==RadioEvent.ADVERTISE):
-                self.logger.info("Interference: More than one message in the queue")
-                for i in range(n):
-                    message= self.subscriber.get_message()
-                    self.logger.debug("Received : node id: %s ASN: %s radioEvent: %s", str(message.nodeID), str(message.ASN), " " + str(message.radioEvent))
-                self.receive_message = RADIO_STATE.FAILURE
-            elif n>1 and (self.transmitted_message.radioEvent==RadioEvent.SCAN):
-                    for i in range(n):
-                        message = self.subscriber.get_message()
-                        self.logger.debug("Received : node id: %s ASN: %s radioEvent: %s", str(message.nodeID), str(message.ASN), " " + str(message.radioEvent))
-                        self.receive_message = self.transmitted_message.check_message(message)
-            
-            elif n==1 and (self.transmitted_message.radioEvent in (RadioEvent.ADVERTISE, RadioEvent.SCAN)):
-                    message = self.subscriber.get_message()
-                    self.receive_message = self.transmitted_message.check_message(message)
-                        
-        
-        else:
-            # Removing the messages from the queue
-            for i in range(n):
-                    message= self.subscriber.get_message()
-
-
-        # self.lock.acquire()
-        self.subscribe_done = True
-        # self.lock.release()
-        
+        ## The first radio to subscribe in a slot resolves the medium for all radios
+        self.medium.resolve()
 
     def sleep(self):
         self.transmit_message = None
@@ -0,0 +1,110 @@
+## Binary event trace of a simulation
+## Instead of formatting log messages in the slot loop, the simulation can hand an EventRecorder to its nodes and
+## medium. Every event is one fixed-width record (ASN, node id, event code, energy level) written into a
+## preallocated NumPy buffer, which is appended to a .npy or hdf5 file whenever it is full. Without a recorder
+## the hot paths do nothing but a None check.
+##
+## A trace is read back with read_trace(path), e.g. to replay the events of one node leading up to a failed
+## discovery:
+##   events = read_trace("trial3.npy")
+##   events[(events["node"] == 2) & (events["event"] == EVENT.RESET.value)]
+
+import os
+from enum import Enum
+import numpy as np
+
+RECORD = np.dtype([("asn", np.int64), ("node", np.int32), ("event", np.int8), ("energy", np.float64)])
+
+
+class EVENT(Enum):
+    ON = 0
+    ADVERTISE = 1
+    SCAN = 2
+    ADVERTISE_SUCCESS = 3
+    SCAN_SUCCESS = 4
+    RESET = 5
+    INTERFERENCE = 6
+
+
+## Fixed size of the .npy header, so the number of records can be written over it after every flush
+NPY_HEADER = 256
+
+
+def _npy_header(count, dtype=RECORD, size=NPY_HEADER):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(dtype), count)
+    header = header.ljust(size - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + np.uint16(len(header)).tobytes() + header.encode("latin1")
+
+
+class EventRecorder(object):
+    """Buffer of event records, appended in chunks to a .npy or an hdf5 file (.h5/.hdf5).
+
+    The file holds every record flushed so far, also if the run is interrupted before close().
+
+    Args:
+        path: output file, the format follows from its extension
+        capacity: number of records held in memory before they are written out
+        dataset: name of the dataset in an hdf5 file
+    """
+
+    def __init__(self, path, capacity=65536, dataset="events"):
+        self.path = path
+        self.buffer = np.zeros(capacity, dtype=RECORD)
+        self.capacity = capacity
+        self.count = 0
+        self.written = 0
+        self.hdf5 = path.endswith((".h5", ".hdf5"))
+        if self.hdf5:
+            import h5py
+            self._file = h5py.File(path, "w")
+            self._dataset = self._file.create_dataset(dataset, shape=(0,), maxshape=(None,), dtype=RECORD,
+                                                      chunks=(capacity,))
+        else:
+            self._file = open(path, "wb")
+            self._file.write(_npy_header(0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, asn, node, event, energy=0.0):
+        self.buffer[self.count] = (asn, node, event.value, energy)
+        self.count += 1
+        if self.count == self.capacity:
+            self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        chunk = self.buffer[:self.count]
+        if self.hdf5:
+            self._dataset.resize((self.written + self.count,))
+            self._dataset[self.written:] = chunk
+            self.written += self.count
+        else:
+            self._file.write(chunk.tobytes())
+            self.written += self.count
+            ## The header always counts whole records only, so the file stays readable if the run is interrupted
+            self._file.seek(0)
+            self._file.write(_npy_header(self.written))
+            self._file.seek(0, os.SEEK_END)
+        self._file.flush()
+        self.count = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+
+
+def read_trace(path, dataset="events"):
+    """Records of a trace written by EventRecorder, as a structured array with the fields of RECORD."""
+    if path.endswith((".h5", ".hdf5")):
+        import h5py
+        with h5py.File(path, "r") as f:
+            return f[dataset][:]
+    return np.load(path)
@@ -0,0 +1,82 @@
+## Durable store of finished trials
+## Every finished trial is appended to a json lines file right away, keyed by the hash of its config and its
+## seed. A crashed or interrupted run therefore keeps everything it finished, and a rerun of the same trials,
+## e.g. of a sweep, only computes the ones that are missing.
+
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def config_hash(config):
+    """Stable hash of a simulation config, independent of the order of its keys."""
+    canonical = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+def seed_key(seed):
+    """String form of a seed: an int, or a numpy SeedSequence given by its entropy and spawn key."""
+    if isinstance(seed, np.random.SeedSequence):
+        return "%s:%s" % (seed.entropy, ",".join(str(k) for k in seed.spawn_key))
+    return str(seed)
+
+
+class ResultsStore(object):
+    """Append-only json lines store of trial results, keyed by (config hash, seed).
+
+    Args:
+        path: file the records are appended to, created if it does not exist
+        sync: fsync after every record, so a finished trial survives a crash of the machine as well
+    """
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self._results = dict()
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                ## End of the last complete line
+                end = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    end += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._results[(record["config"], record["seed"])] = record["result"]
+                ## Drop the partial last line of a store that was interrupted while writing, so the next
+                ## record does not get appended to it
+                f.truncate(end)
+        self._file = open(path, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self, key):
+        digest, seed = key
+        return (digest, seed_key(seed)) in self._results
+
+    def get(self, digest, seed, default=None):
+        return self._results.get((digest, seed_key(seed)), default)
+
+    def add(self, digest, seed, result, **extra):
+        """Record the result of one trial. Extra keyword arguments are stored along with it."""
+        record = {"config": digest, "seed": seed_key(seed), "result": result}
+        record.update(extra)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self._results[(digest, record["seed"])] = result
@@ -0,0 +1,75 @@
+## Per-trial random streams
+## Every trial owns its generators instead of sharing the global `random` and `np.random` state. The streams
+## are spawned from a root seed by (trial, node), so a trial draws the same numbers no matter which worker runs
+## it or in which order, and the random numbers are drawn from numpy in blocks instead of one call per value.
+
+import numpy as np
+
+
+def trial_seed(seed, *key):
+    """SeedSequence of one trial, e.g. trial_seed(root, trial) or trial_seed(root, point, trial)."""
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + tuple(key))
+    return np.random.SeedSequence(seed, spawn_key=tuple(key))
+
+
+class RandomStream(object):
+    """Uniform, integer and normal values of a counter based Philox generator, handed out from pre-drawn blocks.
+
+    Args:
+        seed: int, SeedSequence or None for fresh entropy
+        block_size: number of values drawn from the generator at once
+    """
+
+    def __init__(self, seed=None, block_size=4096):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed = seed
+        self.generator = np.random.Generator(np.random.Philox(seed))
+        self.block_size = block_size
+        self._uniform = []
+        self._normal = []
+        ## Generator state each block was drawn from, so a pickled stream stores its state instead of the values
+        self._uniform_state = None
+        self._normal_state = None
+
+    def spawn(self, n):
+        """n independent child streams, e.g. one per node."""
+        return [RandomStream(s, self.block_size) for s in self.seed.spawn(n)]
+
+    def random(self):
+        """Uniform value in [0, 1)."""
+        if not self._uniform:
+            ## Reversed so that pop() hands the block out in the order it was drawn
+            self._uniform_state = self.generator.bit_generator.state
+            self._uniform = self.generator.random(self.block_size)[::-1].tolist()
+        return self._uniform.pop()
+
+    def randint(self, low, high):
+        """Integer in [low, high), as np.random.randint."""
+        return low + int(self.random() * (high - low))
+
+    def normal(self, mean=0.0, std=1.0):
+        if not self._normal:
+            self._normal_state = self.generator.bit_generator.state
+            self._normal = self.generator.standard_normal(self.block_size)[::-1].tolist()
+        return mean + std * self._normal.pop()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_uniform'] = len(self._uniform)
+        state['_normal'] = len(self._normal)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._uniform = self._redraw(self._uniform_state, state['_uniform'], 'random')
+        self._normal = self._redraw(self._normal_state, state['_normal'], 'standard_normal')
+
+    def _redraw(self, state, left, method):
+        ## The `left` values of the block drawn from generator state `state` that pop() has not handed out yet
+        if not left:
+            return []
+        generator = np.random.Generator(np.random.Philox())
+        generator.bit_generator.state = state
+        return getattr(generator, method)(self.block_size)[::-1].tolist()[:left]
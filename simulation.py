@@ -1,207 +1,350 @@
 ## import all the classes
-from node import Node, RUN_TYPE, RADIO_STATE
-from radio import Radio
+## Importing this module has no side effects: run_simulation(config, seed) runs one trial of a config, and main()
+## is the command line interface that runs many of them on a process pool. A trial is a Simulation, whose state
+## can be snapshot, restored and forked at any slot.
+from node import Node, RUN_TYPE
+from radio import Radio, Medium
 from clock import Clock
-import threading
 from harvester import Harvester
-from interface import Publisher, Subscriber
-from time import sleep
+from interface import Publisher
+import pickle
 import yaml
-import random
+import zlib
 
-from harvester import harvestingmode
+from harvester import harvestingmode, SharedTraces, attach_shared_traces, trace_datasets, load_traces
+from topology import node_config, topology_from_config
+from results_store import ResultsStore, config_hash
+from rng import RandomStream, trial_seed
+from profiler import PhaseTimer
+from recorder import EventRecorder
+from metrics_store import MetricsWriter, trial_metrics
+from stopping import SequentialEstimator, OrderedFeed
 
 import logging
 
 
-## Take the name of the config file and debug file from the command line
-import argparse
-parser = argparse.ArgumentParser()
-parser.add_argument("config_file", help="The name of the config file")
-parser.add_argument("debug_file", help="The name of the debug file")
-args = parser.parse_args()
-config_file = args.config_file
-debug_file = args.debug_file
+def load_config(config_file):
+    """Create dictionary objects from a config file such as config.yaml"""
+    with open(config_file, 'r') as stream:
+        return yaml.load(stream, Loader=yaml.Loader)
 
-## In case of an error, print the example usage
-if config_file == None or debug_file == None:
-    print("Usage: python simulation.py <config_file> <debug_file>")
-    exit()
 
-logging.basicConfig(filename=debug_file,level = logging.DEBUG)
+## Phases of the slot loop timed with --profile. Harvesting is timed within run_one_time_step: get_energy for nodes
+## that harvest slot by slot, fast_forward for the slots_until and skip calls of charging nodes.
+## resolve is the medium resolving the receptions of all radios, i.e. their subscribe step.
+PHASES = ('clock', 'run_one_time_step', 'get_energy', 'fast_forward', 'publish', 'resolve', 'build_channel_map')
 
-## Create dictionary objects from config.yaml file
-with open(config_file, 'r') as stream:
-    try:
-        config = yaml.load(stream, Loader=yaml.Loader)
-    except yaml.YAMLError as exc:
-        print(exc)
+## Harvester methods timed as a phase of their own, with the phase they are counted in
+HARVESTER_PHASES = (('get_energy', 'get_energy'), ('slots_until', 'fast_forward'), ('skip', 'fast_forward'))
 
-## Get the number of nodes
-num_nodes = config['num_nodes']
+class Simulation(object):
+    """State of one trial of the discovery simulation: nodes, radios, harvesters, their random streams and the ASN.
 
-## Get the number of similation slots
-num_cycles = config['num_cycles']
+    A simulation is advanced slot by slot, and can be saved to a compact snapshot at any slot in between. A
+    snapshot restores into an identical simulation, e.g. to checkpoint a long trial, or is forked into a new
+    trial with its own seed, so many trials can branch off one shared warm-up.
 
-## Create dictionary objects for each of the n nodes and save it in an array
-nodes_config = []
-for i in range(num_nodes):
-    nodes_config.append(config['node'+str(i+1)])
+    Args:
+        config: simulation config as loaded from the yaml file
+        seed: int or SeedSequence of the trial, fresh entropy if None
+        recorder: optional EventRecorder the events of the trial are written to
+    """
 
-# print(nodes_config)
+    def __init__(self, config, seed=None, recorder=None):
+        self.config = config
+        num_nodes = config['num_nodes']
+        num_cycles = config['num_cycles']
+        nodes_config = [node_config(config, i) for i in range(num_nodes)]
 
-  
-    
+        ## Read every dataset the file harvesters may replay in one pass per trace file, before set_file asks for them
+        traces = []
+        for c in nodes_config:
+            if c.get('harvester').get('harvesting_mode') == 'file':
+                file = c.get('harvester').get('file')
+                traces.extend((file, d) for d in trace_datasets(file, c.get('harvester').get('dataset')))
+        load_traces(traces, 1e-2)
 
+        ## Every node draws from its own stream spawned from the seed of the trial, the topology from the one after
+        streams = RandomStream(seed).spawn(num_nodes + 1)
 
-def run_simulation():
-    ## Instantiate a radio, clock , and harvester
-    clock_publisher = Publisher("clock")
-
-    ## For each node create a node object and save it in an array using the nodes_config array
-
-    nodes = []
-    radios=[]
-    harvesters = []
-    for i in range(num_nodes):
-        radio = Radio(loglevel=logging.DEBUG)
-        radios.append(radio)
-        clock = Clock(1000000, clock_publisher)
-        if nodes_config[i].get('harvester').get('harvesting_mode') == 'constant':
-            power = nodes_config[i].get('harvester').get('power')
-            if power == "default":
-                power = (0.5 * nodes_config[i].get('capacitance')* (nodes_config[i].get('von')**2 - nodes_config[i].get('voff')**2))/ nodes_config[i].get('nominal_runtime')
-            else:
-                power = float(power)
-            harvester = Harvester(harvestingmode.CONSTANT, "none", clock_publisher)
-            harvester.set_constant(power)
-            harvesters.append(harvester)
-        elif nodes_config[i].get('harvester').get('harvesting_mode') == 'gaussian':
-            # mean = float(nodes_config[i].get('harvester').get('mean'))
-            mean = 0.5 * nodes_config[i].get('capacitance')* (nodes_config[i].get('von')**2 - nodes_config[i].get('voff')**2)/ nodes_config[i].get('nominal_runtime')
-            std = float(nodes_config[i].get('harvester').get('std')) * mean
-            harvester = Harvester(harvestingmode.GAUSSIAN, "none", clock_publisher)
-            harvester.set_gaussian(mean, std)
-            harvesters.append(harvester)
-        elif nodes_config[i].get('harvester').get('harvesting_mode') == 'file':
-            file = nodes_config[i].get('harvester').get('file')
-            harvester = Harvester(harvestingmode.FILE, file, clock_publisher)
-            harvester.set_file(file, 1e-2)
-            harvesters.append(harvester)
-        offset = random.randint(0, nodes_config[i].get('nominal_runtime')-1)
-
-        runtype = RUN_TYPE.NORMAL
-        if (nodes_config[i].get('runtype') == 'normal'):
-            runtype = RUN_TYPE.NORMAL
-        elif (nodes_config[i].get('runtype') == 'scanning'):
-            runtype = RUN_TYPE.SCANNING
-        elif (nodes_config[i].get('runtype') == 'advertising'):
-            runtype = RUN_TYPE.ADVERTISING
-
-        node = Node(i, harvester, clock_publisher, radio, offset,
-                    nodes_config[i].get('alpha'),
-                    nodes_config[i].get('capacitance'),
-                    nodes_config[i].get('von'),
-                    nodes_config[i].get('voff'),
-                    nodes_config[i].get('eadv'),  
-                    nodes_config[i].get('escan'),
-                    nodes_config[i].get('nominal_runtime'), num_cycles,
-                    runtype, log_level=logging.INFO)
-        nodes.append(node)
-
-    ## Connect the radios to one another
-    # for i in range(num_nodes):
-    ## Temporary assumption where we look at the discovery time of one node, considering it is in a star network
-    i= 0
-    for j in range(num_nodes):
-            if i != j:
-                # print("Connecting radio " + str(i) + " to radio " + str(j))
-                radios[i].connectto(radios[j])
-                radios[j].connectto(radios[i])
-
-    ## Run the simulation
-    ## Create threads for each node
-    slot = 0
-    done = False
-    while slot < num_cycles * nodes_config[0].get("nominal_runtime") and done == False:
-        clock.tick()
-        slot = slot + 1
-
-        ## Create a thread for each node and run one time step
-        # threads= []
-        # for i in range(num_nodes):
-        #     t = threading.Thread(target=nodes[i].run_one_time_step)
-        #     threads.append(t)
-        
-        # for t in threads:
-        #     t.start()
-        
-        # for t in threads:
-        #     t.join()
-        
-        # threads = []
-        # ## Run the publish on all radios in separate threads
-        # for i in range(num_nodes):
-        #     t = threading.Thread(target=radios[i].publish)
-        #     threads.append(t)
-
-        # for t in threads:
-        #     t.start()
-        
-        # for t in threads:
-        #     t.join()
-        
-        # threads = []
-        # ## Run the subscribe on all radios in separate threads
-        # for i in range(num_nodes):
-        #     t = threading.Thread(target=radios[i].subscribe)
-        #     threads.append(t)
-        
-        # for t in threads:
-        #     t.start()
-        
-        # for t in threads:
-        #     t.join()
-        
-        # threads = []
-        # ## Run the build channel map on all nodes
-        # for i in range(num_nodes):
-        #     t = threading.Thread(target=nodes[i].build_channel_map)
-        #     threads.append(t)
-        
-        # for t in threads:
-        #     t.start()
-        
-        # for t in threads:
-        #     t.join()
+        ## Instantiate a radio, clock , and harvester
+        clock_publisher = Publisher("clock")
+        medium = Medium(recorder)
 
+        ## For each node create a node object and save it in an array using the nodes_config array
+
+        nodes = []
+        radios=[]
+        harvesters = []
         for i in range(num_nodes):
-            nodes[i].run_one_time_step()
-        
-        for i in range(num_nodes):
-            radios[i].publish()
-        
-        for i in range(num_nodes):
-            radios[i].subscribe()
-        
-        for i in range(num_nodes):
-            nodes[i].build_channel_map()
-        
-        if nodes[0].metrics['adv_success'] == num_nodes -1:
-            print("Node discovered all other nodes at ASN:" + str(slot))
-            return slot
+            radio = Radio(loglevel=logging.DEBUG, medium=medium)
+            radios.append(radio)
+            clock = Clock(1000000, clock_publisher)
+            if nodes_config[i].get('harvester').get('harvesting_mode') == 'constant':
+                power = nodes_config[i].get('harvester').get('power')
+                if power == "default":
+                    power = (0.5 * nodes_config[i].get('capacitance')* (nodes_config[i].get('von')**2 - nodes_config[i].get('voff')**2))/ nodes_config[i].get('nominal_runtime')
+                else:
+                    power = float(power)
+                harvester = Harvester(harvestingmode.CONSTANT, "none", clock_publisher, rng=streams[i])
+                harvester.set_constant(power)
+                harvesters.append(harvester)
+            elif nodes_config[i].get('harvester').get('harvesting_mode') == 'gaussian':
+                # mean = float(nodes_config[i].get('harvester').get('mean'))
+                mean = 0.5 * nodes_config[i].get('capacitance')* (nodes_config[i].get('von')**2 - nodes_config[i].get('voff')**2)/ nodes_config[i].get('nominal_runtime')
+                std = float(nodes_config[i].get('harvester').get('std')) * mean
+                harvester = Harvester(harvestingmode.GAUSSIAN, "none", clock_publisher, rng=streams[i])
+                harvester.set_gaussian(mean, std)
+                harvesters.append(harvester)
+            elif nodes_config[i].get('harvester').get('harvesting_mode') in ('lognormal', 'onoff', 'diurnal'):
+                ## Stochastic modes with the mean energy of the default constant power
+                mode = nodes_config[i].get('harvester').get('harvesting_mode')
+                settings = nodes_config[i].get('harvester')
+                mean = 0.5 * nodes_config[i].get('capacitance')* (nodes_config[i].get('von')**2 - nodes_config[i].get('voff')**2)/ nodes_config[i].get('nominal_runtime')
+                harvester = Harvester(getattr(harvestingmode, mode.upper()), "none", clock_publisher, rng=streams[i])
+                if mode == 'lognormal':
+                    harvester.set_lognormal(mean, float(settings.get('sigma')))
+                elif mode == 'onoff':
+                    mean_on, mean_off = float(settings.get('mean_on')), float(settings.get('mean_off'))
+                    harvester.set_onoff(mean * (mean_on + mean_off) / mean_on, mean_on, mean_off)
+                else:
+                    harvester.set_diurnal(mean, float(settings.get('day')), float(settings.get('noise', 0.0)))
+                harvesters.append(harvester)
+            elif nodes_config[i].get('harvester').get('harvesting_mode') == 'file':
+                file = nodes_config[i].get('harvester').get('file')
+                harvester = Harvester(harvestingmode.FILE, file, clock_publisher, rng=streams[i])
+                harvester.set_file(file, 1e-2, nodes_config[i].get('harvester').get('dataset'))
+                harvesters.append(harvester)
+            offset = streams[i].randint(0, nodes_config[i].get('nominal_runtime'))
+
+            runtype = RUN_TYPE.NORMAL
+            if (nodes_config[i].get('runtype') == 'normal'):
+                runtype = RUN_TYPE.NORMAL
+            elif (nodes_config[i].get('runtype') == 'scanning'):
+                runtype = RUN_TYPE.SCANNING
+            elif (nodes_config[i].get('runtype') == 'advertising'):
+                runtype = RUN_TYPE.ADVERTISING
+
+            node = Node(i, harvester, clock_publisher, radio, offset,
+                        nodes_config[i].get('alpha'),
+                        nodes_config[i].get('capacitance'),
+                        nodes_config[i].get('von'),
+                        nodes_config[i].get('voff'),
+                        nodes_config[i].get('eadv'),  
+                        nodes_config[i].get('escan'),
+                        nodes_config[i].get('nominal_runtime'), num_cycles,
+                        runtype, log_level=logging.INFO, rng=streams[i], recorder=recorder)
+            nodes.append(node)
+
+        ## Connect the radios according to the topology of the config, a star around node 0 by default
+        topology = topology_from_config(config, streams[num_nodes].generator)
+        medium.use_topology(topology)
+        ## Node 0 has discovered the network once it counted every node it hears
+        self.num_targets = len(topology.sources(0))
+
+        self.nodes = nodes
+        self.radios = radios
+        self.harvesters = harvesters
+        self.medium = medium
+        self.clock = clock
+        self.recorder = recorder
+        self.max_slots = num_cycles * nodes_config[0].get("nominal_runtime")
+        self.slot = 0
+        self.done = False
+
+    def step(self, timer=None):
+        """Advance the trial by one slot.
+
+        Returns:
+            True once node 0 discovered all other nodes
+        """
+        if timer is not None:
+            timer.slots += 1
+            start = timer.now()
+        self.clock.tick()
+        self.slot = self.slot + 1
+        if timer is not None:
+            start = timer.lap('clock', start)
+
+        for node in self.nodes:
+            node.run_one_time_step()
+        if timer is not None:
+            start = timer.lap('run_one_time_step', start)
+
+        for radio in self.radios:
+            radio.publish()
+        if timer is not None:
+            start = timer.lap('publish', start)
+
+        self.medium.resolve()
+        if timer is not None:
+            start = timer.lap('resolve', start)
+
+        for node in self.nodes:
+            node.build_channel_map()
+        if timer is not None:
+            timer.lap('build_channel_map', start)
+
+        if self.nodes[0].metrics['adv_success'] == self.num_targets:
+            print("Node discovered all other nodes at ASN:" + str(self.slot))
+            self.done = True
+        return self.done
+
+    def run(self, until=None, timer=None):
+        """Run the trial until node 0 discovered all other nodes, the slot budget runs out, or slot `until`.
+
+        Args:
+            until: optional slot to stop at, e.g. the end of a warm-up or the next checkpoint
+            timer: optional PhaseTimer the time of every phase of the slot loop is added to
+
+        Returns:
+            the slot in which node 0 discovered all other nodes, None if it did not (yet)
+        """
+        last = self.max_slots if until is None else min(until, self.max_slots)
+        if timer is not None:
+            for harvester in self.harvesters:
+                for method, phase in HARVESTER_PHASES:
+                    setattr(harvester, method, timer.wrap(phase, getattr(harvester, method), parent='run_one_time_step'))
+        try:
+            while self.slot < last and not self.done:
+                self.step(timer)
+        finally:
+            if timer is not None:
+                for harvester in self.harvesters:
+                    for method, _ in HARVESTER_PHASES:
+                        delattr(harvester, method)
+        return self.slot if self.done else None
+
+    def node_metrics(self):
+        """Metrics and energy level of every node, one dict per node."""
+        return [dict(node.metrics, energy=node.energy_level) for node in self.nodes]
+
+    def set_recorder(self, recorder):
+        self.recorder = recorder
+        self.medium.recorder = recorder
+        for node in self.nodes:
+            node.recorder = recorder
+
+    def snapshot(self):
+        """The state of the simulation as compressed bytes. Trace data and the recorder are not part of it."""
+        recorder = self.recorder
+        self.set_recorder(None)
+        try:
+            return zlib.compress(pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL))
+        finally:
+            self.set_recorder(recorder)
+
+    @staticmethod
+    def restore(snapshot, recorder=None):
+        """The simulation a snapshot was taken of, continuing exactly as it would have."""
+        simulation = pickle.loads(zlib.decompress(snapshot))
+        simulation.set_recorder(recorder)
+        return simulation
+
+    @staticmethod
+    def fork(snapshot, seed=None, recorder=None):
+        """A new trial that continues from a snapshot with the random streams of `seed`.
+
+        The state up to the snapshot is shared by every fork of it, so forks are not independent trials. Random
+        state the run up to the snapshot did not depend on is drawn again: a node that has not started yet gets
+        a new offset past the snapshot and a new start of its harvest, e.g. its trace position. Nodes that are
+        charging are settled first, so the rest of their charging phase is drawn from the new streams.
+        """
+        simulation = Simulation.restore(snapshot, recorder)
+        streams = RandomStream(seed).spawn(len(simulation.nodes))
+        for node, stream in zip(simulation.nodes, streams):
+            node.settle()
+            node.rng = stream
+            node.energy_harvester.reseed(stream)
+            if node.ASN <= node.offset:
+                ## All the snapshot tells about the offset of a node that has not started is that it is not
+                ## before the current slot
+                node.offset = stream.randint(node.ASN, node.nominal_time_period)
+                node.energy_harvester.restart()
+        return simulation
+
+    def save(self, path):
+        """Checkpoint the simulation to a file, see load."""
+        with open(path, 'wb') as f:
+            f.write(self.snapshot())
+
+    @staticmethod
+    def load(path, recorder=None):
+        with open(path, 'rb') as f:
+            return Simulation.restore(f.read(), recorder)
+
+
+def run_simulation(config, seed=None, timer=None, recorder=None, metrics=None, snapshot=None):
+    """Run one trial of the discovery simulation.
+
+    Args:
+        config: simulation config as loaded from the yaml file
+        seed: int or SeedSequence of the trial, fresh entropy if None
+        timer: optional PhaseTimer the time of every phase of the slot loop is added to
+        recorder: optional EventRecorder the events of the trial are written to
+        metrics: optional list the metrics and final energy level of every node are appended to, one dict per node
+        snapshot: optional Simulation.snapshot the trial is forked from with its seed, instead of starting at slot 0
+
+    Returns:
+        the slot in which node 0 discovered all other nodes, None if it did not within the slot budget
+    """
+    if snapshot is not None:
+        simulation = Simulation.fork(snapshot, seed, recorder)
+    else:
+        simulation = Simulation(config, seed, recorder)
+    if timer is not None:
+        timer.trials += 1
+    slot = simulation.run(timer=timer)
+    if metrics is not None:
+        metrics.extend(simulation.node_metrics())
+    return slot
 
 
 import multiprocessing as mp
-from tqdm import tqdm
+import os
+import time
+import cProfile
 
-nSimulation = 1000
-results = []
+## Set in every pool worker by init_worker
+worker_config = None
+worker_options = None
+worker_digest = None
+## Snapshot of the shared warm-up every trial is forked from, with --warmup
+worker_snapshot = None
+## cProfile of the trials run by this worker, dumped to --cprofile after every trial
+worker_profile = None
+
+def init_worker(config, options, handles, digest, snapshot=None, datasets=None):
+    global worker_config, worker_options, worker_digest, worker_snapshot
+    worker_config = config
+    worker_options = options
+    worker_digest = digest
+    worker_snapshot = snapshot
+    attach_shared_traces(handles, datasets)
 
 def worker_function(simulation_number):
+    global worker_profile
     print("Simulation number: " + str(simulation_number + 1))
-    slot = run_simulation()
-    return slot
+    timer = PhaseTimer(PHASES) if worker_options.profile else None
+    if worker_options.cprofile is not None:
+        if worker_profile is None:
+            worker_profile = cProfile.Profile()
+        worker_profile.enable()
+    ## The trial is seeded by its number only, so its result does not depend on the worker that runs it
+    recorder = None
+    if worker_options.trace is not None:
+        recorder = EventRecorder(os.path.join(worker_options.trace, "trial%d.%s" % (simulation_number, worker_options.trace_format)))
+    seed = trial_seed(worker_options.seed, simulation_number)
+    counters = [] if worker_options.metrics is not None else None
+    slot = run_simulation(worker_config, seed, timer, recorder, counters, worker_snapshot)
+    if recorder is not None:
+        recorder.close()
+    if worker_profile is not None:
+        worker_profile.disable()
+        worker_profile.dump_stats(os.path.join(worker_options.cprofile, "worker%d.prof" % os.getpid()))
+    ## The metric records travel back with the result, only the parent writes to the metrics file
+    records = trial_metrics(counters, slot, worker_digest, seed, simulation_number) if counters is not None else None
+    return simulation_number, slot, timer.state() if timer is not None else None, records
 
 # for i in range(nSimulation):
 #     print("Simulation number: " + str(i+1))
@@ -230,18 +373,99 @@ def worker_function(simulation_number):
 # plt.ylabel("Simulation number")
 # plt.savefig("simulation_results_ourmethod.png")
 
-## Save the results to a file
-import cProfile
-import pstats
-
-if __name__ == '__main__':
-    pool = mp.Pool(mp.cpu_count())
-    ## Run the simulation using multiprocessing and get progress bar
-    # results = tqdm(pool.imap(worker_function, range(nSimulation)), total=nSimulation)
-    
-    results = pool.map(worker_function, range(nSimulation))
-    pool.close()
-    pool.join()
+def main(argv=None):
+    ## Take the name of the config file and debug file from the command line
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file", help="The name of the config file")
+    parser.add_argument("debug_file", help="The name of the debug file")
+    parser.add_argument("--store", default=None, help="Results store, finished trials are appended to it and skipped when rerun")
+    parser.add_argument("--seed", type=int, default=0, help="Root seed, every trial is seeded from (seed, trial number)")
+    parser.add_argument("--trials", type=int, default=1000, help="Number of trials, the cap with --precision")
+    parser.add_argument("--precision", type=float, default=None, help="Stop once the mean and median are known to this relative precision")
+    parser.add_argument("--min-trials", type=int, default=30, help="Finished trials required before stopping on --precision")
+    parser.add_argument("--profile", action="store_true", help="Report slots/s, trials/s and the time spent in every phase of the slot loop")
+    parser.add_argument("--cprofile", default=None, help="Directory to dump a cProfile stats file of every worker to")
+    parser.add_argument("--trace", default=None, help="Directory to write a binary event trace of every trial to")
+    parser.add_argument("--trace-format", default="npy", choices=["npy", "h5"], help="File format of the event traces")
+    parser.add_argument("--warmup", type=int, default=None, help="Run the first slots once and fork every trial from there. The forks share the state of the nodes that started in those slots, so they are not independent: no --precision, and they are tagged in the store")
+    parser.add_argument("--metrics", default=None, help="Columnar file (.npy or .h5) the per-node metrics of every trial run are appended to")
+    args = parser.parse_args(argv)
+    ## The confidence intervals of the sequential estimator assume independent trials
+    if args.warmup is not None and args.precision is not None:
+        parser.error("--precision cannot be used with --warmup, the forked trials are correlated")
+
+    logging.basicConfig(filename=args.debug_file, level = logging.DEBUG)
+    config = load_config(args.config_file)
+    nodes_config = [node_config(config, i) for i in range(config['num_nodes'])]
+    nSimulation = args.trials
+
+    ## Load every dataset a file harvester may replay once and share it read-only with the workers
+    traces = []
+    for c in nodes_config:
+        if c.get('harvester').get('harvesting_mode') == 'file':
+            file = c.get('harvester').get('file')
+            traces.extend((file, d) for d in trace_datasets(file, c.get('harvester').get('dataset')))
+    ## Trials already in the store are not run again, every finished trial is stored right away
+    ## Trials forked from a warm-up are stored apart from trials of the same config that were run from slot 0
+    digest = config_hash(config if args.warmup is None else dict(config, warmup=args.warmup))
+    store = ResultsStore(args.store) if args.store is not None else None
+    metrics = MetricsWriter(args.metrics) if args.metrics is not None else None
+    ## Results are used in trial order, up to the trial at which the estimate reached --precision
+    feed = OrderedFeed(SequentialEstimator(args.precision, min_trials=args.min_trials, max_trials=nSimulation))
+    todo = []
+    for i in range(nSimulation):
+        if store is not None and (digest, trial_seed(args.seed, i)) in store:
+            feed.add(i, store.get(digest, trial_seed(args.seed, i)))
+        else:
+            todo.append(i)
+
+    if args.cprofile is not None:
+        os.makedirs(args.cprofile, exist_ok=True)
+    if args.trace is not None:
+        os.makedirs(args.trace, exist_ok=True)
+    timer = PhaseTimer(PHASES)
+    wall_start = time.perf_counter()
+    ## Finished trials are on disk as soon as they come back, also if the run is interrupted or a worker fails
+    try:
+        with SharedTraces(traces) as shared_traces:
+            snapshot = None
+            if args.warmup is not None:
+                ## Seeded apart from the trials, which are spawned from the root seed itself
+                warmup = Simulation(config, trial_seed((args.seed, args.warmup)))
+                warmup.run(until=args.warmup)
+                snapshot = warmup.snapshot()
+            pool = mp.Pool(mp.cpu_count(), initializer=init_worker,
+                           initargs=(config, args, shared_traces.handles, digest, snapshot,
+                                     shared_traces.datasets))
+            ## Run the simulation using multiprocessing and get progress bar
+            # results = tqdm(pool.imap(worker_function, range(nSimulation)), total=nSimulation)
+
+            try:
+                for i, slot, counters, records in pool.imap_unordered(worker_function, todo if not feed.estimator.done() else []):
+                    if counters is not None:
+                        timer.merge(counters)
+                    if store is not None:
+                        store.add(digest, trial_seed(args.seed, i), slot, trial=i,
+                                  **({} if args.warmup is None else {'warmup': args.warmup}))
+                    if metrics is not None:
+                        metrics.add(records)
+                    if feed.add(i, slot):
+                        break
+            finally:
+                ## Trials still running once the estimate is precise enough are not needed
+                pool.terminate()
+                pool.join()
+    finally:
+        if store is not None:
+            store.close()
+        if metrics is not None:
+            metrics.close()
+    if args.profile:
+        print(timer.report(time.perf_counter() - wall_start))
+    results = feed.used
+    if args.precision is not None:
+        print("Stopped after %d trials: %s" % (len(results), feed.estimator.summary()))
     
     with open("simulation_results_ourmethod_node5_1000.txt", "w") as f:
         for item in results:
@@ -257,4 +481,8 @@ if __name__ == '__main__':
     # p.print_stats()
     
 
-    
\ No newline at end of file
+    
+
+
+if __name__ == '__main__':
+    main()
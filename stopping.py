@@ -0,0 +1,126 @@
+## Sequential stopping of Monte Carlo trials
+## Trial results are streamed into a running estimate of the mean and some quantiles of the discovery latency,
+## each with a confidence interval. A configuration is stopped once every interval is within the requested
+## relative precision, or once the trial cap is hit.
+##
+## Results have to be added in trial order: stopping on whichever trials finish first would favour the short
+## ones, as long discoveries also take longer to simulate.
+
+import bisect
+import math
+from statistics import NormalDist
+
+
+class SequentialEstimator(object):
+    """Running mean and quantiles of the discovery slots, with normal (mean) and order statistic (quantile)
+    confidence intervals. Trials that did not finish (None) only count towards the finished fraction.
+
+    Args:
+        precision: relative half-width of the confidence intervals to stop at, None never stops early
+        quantiles: quantiles to estimate besides the mean
+        confidence: confidence level of the intervals
+        min_trials: finished trials required before stopping early
+        max_trials: trial cap, None for no cap
+    """
+
+    def __init__(self, precision=None, quantiles=(0.5,), confidence=0.95, min_trials=30, max_trials=None):
+        self.precision = precision
+        self.quantiles = tuple(quantiles)
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.min_trials = min_trials
+        self.max_trials = max_trials
+        self.trials = 0
+        self.values = []
+        ## Welford's running mean and sum of squared deviations
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, slot):
+        self.trials += 1
+        if slot is None:
+            return
+        bisect.insort(self.values, slot)
+        n = len(self.values)
+        delta = slot - self._mean
+        self._mean += delta / n
+        self._m2 += delta * (slot - self._mean)
+
+    @property
+    def finished(self):
+        return len(self.values)
+
+    def mean(self):
+        """Mean of the finished trials and the half-width of its confidence interval."""
+        n = len(self.values)
+        if n < 2:
+            return (self._mean if n else None), math.inf
+        return self._mean, self.z * math.sqrt(self._m2 / (n - 1) / n)
+
+    def quantile(self, q):
+        """Quantile of the finished trials and its distribution-free confidence interval (lower, upper)."""
+        n = len(self.values)
+        if n == 0:
+            return None, (None, None)
+        spread = self.z * math.sqrt(n * q * (1 - q))
+        lower = max(0, int(math.floor(n * q - spread)) - 1)
+        upper = min(n - 1, int(math.ceil(n * q + spread)))
+        return self.values[min(n - 1, int(n * q))], (self.values[lower], self.values[upper])
+
+    def relative_precision(self):
+        """Largest relative half-width over the mean and the quantiles."""
+        mean, half = self.mean()
+        if mean is None or mean == 0 or math.isinf(half):
+            return math.inf
+        widths = [half / abs(mean)]
+        for q in self.quantiles:
+            value, (lower, upper) = self.quantile(q)
+            widths.append((upper - lower) / 2 / abs(value) if value else math.inf)
+        return max(widths)
+
+    def done(self):
+        if self.max_trials is not None and self.trials >= self.max_trials:
+            return True
+        if self.precision is None or self.finished < self.min_trials:
+            return False
+        return self.relative_precision() <= self.precision
+
+    def summary(self):
+        mean, half = self.mean()
+        summary = {'trials': self.trials, 'finished': self.finished, 'mean': mean,
+                   'mean_ci': None if math.isinf(half) else [mean - half, mean + half],
+                   'confidence': self.confidence, 'quantiles': {}}
+        for q in self.quantiles:
+            value, interval = self.quantile(q)
+            summary['quantiles'][str(q)] = {'value': value, 'ci': list(interval)}
+        return summary
+
+
+class OrderedFeed(object):
+    """Feeds results that arrive in any order to an estimator in trial order.
+
+    Args:
+        estimator: SequentialEstimator the results are added to
+    """
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+        self.next_trial = 0
+        self.pending = dict()
+        self.used = []
+
+    def add(self, trial, slot):
+        """Buffer the result of a trial and add every result that is now in order.
+
+        Returns:
+            True once the estimator is done, results added after that are ignored
+        """
+        if self.estimator.done():
+            return True
+        self.pending[trial] = slot
+        while self.next_trial in self.pending and not self.estimator.done():
+            slot = self.pending.pop(self.next_trial)
+            self.estimator.add(slot)
+            self.used.append(slot)
+            self.next_trial += 1
+        return self.estimator.done()
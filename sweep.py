@@ -0,0 +1,255 @@
+## Parallel parameter sweeps
+## Expands a parameter space from a yaml spec into design points, flattens (design point x trial) into one
+## stream of tasks over a process pool and appends the results of every design point to a json lines file as
+## soon as its last trial finished, so all cores stay busy across the whole study.
+##
+## Example spec:
+##   base: config.yaml          # simulation config the parameters are applied to, relative to the spec
+##   trials: 100                # trials per design point
+##   seed: 1                    # root seed of the lhs design and of every trial, 0 if not given
+##   design: grid               # grid: cartesian product of the listed values
+##   parameters:
+##     alpha: [0.5, 0.7, 0.9]
+##     num_nodes: [5, 10]
+##
+##   design: lhs                # latin hypercube over ranges
+##   samples: 50
+##   parameters:
+##     capacitance: {min: 22.0e-6, max: 100.0e-6}
+##     nominal_runtime: {min: 100, max: 2000}      # integer bounds give integer values
+##     harvester.std: {min: 0.1, max: 1.0, log: true}
+##
+## With `precision: 0.05` in the spec, a design point stops once the mean and quantiles of its discovery slots are
+## known to within 5% (see stopping.py), and `trials` is the cap per design point.
+##
+## With a results store (store: results.jsonl in the spec, or --store), finished trials are recorded as they
+## complete and trials already in the store are not run again.
+##
+## With a metrics file (metrics: metrics.npy in the spec, or --metrics), the per-node metrics of every trial that
+## is run are appended to it, see metrics_store.py.
+##
+## Top-level config keys (num_nodes, num_cycles) are set directly, every other parameter is set in all node
+## sections. Dotted names address nested keys, e.g. harvester.std.
+
+import copy
+import itertools
+import json
+import logging
+import os
+import queue
+import numpy as np
+import yaml
+import multiprocessing as mp
+
+from event_engine import EventSimulation
+from harvester import SharedTraces, attach_shared_traces, trace_datasets
+from metrics_store import MetricsWriter, trial_metrics
+from results_store import ResultsStore, config_hash
+from rng import trial_seed
+from stopping import SequentialEstimator, OrderedFeed
+from topology import node_config
+
+TOP_LEVEL = ('num_nodes', 'num_cycles')
+
+
+def load_sweep(path):
+    """Read a sweep spec and the base config it refers to."""
+    with open(path, 'r') as stream:
+        spec = yaml.load(stream, Loader=yaml.Loader)
+    base = os.path.join(os.path.dirname(os.path.abspath(path)), spec['base'])
+    with open(base, 'r') as stream:
+        spec['base_config'] = yaml.load(stream, Loader=yaml.Loader)
+    return spec
+
+
+def _values(entry):
+    ## Grid values: an explicit list, or {min, max, num} spaced linearly (or logarithmically with log: true)
+    if isinstance(entry, dict):
+        space = np.geomspace if entry.get('log', False) else np.linspace
+        values = space(entry['min'], entry['max'], int(entry['num']))
+        if isinstance(entry['min'], int) and isinstance(entry['max'], int):
+            values = np.unique(np.round(values).astype(int))
+        return values.tolist()
+    return list(entry)
+
+
+def grid_design(parameters):
+    names = list(parameters)
+    return [dict(zip(names, point)) for point in itertools.product(*(_values(parameters[n]) for n in names))]
+
+
+def lhs_design(parameters, samples, rng):
+    """Latin hypercube: every range is split into `samples` strata and each stratum is used exactly once."""
+    points = [dict() for _ in range(samples)]
+    for name, entry in parameters.items():
+        u = (rng.permutation(samples) + rng.random(samples)) / samples
+        low, high = entry['min'], entry['max']
+        if entry.get('log', False):
+            values = np.exp(np.log(low) + u * (np.log(high) - np.log(low)))
+        else:
+            values = low + u * (high - low)
+        integer = isinstance(low, int) and isinstance(high, int)
+        for point, value in zip(points, values):
+            point[name] = int(round(value)) if integer else float(value)
+    return points
+
+
+def expand_design(spec):
+    design = spec.get('design', 'grid')
+    if design == 'grid':
+        return grid_design(spec['parameters'])
+    elif design == 'lhs':
+        return lhs_design(spec['parameters'], int(spec['samples']), np.random.default_rng(spec.get('seed', 0)))
+    else:
+        raise ValueError("Unknown design: " + str(design))
+
+
+def _set(section, name, value):
+    keys = name.split('.')
+    for key in keys[:-1]:
+        section = section.setdefault(key, {})
+    section[keys[-1]] = value
+
+
+def apply_parameters(base_config, parameters):
+    """Copy of the config with the parameters of one design point applied."""
+    config = copy.deepcopy(base_config)
+    if 'default_node' not in config:
+        ## Nodes added by a larger num_nodes get the settings of node 1
+        config['default_node'] = copy.deepcopy(config['node1'])
+    for name, value in parameters.items():
+        if name in TOP_LEVEL:
+            config[name] = value
+    for name, value in parameters.items():
+        if name in TOP_LEVEL:
+            continue
+        sections = ['default_node'] + [key for key in config if key.startswith('node') and key[4:].isdigit()]
+        for key in sections:
+            _set(config[key], name, value)
+    return config
+
+
+def trace_datasets_of(configs):
+    ## (trace file, dataset) of every dataset a file harvester of the configs may replay
+    traces = set()
+    for config in configs:
+        for i in range(config['num_nodes']):
+            harvester = node_config(config, i).get('harvester')
+            if harvester.get('harvesting_mode') == 'file':
+                file = harvester.get('file')
+                traces.update((file, d) for d in trace_datasets(file, harvester.get('dataset')))
+    return sorted(traces)
+
+
+def run_trials(tasks, metrics=False):
+    results = []
+    for point, trial, config, seed in tasks:
+        simulation = EventSimulation(config, seed=seed)
+        slot = simulation.run()
+        records = trial_metrics(simulation.node_metrics(), slot, config_hash(config), seed, trial) if metrics else None
+        results.append((point, trial, slot, records))
+    return results
+
+
+def run_sweep(spec, output_file, processes=None, chunksize=1, store=None, metrics=None):
+    """Run the trials of every design point and append one json line per design point as it completes.
+
+    Without `precision` in the spec every design point runs `trials` trials. With it, a design point stops as
+    soon as the mean and the `quantiles` (default: the median) of its discovery slots are known to that relative
+    precision at the `confidence` level, after at least `min_trials` finished trials, and `trials` is the cap.
+
+    Args:
+        store: optional ResultsStore, trials found in it are skipped and finished trials are added to it
+        metrics: optional MetricsWriter the per-node metrics of every trial run are added to
+    """
+    logger = logging.getLogger(__name__)
+    processes = processes or mp.cpu_count()
+    points = expand_design(spec)
+    configs = [apply_parameters(spec['base_config'], p) for p in points]
+    digests = [config_hash(c) for c in configs]
+    trials = int(spec.get('trials', 1))
+    ## A fixed root by default, as --seed 0 of simulation.py, so a rerun of a spec finds its trials in the store
+    seed = spec.get('seed', 0)
+    feeds = [OrderedFeed(SequentialEstimator(spec.get('precision'), spec.get('quantiles', (0.5,)),
+                                             spec.get('confidence', 0.95), int(spec.get('min_trials', 30)), trials))
+             for _ in points]
+    written = [False] * len(points)
+
+    with SharedTraces(trace_datasets_of(configs)) as shared, open(output_file, 'a') as out:
+        def finish(point, trial, slot):
+            if feeds[point].add(trial, slot) and not written[point]:
+                written[point] = True
+                out.write(json.dumps({"point": point, "parameters": points[point], "slots": feeds[point].used,
+                                      "estimate": feeds[point].estimator.summary()}) + "\n")
+                out.flush()
+                logger.info("Design point %s of %s done", point + 1, len(points))
+
+        def chunks():
+            ## Generated lazily, so no more trials of a design point are started once it stopped
+            chunk = []
+            for point, config in enumerate(configs):
+                for trial in range(trials):
+                    if written[point]:
+                        break
+                    task_seed = trial_seed(seed, point, trial)
+                    if store is not None and (digests[point], task_seed) in store:
+                        finish(point, trial, store.get(digests[point], task_seed))
+                        continue
+                    chunk.append((point, trial, config, task_seed))
+                    if len(chunk) == chunksize:
+                        yield chunk
+                        chunk = []
+            if chunk:
+                yield chunk
+
+        ## Only a few chunks per worker are queued at a time, so stopped design points free their workers
+        results = queue.Queue()
+        source = chunks()
+        with mp.Pool(processes, initializer=attach_shared_traces, initargs=(shared.handles, shared.datasets)) as pool:
+            def submit():
+                for chunk in source:
+                    pool.apply_async(run_trials, (chunk, metrics is not None), callback=results.put, error_callback=results.put)
+                    return 1
+                return 0
+
+            in_flight = 0
+            while in_flight < 2 * processes and submit():
+                in_flight += 1
+            while in_flight > 0:
+                done = results.get()
+                in_flight -= 1
+                if isinstance(done, BaseException):
+                    raise done
+                for point, trial, slot, records in done:
+                    if store is not None:
+                        store.add(digests[point], trial_seed(seed, point, trial), slot, point=point, trial=trial)
+                    if metrics is not None:
+                        metrics.add(records)
+                    finish(point, trial, slot)
+                in_flight += submit()
+    return points, [feed.used for feed in feeds]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sweep_file", help="The name of the sweep spec")
+    parser.add_argument("output_file", help="The json lines file the results of every design point are appended to")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=1, help="Trials handed to a worker at once")
+    parser.add_argument("--store", default=None, help="Results store shared by reruns of the sweep")
+    parser.add_argument("--metrics", default=None, help="Columnar file (.npy or .h5) the per-node metrics of every trial run are appended to")
+    args = parser.parse_args()
+
+    spec = load_sweep(args.sweep_file)
+    store_file = args.store if args.store is not None else spec.get('store')
+    store = ResultsStore(store_file) if store_file is not None else None
+    metrics_file = args.metrics if args.metrics is not None else spec.get('metrics')
+    metrics = MetricsWriter(metrics_file) if metrics_file is not None else None
+    try:
+        run_sweep(spec, args.output_file, args.processes, args.chunksize, store, metrics)
+    finally:
+        if store is not None:
+            store.close()
+        if metrics is not None:
+            metrics.close()
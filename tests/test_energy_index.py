@@ -0,0 +1,37 @@
+import numpy as np
+
+from harvester import EnergyIndex
+
+
+def direct_window(data, sample_period, offset, length):
+    ## Energy of length samples from offset, wrapping around the end of the trace
+    positions = (offset + np.arange(length)) % len(data)
+    return float(np.sum(data[positions]) * sample_period)
+
+
+def test_cumulative_matches_cumsum():
+    data = np.random.default_rng(0).random(1000)
+    index = EnergyIndex(data, sample_period=1e-5)
+    np.testing.assert_allclose(index.cumulative[1:], np.cumsum(data) * 1e-5)
+    assert index.cumulative[0] == 0.0
+    assert len(index) == len(data)
+
+
+def test_window_matches_direct_sum():
+    rng = np.random.default_rng(1)
+    data = rng.random(997)
+    index = EnergyIndex(data, sample_period=1e-5)
+    ## Windows inside the trace, wrapping around its end, and longer than the trace
+    for offset, length in [(0, 10), (500, 497), (990, 20), (3, 997), (100, 2500), (996, 1)]:
+        assert np.isclose(index.window(offset, length), direct_window(data, 1e-5, offset, length))
+    offsets = rng.integers(0, len(data), size=50)
+    expected = [direct_window(data, 1e-5, o, 40) for o in offsets]
+    np.testing.assert_allclose(index.window(offsets, 40), expected)
+
+
+def test_slot_energy_index():
+    energy = np.random.default_rng(2).random(200)
+    index = EnergyIndex.from_slot_energy(energy, Ts=1e-2)
+    assert index.samples_per_slot(1e-2) == 1
+    np.testing.assert_allclose(index.window(np.arange(200), 1), energy)
+    assert np.isclose(index.slot_energy(150, 1e-2 * 60), direct_window(energy, 1.0, 150, 60))
@@ -0,0 +1,58 @@
+## The batch, event and population engines have to agree with the slot-stepped reference engine of simulation.py
+## in distribution. Every engine runs the same seeded trials of a small network, and the mean discovery latency and
+## the fraction of finished trials are compared within their sampling error.
+
+import numpy as np
+import pytest
+
+from batch import BatchSimulation
+from event_engine import EventSimulation
+from population import PopulationSimulation
+from rng import trial_seed
+from simulation import run_simulation
+
+TRIALS = 120
+SEED = 0
+
+
+def small_config():
+    ## Three nodes with a short period, so every engine runs its trials in seconds. They harvest a bit more than
+    ## half the energy of a period per period, so the latency depends on the energy model as well as the protocol
+    period = 50
+    power = 0.6 * 0.5 * 4.7e-05 * (3.0**2 - 2.4**2) / period
+    node = {'alpha': 0.7, 'capacitance': 4.7e-05, 'eadv': 4.805e-05, 'escan': 3.0e-06, 'nominal_runtime': period,
+            'voff': 2.4, 'von': 3.0, 'harvester': {'harvesting_mode': 'constant', 'power': power}}
+    return {'num_nodes': 3, 'num_cycles': 100, 'default_node': node}
+
+
+def summary(results):
+    finished = np.array([r for r in results if r is not None], dtype=float)
+    return finished.mean(), finished.std(ddof=1) / np.sqrt(len(finished)), len(finished) / len(results)
+
+
+@pytest.fixture(scope="module")
+def reference():
+    config = small_config()
+    return summary([run_simulation(config, trial_seed(SEED, i)) for i in range(TRIALS)])
+
+
+def run_batch(config):
+    return BatchSimulation(config, TRIALS, seed=SEED).run()
+
+
+def run_event(config):
+    return [EventSimulation(config, seed=trial_seed(SEED, i)).run() for i in range(TRIALS)]
+
+
+def run_population(config):
+    return [PopulationSimulation(config, seed=trial_seed(SEED, i)).run() for i in range(TRIALS)]
+
+
+@pytest.mark.parametrize("engine", [run_batch, run_event, run_population])
+def test_engine_matches_slot_engine(engine, reference):
+    mean, error, finished = summary(engine(small_config()))
+    ref_mean, ref_error, ref_finished = reference
+    assert abs(mean - ref_mean) < 3 * np.hypot(error, ref_error)
+    ## Binomial error of the two fractions, with a floor for fractions close to one
+    spread = np.sqrt((finished * (1 - finished) + ref_finished * (1 - ref_finished)) / TRIALS)
+    assert abs(finished - ref_finished) < max(3 * spread, 0.05)
@@ -0,0 +1,21 @@
+from results_store import ResultsStore
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    path = str(tmp_path / "store.jsonl")
+    with ResultsStore(path, sync=False) as store:
+        for i in range(3):
+            store.add("c", i, i * 10)
+    ## A write interrupted halfway through a record
+    with open(path, "a") as f:
+        f.write('{"config": "c", "seed": "3", "res')
+
+    with ResultsStore(path, sync=False) as store:
+        assert len(store) == 3
+        store.add("c", 3, 30)
+        store.add("c", 4, 40)
+
+    store = ResultsStore(path, sync=False)
+    store.close()
+    assert len(store) == 5
+    assert ("c", 3) in store and store.get("c", 4) == 40
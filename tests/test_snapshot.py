@@ -0,0 +1,30 @@
+## Snapshots of a simulation have to stay compact however long it has run, e.g. for checkpoints of long trials.
+
+from simulation import Simulation
+
+
+def low_harvest_config(num_nodes=3):
+    ## Nodes charge for hundreds of thousands of slots, all of it fast-forwarded
+    node = {'alpha': 0.7, 'capacitance': 4.7e-05, 'eadv': 4.805e-05, 'escan': 3.0e-06, 'nominal_runtime': 100,
+            'voff': 2.4, 'von': 3.0, 'harvester': {'harvesting_mode': 'constant', 'power': 2e-9}}
+    return {'num_nodes': num_nodes, 'num_cycles': 10**6, 'default_node': node}
+
+
+def test_snapshot_size_is_flat():
+    simulation = Simulation(low_harvest_config(), seed=1)
+    sizes = []
+    for until in (10_000, 50_000, 150_000):
+        simulation.run(until=until)
+        sizes.append(len(simulation.snapshot()))
+    assert max(sizes) < 1.2 * min(sizes)
+    assert max(sizes) < 20_000
+
+
+def test_restored_snapshot_continues_exactly():
+    config = low_harvest_config()
+    config['default_node']['harvester']['power'] = 'default'
+    config['num_cycles'] = 100
+    reference = Simulation(config, seed=3).run()
+    simulation = Simulation(config, seed=3)
+    simulation.run(until=500)
+    assert Simulation.restore(simulation.snapshot()).run() == reference
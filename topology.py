@@ -0,0 +1,174 @@
+## Network topologies for the discovery simulation
+## A topology is stored as a directed adjacency in CSR form, indexed by transmitter: the listeners of node j are
+## indices[indptr[j]:indptr[j+1]]. The reception computation of a slot then only touches the nodes that
+## transmit and their listeners, and no per-link Python objects are needed for large networks.
+##
+## Topologies are read from the `topology` section of the config file:
+##   topology:
+##     type: star                # default, node 0 is the hub as in the original simulation
+##
+##     type: edges               # explicit edge list
+##     edges: [[0, 1], [1, 2]]
+##     directed: false           # with directed: true, [a, b] means b hears a
+##
+##     type: unit_disk           # nodes within `radius` of each other hear one another
+##     radius: 10.0
+##     positions: [[0, 0], [5, 5], ...]   # or a `position` entry in every node section
+##
+##     type: random_geometric    # unit disk graph over positions drawn uniformly in `area`
+##     radius: 10.0
+##     area: [100.0, 100.0]
+##     seed: 1
+
+import numpy as np
+
+
+class Topology:
+    """Directed adjacency of a network in CSR form.
+
+    Args:
+        num_nodes: number of nodes
+        indptr: array of length num_nodes + 1, listeners of node j are indices[indptr[j]:indptr[j+1]]
+        indices: listener ids, sorted per transmitter
+        positions: optional (num_nodes, 2) array of node coordinates
+    """
+
+    def __init__(self, num_nodes, indptr, indices, positions=None):
+        self.num_nodes = num_nodes
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.positions = positions
+        self._transpose = None
+
+    @classmethod
+    def from_edges(cls, num_nodes, transmitters, listeners, positions=None):
+        """Build the CSR adjacency from arrays of (transmitter, listener) pairs. Duplicates and self loops are dropped."""
+        transmitters = np.asarray(transmitters, dtype=np.int64)
+        listeners = np.asarray(listeners, dtype=np.int64)
+        keep = transmitters != listeners
+        pairs = np.unique(transmitters[keep] * num_nodes + listeners[keep])
+        transmitters, listeners = np.divmod(pairs, num_nodes)
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(transmitters, minlength=num_nodes), out=indptr[1:])
+        return cls(num_nodes, indptr, listeners, positions)
+
+    def __len__(self):
+        return self.num_nodes
+
+    @property
+    def num_links(self):
+        return len(self.indices)
+
+    def listeners(self, j):
+        """Ids of the nodes that hear node j."""
+        return self.indices[self.indptr[j]:self.indptr[j + 1]]
+
+    def transpose(self):
+        """Topology with every link reversed, i.e. indexed by listener."""
+        if self._transpose is None:
+            transmitters = np.repeat(np.arange(self.num_nodes), np.diff(self.indptr))
+            self._transpose = Topology.from_edges(self.num_nodes, self.indices, transmitters, self.positions)
+        return self._transpose
+
+    def sources(self, i):
+        """Ids of the nodes that node i hears."""
+        return self.transpose().listeners(i)
+
+    def discovery_targets(self, hub=0):
+        """Nodes the hub hears, and for each of them whether it hears nothing but the hub.
+
+        The hub counts a node when it hears only that node advertising in a slot. A node that hears nothing but
+        the hub advertised successfully in the same slot and is done, so it can be counted at most once.
+        """
+        heard = self.sources(hub)
+        single = (np.diff(self.transpose().indptr)[heard] == 1) & np.isin(heard, self.listeners(hub))
+        return heard, single
+
+    def expand(self, transmitters):
+        """Concatenated listeners of the given transmitters, and for every entry the position of its transmitter."""
+        start = self.indptr[transmitters]
+        degree = self.indptr[transmitters + 1] - start
+        owner = np.repeat(np.arange(len(transmitters)), degree)
+        within = np.arange(degree.sum()) - np.repeat(np.cumsum(degree) - degree, degree)
+        return self.indices[np.repeat(start, degree) + within], owner
+
+    def to_dense(self):
+        """Dense boolean adjacency, adjacency[i, j] is True if i hears j."""
+        adjacency = np.zeros((self.num_nodes, self.num_nodes), dtype=bool)
+        transmitters = np.repeat(np.arange(self.num_nodes), np.diff(self.indptr))
+        adjacency[self.indices, transmitters] = True
+        return adjacency
+
+
+def star(num_nodes, hub=0):
+    """Star network of run_simulation: the hub hears every node and every node hears the hub."""
+    others = np.array([j for j in range(num_nodes) if j != hub], dtype=np.int64)
+    hubs = np.full(len(others), hub, dtype=np.int64)
+    return Topology.from_edges(num_nodes, np.concatenate((others, hubs)), np.concatenate((hubs, others)))
+
+
+def from_edge_list(num_nodes, edges, directed=False):
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    if directed:
+        return Topology.from_edges(num_nodes, edges[:, 0], edges[:, 1])
+    return Topology.from_edges(num_nodes, np.concatenate((edges[:, 0], edges[:, 1])),
+                               np.concatenate((edges[:, 1], edges[:, 0])))
+
+
+def unit_disk(positions, radius):
+    """Nodes closer than `radius` hear each other. Candidate pairs come from a grid of radius-sized cells,
+    so the cost grows with the number of links rather than with the square of the number of nodes."""
+    positions = np.asarray(positions, dtype=np.float64)
+    num_nodes = len(positions)
+    cell = np.floor((positions - positions.min(axis=0)) / radius).astype(np.int64)
+    ny = cell[:, 1].max() + 3
+    key = (cell[:, 0] + 1) * ny + (cell[:, 1] + 1)
+    order = np.argsort(key, kind="stable")
+    sorted_key = key[order]
+
+    sources, targets = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour_key = key + dx * ny + dy
+            start = np.searchsorted(sorted_key, neighbour_key, side="left")
+            count = np.searchsorted(sorted_key, neighbour_key, side="right") - start
+            source = np.repeat(np.arange(num_nodes), count)
+            within = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+            target = order[np.repeat(start, count) + within]
+            close = np.sum((positions[source] - positions[target])**2, axis=1) <= radius**2
+            sources.append(source[close])
+            targets.append(target[close])
+    return Topology.from_edges(num_nodes, np.concatenate(sources), np.concatenate(targets), positions)
+
+
+def random_geometric(num_nodes, radius, area=(1.0, 1.0), rng=None):
+    """Unit disk graph over positions drawn uniformly in a rectangle of the given size."""
+    rng = np.random.default_rng(rng)
+    positions = rng.random((num_nodes, 2)) * np.asarray(area, dtype=np.float64)
+    return unit_disk(positions, radius)
+
+
+def node_config(config, i):
+    """Config section of node i, the shared `default_node` section for nodes without their own."""
+    return config.get('node' + str(i + 1), config.get('default_node'))
+
+
+def topology_from_config(config, rng=None):
+    """Topology described by the `topology` section of a config, the star around node 0 if there is none."""
+    num_nodes = config['num_nodes']
+    spec = config.get('topology') or {}
+    kind = spec.get('type', 'star')
+    if kind == 'star':
+        return star(num_nodes)
+    elif kind == 'edges':
+        return from_edge_list(num_nodes, spec.get('edges'), spec.get('directed', False))
+    elif kind == 'unit_disk':
+        positions = spec.get('positions')
+        if positions is None:
+            positions = [node_config(config, i).get('position') for i in range(num_nodes)]
+        return unit_disk(positions, float(spec.get('radius')))
+    elif kind == 'random_geometric':
+        seed = spec.get('seed', rng)
+        return random_geometric(num_nodes, float(spec.get('radius')), spec.get('area', (1.0, 1.0)), seed)
+    else:
+        raise ValueError("Unknown topology type: " + str(kind))